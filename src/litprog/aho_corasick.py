@@ -0,0 +1,86 @@
+# This file is part of the litprog project
+# https://gitlab.com/mbarkhau/litprog
+#
+# Copyright (c) 2020 Manuel Barkhau (mbarkhau@gmail.com) - MIT License
+# SPDX-License-Identifier: MIT
+"""Find which of many patterns occur in a text, in a single pass.
+
+https://en.wikipedia.org/wiki/Aho%E2%80%93Corasick_algorithm
+"""
+import typing as typ
+import collections
+
+
+class Automaton:
+    """Aho-Corasick automaton over a fixed set of patterns."""
+
+    patterns: typ.List[str]
+
+    # per state
+    _goto   : typ.List[typ.Dict[str, int]]
+    _fail   : typ.List[int]
+    _outputs: typ.List[typ.FrozenSet[int]]
+
+    def __init__(self, patterns: typ.Iterable[str]) -> None:
+        self.patterns = list(patterns)
+        self._goto    = [{}]
+        self._fail    = [0]
+
+        outputs: typ.List[typ.Set[int]] = [set()]
+        for pattern_idx, pattern in enumerate(self.patterns):
+            if not pattern:
+                continue
+
+            state = 0
+            for char in pattern:
+                next_state = self._goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto[state][char] = next_state
+                    self._goto.append({})
+                    self._fail.append(0)
+                    outputs.append(set())
+                state = next_state
+            outputs[state].add(pattern_idx)
+
+        # breadth first, so that the fail state of a state is
+        # complete before it is used
+        queue = collections.deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail_state = self._fail[state]
+                while fail_state and char not in self._goto[fail_state]:
+                    fail_state = self._fail[fail_state]
+                fail_state = self._goto[fail_state].get(char, 0)
+                self._fail[next_state] = fail_state
+                outputs[next_state] |= outputs[fail_state]
+
+        self._outputs = [frozenset(state_outputs) for state_outputs in outputs]
+
+    def iter_matches(self, text: str) -> typ.Iterable[typ.Tuple[int, int]]:
+        """Yield (end, pattern_idx) for every occurrence of every pattern.
+
+        Occurrences of the empty pattern are not reported.
+        """
+        goto    = self._goto
+        fail    = self._fail
+        outputs = self._outputs
+
+        state = 0
+        for pos, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for pattern_idx in outputs[state]:
+                yield (pos + 1, pattern_idx)
+
+    def find_present(self, text: str) -> typ.Set[int]:
+        """Indexes of all patterns that occur in text."""
+        present = {idx for idx, pattern in enumerate(self.patterns) if not pattern}
+        for _, pattern_idx in self.iter_matches(text):
+            present.add(pattern_idx)
+            if len(present) == len(self.patterns):
+                break
+        return present
@@ -9,10 +9,15 @@ import re
 import sys
 import enum
 import math
+import json
 import time
+import shlex
+import shutil
+import bisect
 import typing as typ
 import logging
 import os.path
+import threading
 import datetime as dt
 import operator as op
 import functools as ft
@@ -21,7 +26,13 @@ import collections
 
 import pathlib2 as pl
 
+import litprog.index
+import litprog.aho_corasick
+import litprog.forkserver
+import litprog.parse
+import litprog.sched
 import litprog.session
+import litprog.tracing
 from litprog.parse import Block
 from litprog.parse import Context
 from litprog.parse import Headline
@@ -58,23 +69,22 @@ class Capture(typ.NamedTuple):
 
 
 def get_directive(block: Block, name: str) -> typ.Optional[Directive]:
-    for directive in block.directives:
-        if directive.name == name:
-            return directive
-    return None
+    directives = block.directive_index.get(name)
+    if directives:
+        return directives[0]
+    else:
+        return None
 
 
 def iter_directives(block: Block, name: str) -> typ.Iterable[Directive]:
-    for directive in block.directives:
-        if directive.name == name:
-            yield directive
+    return iter(block.directive_index.get(name, ()))
 
 
 def has_directive(block: Block, name: str) -> bool:
-    return get_directive(block, name) is not None
+    return name in block.directive_index
 
 
-CONSTANT_RE = re.compile(r"`lp_const:\s*(?P<name>\w+)\s*=(?P<value>.*)`")
+CONSTANT_RE = re.compile(r"`lp_const:\s*(?P<name>\w+)\s*=(?P<value>[^`]*)`")
 
 
 class ConstItem(typ.NamedTuple):
@@ -88,19 +98,27 @@ def _parse_constants(build_ctx: Context) -> typ.List[ConstItem]:
     for md_file in build_ctx.files:
         decl_path = md_file.md_path
         for elem in md_file.elements:
-            for match in CONSTANT_RE.finditer(elem.content):
+            content = elem.content
+            if "lp_const" not in content:
+                continue
+
+            for match in CONSTANT_RE.finditer(content):
                 name  = match.group('name')
-                value = match.group('value')
+                value = match.group('value').strip()
                 constants.append(ConstItem(decl_path, name, value))
 
-    # Expand longer constants first, so constants that
-    # are substrings of others don't clobber the longer
+    return constants
+
+
+def _init_constants_re(names: typ.Iterable[str]) -> typ.Pattern[str]:
+    # Longer names come first in the alternation, so constants
+    # that are substrings of others don't clobber the longer
     # constant. This is not an ideal solution, but since
     # we are restricted to textual replacement with any
     # conceivable language this may be adequate.
-    constants.sort(key=lambda item: len(item.name))
-
-    return constants
+    alternatives = sorted(set(names), key=lambda name: (-len(name), name))
+    pattern      = r"\b(?:" + "|".join(re.escape(name) for name in alternatives) + r")\b"
+    return re.compile(pattern)
 
 
 def find_include(block_contents: typ.List[str], include_directive: Directive) -> typ.Optional[str]:
@@ -130,85 +148,459 @@ def _parse_prefix(directive: Directive) -> str:
 
 
 def _expand_constants(build_ctx: Context) -> Context:
+    """Replace the names of constants in blocks with their values.
+
+    Constants are declared with `lp_const: NAME = value` anywhere
+    in a markdown file. The declaration in the file of a block
+    takes precedence over declarations in other files, otherwise
+    the first declaration wins. Each block is expanded with a
+    single regular expression substitution, values are not
+    expanded recursively.
+    """
     constants = _parse_constants(build_ctx)
-    # macros have been abandoned for now
-    return build_ctx
+    if not constants:
+        return build_ctx
 
-    done = False
-    while not done:
-        done         = True
-        new_md_files = []
-        for md_file in build_ctx.files:
-            cur_path = md_file.md_path
-
-            new_elements = list(md_file.elements)
-
-            for block in md_file.blocks:
-                new_content = block.content
-                for decl_path, name, const_val in constants:
-                    namespace   = decl_path.name[: -len(decl_path.suffix)]
-                    new_content = new_content.replace(name, const_val)
-                    if decl_path == cur_path:
-                        new_content = new_content.replace(name, const_val)
-
-                # TODO: There may a bug here that relates to the order
-                #   of expanding blocks. Since the addable_val is based
-                #   on block.inner_content, there may be issues with
-                #   recursive includes
-
-                if new_content == block.content:
-                    continue
+    global_values: typ.Dict[str, str] = {}
+    local_values : typ.Dict[pl.Path, typ.Dict[str, str]] = collections.defaultdict(dict)
+    for decl_path, name, value in constants:
+        global_values.setdefault(name, value)
+        local_values[decl_path].setdefault(name, value)
 
-                done = False
+    constants_re = _init_constants_re(global_values)
 
-                elem = md_file.elements[block.elem_index]
-                new_elements[block.elem_index] = MarkdownElement(
-                    elem.md_path, elem.elem_index, elem.md_type, new_content, elem.first_line, None
-                )
+    new_md_files = []
+    for md_file in build_ctx.files:
+        values = dict(global_values)
+        values.update(local_values.get(md_file.md_path, {}))
 
-            new_md_file = MarkdownFile(md_file.md_path, new_elements)
-            new_md_files.append(new_md_file)
+        def _repl(match: typ.Match[str]) -> str:
+            return values[match.group()]
 
-        build_ctx = Context(new_md_files)
+        is_changed   = False
+        new_elements = list(md_file.elements)
+        for block in md_file.blocks:
+            new_content = constants_re.sub(_repl, block.content)
+            if new_content == block.content:
+                continue
 
-    return build_ctx
+            is_changed = True
+            elem       = md_file.elements[block.elem_index]
+            new_elements[block.elem_index] = MarkdownElement(
+                elem.md_path, elem.elem_index, elem.md_type, new_content, elem.first_line, None
+            )
+
+        if is_changed:
+            new_md_files.append(MarkdownFile(md_file.md_path, new_elements))
+        else:
+            new_md_files.append(md_file)
+
+    return Context(new_md_files)
+
+
+NON_ADDABLE_DIRECTIVES = {'lp_out', 'lp_run', 'lp_make', 'lp_add', 'lp_file'}
+
+
+def _is_addable_block(block: Block) -> bool:
+    return NON_ADDABLE_DIRECTIVES.isdisjoint(block.directive_index)
 
 
 def _iter_addable_blocks(md_file: MarkdownFile) -> typ.Iterable[Block]:
     for block in md_file.blocks:
-        is_simple_block = not any(
-            (
-                has_directive(block, 'lp_out'),
-                has_directive(block, 'lp_run'),
-                has_directive(block, 'lp_make'),
-                has_directive(block, 'lp_add'),
-                has_directive(block, 'lp_file'),
-            )
-        )
-        if is_simple_block:
+        if _is_addable_block(block):
             yield block
 
 
-def _expand_file_add_directives(md_file: MarkdownFile) -> MarkdownFile:
-    addable_contents = [b.inner_content for b in _iter_addable_blocks(md_file)]
+# Below this, plain substring searches are faster than
+# building and running an Aho-Corasick automaton.
+MIN_AUTOMATON_QUERIES = 8
 
-    new_elements = list(md_file.elements)
-    for block in md_file.blocks:
-        new_content = block.content
+
+class _AddableIndex:
+    """Addable blocks of a file, with memoized lp_add lookups.
+
+    Blocks are added in generations (one per round of expansion).
+    A lookup returns the first block (in document order) of the
+    current generation or earlier, that contains the query. Since
+    blocks are never removed, a lookup only has to search the
+    blocks that were added since the previous lookup of the same
+    query.
+    """
+
+    _blocks      : typ.List[Block]
+    _block_gens  : typ.List[int]
+    _elem_indexes: typ.List[int]
+    _gen         : int
+    _memo        : typ.Dict[str, typ.Tuple[int, typ.Optional[Block]]]
+
+    def __init__(self) -> None:
+        self._blocks       = []
+        self._block_gens   = []
+        self._elem_indexes = []
+        self._gen          = 0
+        self._memo         = {}
+
+    def add(self, block: Block) -> None:
+        """Add a block, it is visible after the next call to next_gen()."""
+        pos = bisect.bisect(self._elem_indexes, block.elem_index)
+        self._blocks.insert(pos, block)
+        self._block_gens.insert(pos, self._gen + 1)
+        self._elem_indexes.insert(pos, block.elem_index)
+
+    def next_gen(self) -> None:
+        self._gen += 1
+
+    def __len__(self) -> int:
+        return len(self._blocks)
+
+    def _stale_memo(
+        self, queries: typ.Iterable[str]
+    ) -> typ.Dict[str, typ.Tuple[int, typ.Optional[Block]]]:
+        """Memo entries of queries from before the current generation."""
+        stale: typ.Dict[str, typ.Tuple[int, typ.Optional[Block]]] = {}
+        for query in queries:
+            prev_gen, match = self._memo.get(query, (0, None))
+            if prev_gen < self._gen:
+                stale[query] = (prev_gen, match)
+        return stale
+
+    def prefetch(self, queries: typ.Iterable[str]) -> None:
+        """Resolve many queries with one pass over the blocks.
+
+        This has the same result as calling find() for each query,
+        but each block is only scanned once for all queries.
+        """
+        stale = self._stale_memo(queries)
+        if len(stale) < MIN_AUTOMATON_QUERIES:
+            return
+
+        automaton = litprog.aho_corasick.Automaton(stale)
+        results   = {query: match for query, (_, match) in stale.items()}
+        remaining = set(range(len(automaton.patterns)))
+        min_gen   = min(prev_gen for prev_gen, _ in stale.values())
+
+        # Queries with a previous match are done once the
+        # scan reaches the block of that match.
+        cutoffs = sorted(
+            (match.elem_index, pattern_idx)
+            for pattern_idx, (_, match) in enumerate(stale.values())
+            if match
+        )
+        cutoffs.reverse()
+
+        for block, block_gen in zip(self._blocks, self._block_gens):
+            while cutoffs and cutoffs[-1][0] <= block.elem_index:
+                _, pattern_idx = cutoffs.pop()
+                remaining.discard(pattern_idx)
+
+            if not remaining:
+                break
+            if not min_gen < block_gen <= self._gen:
+                continue
+
+            for pattern_idx in automaton.find_present(block.inner_content) & remaining:
+                query       = automaton.patterns[pattern_idx]
+                prev_gen, _ = stale[query]
+                if prev_gen < block_gen:
+                    results[query] = block
+                    remaining.discard(pattern_idx)
+
+        for query, match in results.items():
+            self._memo[query] = (self._gen, match)
+
+    def find(self, query: str) -> typ.Optional[Block]:
+        prev_gen, match = self._memo.get(query, (0, None))
+        if prev_gen < self._gen:
+            for block, block_gen in zip(self._blocks, self._block_gens):
+                if match and block.elem_index >= match.elem_index:
+                    break
+                if prev_gen < block_gen <= self._gen and query in block.inner_content:
+                    match = block
+                    break
+            self._memo[query] = (self._gen, match)
+        return match
+
+
+def _pending_add_deps(
+    pending: typ.Dict[int, Block], index: _AddableIndex
+) -> typ.Dict[int, typ.List[int]]:
+    # An unresolved lp_add depends on the pending blocks which
+    # contain its query. Pending blocks only become addable once
+    # all of their own lp_add directives are resolved.
+    deps: typ.Dict[int, typ.List[int]] = {}
+    for elem_index, block in pending.items():
+        deps[elem_index] = []
         for lp_add in iter_directives(block, 'lp_add'):
-            addable_val = find_include(addable_contents, lp_add)
-            if not addable_val:
+            query = lp_add.value.strip()
+            if index.find(query):
                 continue
+            for dep in pending.values():
+                if query in dep.inner_content:
+                    deps[elem_index].append(dep.elem_index)
+    return deps
+
+
+def _iter_cycles(deps: typ.Dict[int, typ.List[int]]) -> typ.Iterable[typ.List[int]]:
+    """Cycles of a dependency graph, found by a depth first search."""
+    visited: typ.Set[int] = set()
+    for root in sorted(deps):
+        path : typ.List[int] = []
+        stack: typ.List[typ.Tuple[int, int]] = [(root, 0)]
+        while stack:
+            node, dep_idx = stack.pop()
+            if dep_idx == 0:
+                if node in path:
+                    yield path[path.index(node) :]
+                    continue
+                if node in visited:
+                    continue
+                visited.add(node)
+                path.append(node)
+
+            if dep_idx < len(deps[node]):
+                stack.append((node, dep_idx + 1))
+                stack.append((deps[node][dep_idx], 0))
+            else:
+                path.pop()
+
+
+def _iter_add_cycles(
+    pending: typ.Dict[int, Block], index: _AddableIndex
+) -> typ.Iterable[typ.List[Block]]:
+    deps = _pending_add_deps(pending, index)
+    for cycle in _iter_cycles(deps):
+        yield [pending[elem_index] for elem_index in cycle]
 
-            new_content = _indented_include(new_content, lp_add.raw_text, addable_val)
 
-        if new_content == block.content:
+# (query, elem_index) of the inclusions that produced an lp_add
+# directive (the directive is part of the included content)
+_Ancestry = typ.FrozenSet[typ.Tuple[str, int]]
+
+# (lp_add directive, addable block) pairs of a pending block
+_Includes = typ.List[typ.Tuple[Directive, Block]]
+
+
+def _iter_add_queries(content: str) -> typ.Iterable[str]:
+    """Queries of text in content, which may become lp_add directives."""
+    for line in content.splitlines():
+        _, sep, query = line.partition("lp_add:")
+        if sep:
+            yield query.strip()
+
+
+def _new_ancestries(
+    block     : Block,
+    includes  : _Includes,
+    ancestries: typ.Dict[str, _Ancestry],
+) -> typ.Dict[str, _Ancestry]:
+    """Ancestries (by query) of the lp_add directives of an expanded block."""
+    replaced = {lp_add.value.strip() for lp_add, _ in includes}
+    included = [
+        (
+            lp_add.value.strip(),
+            addable_block.elem_index,
+            set(_iter_add_queries(addable_block.inner_content)),
+        )
+        for lp_add, addable_block in includes
+    ]
+
+    new_ancestries: typ.Dict[str, _Ancestry] = {}
+    for lp_add in iter_directives(block, 'lp_add'):
+        query    = lp_add.value.strip()
+        ancestry : typ.Set[typ.Tuple[str, int]] = set()
+        if query not in replaced:
+            ancestry.update(ancestries.get(query, ()))
+
+        for include_query, elem_index, add_queries in included:
+            if query in add_queries:
+                ancestry.update(ancestries.get(include_query, ()))
+                ancestry.add((include_query, elem_index))
+
+        new_ancestries[query] = new_ancestries.get(query, frozenset()) | ancestry
+    return new_ancestries
+
+
+def _find_includes(block: Block, index: _AddableIndex) -> _Includes:
+    includes: _Includes = []
+    for lp_add in iter_directives(block, 'lp_add'):
+        addable_block = index.find(lp_add.value.strip())
+        if addable_block and addable_block.inner_content:
+            includes.append((lp_add, addable_block))
+    return includes
+
+
+def _is_recursive(includes: _Includes, ancestries: typ.Dict[str, _Ancestry]) -> bool:
+    for lp_add, addable_block in includes:
+        query = lp_add.value.strip()
+        if (query, addable_block.elem_index) in ancestries.get(query, ()):
+            return True
+    return False
+
+
+def _expand_includes(block: Block, includes: _Includes, is_recursive: bool) -> str:
+    new_content = block.content
+    raw_texts   = set()
+    for lp_add, addable_block in includes:
+        # NOTE: All occurrences of raw_text are replaced at once.
+        #   For a recursive block, replacing them again would
+        #   expand the directives that were just included.
+        if is_recursive and lp_add.raw_text in raw_texts:
             continue
+        raw_texts.add(lp_add.raw_text)
+
+        new_content = _indented_include(new_content, lp_add.raw_text, addable_block.inner_content)
+    return new_content
+
+
+class _AddRound(typ.NamedTuple):
+    includes_by_block: typ.Dict[int, _Includes]
+    new_contents     : typ.Dict[int, str]
+    # elem indexes of recursive blocks that can never be expanded
+    stuck_blocks: typ.List[int]
 
-        elem = md_file.elements[block.elem_index]
-        new_elements[block.elem_index] = MarkdownElement(
+
+def _expand_add_round(
+    pending           : typ.Dict[int, Block],
+    index             : _AddableIndex,
+    ancestries        : typ.Dict[int, typ.Dict[str, _Ancestry]],
+    is_index_unchanged: bool,
+) -> _AddRound:
+    index.prefetch(
+        lp_add.value.strip()
+        for block in pending.values()
+        for lp_add in iter_directives(block, 'lp_add')
+    )
+
+    includes_by_block: typ.Dict[int, _Includes] = {}
+    recursive_blocks : typ.Set[int] = set()
+    for elem_index, block in pending.items():
+        includes = _find_includes(block, index)
+        if includes:
+            includes_by_block[elem_index] = includes
+            if _is_recursive(includes, ancestries.get(elem_index, {})):
+                recursive_blocks.add(elem_index)
+
+    # NOTE: Recursive blocks are only expanded again once the
+    #   lookup of their directives may have a different result.
+    new_contents: typ.Dict[int, str] = {}
+    for elem_index, includes in includes_by_block.items():
+        is_recursive = elem_index in recursive_blocks
+        if is_recursive and is_index_unchanged:
+            continue
+
+        block       = pending[elem_index]
+        new_content = _expand_includes(block, includes, is_recursive)
+        if new_content != block.content:
+            new_contents[elem_index] = new_content
+
+    if is_index_unchanged and not new_contents:
+        stuck_blocks = sorted(recursive_blocks)
+    else:
+        stuck_blocks = []
+
+    return _AddRound(includes_by_block, new_contents, stuck_blocks)
+
+
+def _update_add_round(
+    new_elements: typ.List[MarkdownElement],
+    add_round   : _AddRound,
+    index       : _AddableIndex,
+    pending     : typ.Dict[int, Block],
+    ancestries  : typ.Dict[int, typ.Dict[str, _Ancestry]],
+) -> int:
+    """Replace the expanded elements, returns the number of new addable blocks."""
+    n_added = 0
+    for elem_index, new_content in sorted(add_round.new_contents.items()):
+        elem     = new_elements[elem_index]
+        new_elem = MarkdownElement(
             elem.md_path, elem.elem_index, elem.md_type, new_content, elem.first_line, None
         )
+        new_elements[elem_index] = new_elem
+
+        block = litprog.parse.parse_block(new_elem)
+        if _is_addable_block(block):
+            index.add(block)
+            n_added += 1
+
+        if has_directive(block, 'lp_add'):
+            pending[elem_index]    = block
+            includes               = add_round.includes_by_block[elem_index]
+            block_ancestries       = ancestries.get(elem_index, {})
+            ancestries[elem_index] = _new_ancestries(block, includes, block_ancestries)
+        else:
+            del pending[elem_index]
+            ancestries.pop(elem_index, None)
+    return n_added
+
+
+def _max_add_rounds(md_file: MarkdownFile) -> int:
+    # NOTE: This is a safeguard in case a recursion is not
+    #   detected. Each round either makes a block addable, or
+    #   it includes a block for a (query, block) pair that is
+    #   not yet in the ancestry of the directive. Included text
+    #   is always from the original blocks, so there are no
+    #   queries other than those in the original file.
+    queries = {query for block in md_file.blocks for query in _iter_add_queries(block.content)}
+    return (len(queries) + 1) * (len(md_file.blocks) + 1)
+
+
+def _expand_file_add_directives(md_file: MarkdownFile) -> MarkdownFile:
+    """Expand lp_add directives, round by round.
+
+    In each round, every lp_add directive is resolved using the
+    blocks that were addable at the start of the round. A block
+    becomes addable once all of its own lp_add directives have
+    been resolved. Only blocks which changed are parsed again.
+    """
+    new_elements = list(md_file.elements)
+
+    index   = _AddableIndex()
+    pending: typ.Dict[int, Block] = {}
+    for block in md_file.blocks:
+        if _is_addable_block(block):
+            index.add(block)
+        elif has_directive(block, 'lp_add'):
+            pending[block.elem_index] = block
+
+    # NOTE: An addable block may contain the text of an lp_add
+    #   directive without it being parsed as one (for example if
+    #   the block has no language). If such a block is included
+    #   and the directive is parsed in the including block, it may
+    #   be expanded to the same block again. A block is recursive
+    #   if one of its directives would be expanded to a block,
+    #   which was included for the same query to produce that
+    #   directive. If no block became addable and only recursive
+    #   blocks would change, expansion would never terminate.
+    ancestries: typ.Dict[int, typ.Dict[str, _Ancestry]] = {}
+
+    n_added    = len(index)
+    n_rounds   = 0
+    max_rounds = _max_add_rounds(md_file)
+    while pending:
+        n_rounds += 1
+        if n_rounds > max_rounds:
+            err_msg = (
+                f"Expansion of lp_add directives in {md_file.md_path} "
+                f"did not terminate after {max_rounds} rounds."
+            )
+            raise Exception(err_msg)
+
+        index.next_gen()
+        add_round = _expand_add_round(pending, index, ancestries, is_index_unchanged=n_added == 0)
+
+        for elem_index in add_round.stuck_blocks:
+            line_no = new_elements[elem_index].first_line
+            log.error(f"Recursive lp_add directive in {md_file.md_path} on line {line_no}")
+            del pending[elem_index]
+
+        if not add_round.new_contents:
+            break
+
+        n_added = _update_add_round(new_elements, add_round, index, pending, ancestries)
+
+    for cycle in _iter_add_cycles(pending, index):
+        cycle_lines = ", ".join(str(new_elements[block.elem_index].first_line) for block in cycle)
+        log.error(f"Cyclic lp_add directives in {md_file.md_path} on lines {cycle_lines}")
 
     return MarkdownFile(md_file.md_path, new_elements)
 
@@ -222,14 +614,7 @@ def _iter_expanded_files(md_files: typ.Iterable[MarkdownFile]) -> typ.Iterable[M
     # the first occurrence of it's search string in the
     # same file.
     for md_file in md_files:
-        prev_md_file = md_file
-        while True:
-            new_md_file = _expand_file_add_directives(prev_md_file)
-            if new_md_file == prev_md_file:
-                yield new_md_file
-                break
-            else:
-                prev_md_file = new_md_file
+        yield _expand_file_add_directives(md_file)
 
 
 def _iter_block_errors(orig_ctx: Context, build_ctx: Context) -> typ.Iterable[str]:
@@ -244,37 +629,83 @@ def _iter_block_errors(orig_ctx: Context, build_ctx: Context) -> typ.Iterable[st
         assert orig_md_file.md_path == md_file.md_path
         assert len(orig_md_file.elements) == len(md_file.elements)
 
-        for block in md_file.blocks:
+        for block in md_file.blocks_with_directive('lp_add'):
             orig_elem = orig_md_file.elements[block.elem_index]
-            for directive in block.directives:
-                if directive.name != 'lp_add':
-                    continue
-
-                elem = md_file.elements[block.elem_index]
-
-                rel_line_no = 0
-                for line in orig_elem.content.splitlines():
-                    if directive.raw_text in line:
-                        break
-                    else:
-                        rel_line_no += 1
+            for directive in iter_directives(block, 'lp_add'):
+                rel_offset = orig_elem.content.find(directive.raw_text)
+                if rel_offset < 0:
+                    line_no = orig_elem.first_line + orig_elem.content.count("\n")
+                else:
+                    offset  = orig_md_file.elem_offset(block.elem_index) + rel_offset
+                    line_no = orig_md_file.line_no(offset)
 
-                line_no = elem.first_line + rel_line_no
                 yield f"Error processing {md_file.md_path}"
                 yield f"Could not expend '{directive.raw_text}' on line {line_no}"
 
 
-def _dump_files(build_ctx: Context) -> None:
-    for md_file in build_ctx.files:
-        for block in md_file.blocks:
-            file_directive = get_directive(block, 'lp_file')
-            if file_directive is None:
-                continue
+def _content_digest(data: bytes) -> litprog.index.HexDigest:
+    """Digest of data, the same as litprog.index.file_digest of a file with data."""
+    id_sum = litprog.index.new_digest()
+    id_sum.update(data)
+    return id_sum.hexdigest()
+
 
-            path = pl.Path(file_directive.value)
+def _is_file_unchanged(path: pl.Path, data: bytes) -> bool:
+    try:
+        if path.stat().st_size != len(data):
+            return False
+        return litprog.index.file_digest(path) == _content_digest(data)
+    except IOError:
+        return False
+
+
+def _lp_file_contents(build_ctx: Context) -> typ.Dict[pl.Path, str]:
+    # NOTE: If multiple blocks have the same lp_file target,
+    #   the last one wins.
+    contents: typ.Dict[pl.Path, str] = {}
+    for block in build_ctx.blocks_with_directive('lp_file'):
+        file_directive = get_directive(block, 'lp_file')
+        assert file_directive is not None
+        contents[pl.Path(file_directive.value)] = block.inner_content
+    return contents
+
+
+def _dump_files(build_ctx: Context) -> None:
+    # NOTE: Files are only written if their content changed, so
+    #   that mtimes are preserved for other build tools.
+    n_written = 0
+    n_skipped = 0
+    for path, content in _lp_file_contents(build_ctx).items():
+        if _is_file_unchanged(path, content.encode("utf-8")):
+            n_skipped += 1
+        else:
             path.parent.mkdir(parents=True, exist_ok=True)
-            with path.open(mode="w", encoding="utf-8") as fh:
-                fh.write(block.inner_content)
+            _replace_file(path, content)
+            n_written += 1
+
+    log.info(f"lp_file: {n_written} written, {n_skipped} unchanged")
+
+
+def _iter_session_blocks(md_file: MarkdownFile) -> typ.Iterable[Block]:
+    """Blocks with an lp_run or lp_out directive, in document order."""
+    run_blocks     = md_file.blocks_with_directive('lp_run')
+    out_blocks     = md_file.blocks_with_directive('lp_out')
+    session_blocks = {block.elem_index: block for block in run_blocks + out_blocks}
+    for elem_index in sorted(session_blocks):
+        yield session_blocks[elem_index]
+
+
+def _replace_file(path: pl.Path, content: str) -> None:
+    # NOTE: The file is replaced rather than truncated and
+    #   rewritten, since the original may still be memory mapped
+    #   (see parse_context(use_mmap=True)) and elements that
+    #   reference it would otherwise become invalid.
+    tmp_path = path.parent / f".{path.name}.{os.getpid()}.tmp"
+    with tmp_path.open(mode="w", encoding="utf-8") as fh:
+        fh.write(content)
+    if path.exists():
+        shutil.copymode(str(path), str(tmp_path))
+    tmp_path.replace(path)
 
 
 class SessionBlockOptions(typ.NamedTuple):
@@ -305,6 +736,49 @@ class SessionBlockOptions(typ.NamedTuple):
     out_prefix: str
     err_prefix: str
 
+    # limits for the output of an lp_out block (None: no limit)
+    max_lines: typ.Optional[int]
+    max_bytes: typ.Optional[int]
+
+    # name of the persistent session (lp_session directive)
+    session: typ.Optional[str]
+
+
+# NOTE: The capture limits are per output stream (stdout and
+#   stderr). They are a safeguard against runaway processes.
+#   To shorten the output of a block, lp_max_lines and
+#   lp_max_bytes are set on its lp_out block.
+CAPTURE_MAX_LINES = 100_000
+CAPTURE_MAX_BYTES = 16 * 1024 * 1024
+
+
+def _parse_limit(block: Block, name: str) -> typ.Optional[int]:
+    directive = get_directive(block, name)
+    if directive is None:
+        return None
+
+    try:
+        limit = int(directive.value.replace("_", ""))
+    except ValueError:
+        limit = -1
+
+    if limit <= 0:
+        err_msg = f"Invalid {name}: {directive.value}. Must be a positive integer."
+        raise Exception(err_msg)
+
+    return limit
+
+
+def _parse_session_name(block: Block) -> typ.Optional[str]:
+    directive = get_directive(block, 'lp_session')
+    if directive is None:
+        return None
+
+    name = directive.value.strip()
+    if not name:
+        raise Exception("Invalid lp_session: Must be the name of the session.")
+    return name
+
 
 def _parse_session_block_options(block: Block) -> typ.Optional[SessionBlockOptions]:
     run_directive = get_directive(block, 'lp_run')
@@ -396,8 +870,56 @@ def _parse_session_block_options(block: Block) -> typ.Optional[SessionBlockOptio
         info_fmt=info_fmt,
         out_prefix=_parse_prefix(out_prefix) if out_prefix else "",
         err_prefix=_parse_prefix(err_prefix) if err_prefix else "! ",
+        max_lines=_parse_limit(block, 'lp_max_lines'),
+        max_bytes=_parse_limit(block, 'lp_max_bytes'),
+        session=_parse_session_name(block),
+    )
+
+
+def _n_fitting_lines(
+    lines: typ.Iterable[CapturedLine], max_lines: float, max_bytes: float
+) -> int:
+    n_fitting = 0
+    n_lines   = 0
+    n_bytes   = 0
+    for cl in lines:
+        if not cl.n_omitted:
+            n_lines += 1
+            n_bytes += len(cl.line.encode("utf-8"))
+            if n_lines > max_lines or n_bytes > max_bytes:
+                break
+        n_fitting += 1
+    return n_fitting
+
+
+def _truncate_lines(
+    lines    : typ.List[CapturedLine],
+    max_lines: typ.Optional[int],
+    max_bytes: typ.Optional[int],
+) -> typ.List[CapturedLine]:
+    """Keep the lines at the head and at the tail of the output.
+
+    The lines in between are replaced by a single marker (which
+    also counts the lines that were omitted during the capture).
+    """
+    lines_limit = math.inf if max_lines is None else max_lines
+    bytes_limit = math.inf if max_bytes is None else max_bytes
+
+    head_max_lines = lines_limit // 2
+    head_max_bytes = bytes_limit // 2
+    head_len       = _n_fitting_lines(lines, head_max_lines, head_max_bytes)
+    tail_len       = _n_fitting_lines(
+        reversed(lines[head_len:]), lines_limit - head_max_lines, bytes_limit - head_max_bytes
     )
 
+    omitted = lines[head_len : len(lines) - tail_len]
+    if not any(cl.n_omitted == 0 for cl in omitted):
+        return lines
+
+    n_omitted = sum(cl.n_omitted or 1 for cl in omitted)
+    marker    = CapturedLine(omitted[0].ts, "", omitted[0].is_err, n_omitted)
+    return lines[:head_len] + [marker] + lines[len(lines) - tail_len :]
+
 
 def _parse_capture_output(capture: Capture, opts: SessionBlockOptions) -> str:
     # TODO: coloring
@@ -407,8 +929,11 @@ def _parse_capture_output(capture: Capture, opts: SessionBlockOptions) -> str:
     #     stderr = opts.err_fmt.format(capture.stderr)
 
     output_lines = []
-    for cl in capture.lines:
-        if cl.is_err:
+    for cl in _truncate_lines(capture.lines, opts.max_lines, opts.max_bytes):
+        if cl.n_omitted:
+            prefix   = opts.err_prefix if cl.is_err else opts.out_prefix
+            line_val = prefix + f"[... {cl.n_omitted} lines omitted ...]"
+        elif cl.is_err:
             if opts.err_prefix:
                 line_val = opts.err_prefix + cl.line
             else:
@@ -443,131 +968,993 @@ def _parse_capture_output(capture: Capture, opts: SessionBlockOptions) -> str:
     return output
 
 
-def build(orig_ctx: Context) -> Context:
-    # TODO: Immutable datastructures
-    #   Context, MarkdownFile
+# Held while writing output of the build (log messages, debug
+# output of sessions and updates of markdown files), so that
+# output from concurrent sessions is not interleaved.
+_OUTPUT_LOCK = threading.RLock()
+
+
+class SessionLog:
+    """Output of a session, optionally buffered until flush()."""
+
+    is_buffered: bool
+
+    _messages: typ.List[typ.Tuple[typ.Callable[[str], typ.Any], str]]
+
+    def __init__(self, is_buffered: bool = False) -> None:
+        self.is_buffered = is_buffered
+        self._messages   = []
+
+    def _write(self, write_fn: typ.Callable[[str], typ.Any], msg: str) -> None:
+        if self.is_buffered:
+            self._messages.append((write_fn, msg))
+        else:
+            with _OUTPUT_LOCK:
+                write_fn(msg)
+
+    def info(self, msg: str) -> None:
+        self._write(log.info, msg)
+
+    def error(self, msg: str) -> None:
+        self._write(log.error, msg)
+
+    def write_stdout(self, text: str) -> None:
+        self._write(sys.stdout.write, text)
+
+    def write_stderr(self, text: str) -> None:
+        self._write(sys.stderr.write, text)
+
+    def flush(self) -> None:
+        messages       = self._messages
+        self._messages = []
+        with _OUTPUT_LOCK:
+            for write_fn, msg in messages:
+                write_fn(msg)
+
+
+ForkServers = typ.Optional[litprog.forkserver.ForkServerPool]
+
+
+def _run_session(
+    block       : Block,
+    opts        : SessionBlockOptions,
+    slog        : typ.Optional[SessionLog] = None,
+    fork_servers: ForkServers = None,
+) -> Capture:
+    assert opts.command
+    if slog is None:
+        slog = SessionLog()
+
+    fork_server = fork_servers.get(opts.command) if fork_servers else None
+    if fork_server:
+        slog.info(f"  lp_run {opts.command} (fork server)")
+    else:
+        slog.info(f"  lp_run {opts.command}")
+
+    isession = litprog.session.InteractiveSession(
+        opts.command,
+        max_lines=CAPTURE_MAX_LINES,
+        max_bytes=CAPTURE_MAX_BYTES,
+        fork_server=fork_server,
+    )
+
+    if opts.is_stdin_writable:
+        stdin_lines = block.inner_content.splitlines(opts.keepends)
+    else:
+        stdin_lines = []
+
+    try:
+        for line in stdin_lines:
+            if opts.is_debug:
+                slog.write_stderr(opts.debug_prefix + line.rstrip() + "\n")
+            isession.send(line, delay=opts.input_delay)
+        exit_status = isession.wait(timeout=opts.timeout)
+    except Exception:
+        slog.error(f"Error processing '{opts.command}'")
+        slog.write_stdout("".join(isession.iter_stdout()))
+        slog.write_stderr("".join(isession.iter_stderr()))
+        raise
+
+    runtime_ms = isession.runtime * 1000
+    slog.info(f"  lp_run  exit: {exit_status}  time: {runtime_ms:9.3f}ms")
+
+    lines = list(isession.iter_lines())
+    if isession.is_truncated:
+        limits = f"max lines: {CAPTURE_MAX_LINES}, max bytes: {CAPTURE_MAX_BYTES}"
+        slog.info(f"  lp_run  output truncated ({limits})")
+
+    # TODO: output escaping/fence style change and errors
+
+    return Capture(opts.command, exit_status, isession.runtime, lines)
+
+
+CAPTURE_CACHE_VERSION = 3
+
+# Environment variables that may change the output of a session.
+CAPTURE_CACHE_ENV_VARS = [
+    'PATH',
+    'HOME',
+    'LANG',
+    'LC_ALL',
+    'LC_CTYPE',
+    'PYTHONPATH',
+    'VIRTUAL_ENV',
+]
+
+
+def _is_cacheable_session(block: Block) -> bool:
+    # NOTE: The purpose of an lp_make session is its side
+    #   effect (the files it creates), which a replayed capture
+    #   would not have. The output of an lp_session block
+    #   depends on the blocks that ran before it.
+    return not (has_directive(block, 'lp_make') or has_directive(block, 'lp_session'))
+
+
+def _iter_capture_dep_paths(
+    md_file: MarkdownFile, block: Block, opts: SessionBlockOptions
+) -> typ.Iterable[str]:
+    yield from _iter_directive_paths(block, 'lp_deps')
+
+    # NOTE: Commands often use files generated from the same
+    #   markdown file (e.g. "lp_out: python3 out/example.py")
+    #   without declaring them with lp_deps.
+    for file_block in md_file.blocks_with_directive('lp_file'):
+        yield from _iter_directive_paths(file_block, 'lp_file')
+
+    assert opts.command
+    try:
+        args = shlex.split(opts.command)
+    except ValueError:
+        args = opts.command.split()
+
+    for arg in args:
+        if os.path.isfile(arg):
+            yield os.path.normpath(arg)
+
+
+def _capture_cache_path(
+    md_file      : MarkdownFile,
+    block        : Block,
+    opts         : SessionBlockOptions,
+    cache_dir    : pl.Path,
+    file_contents: typ.Optional[typ.Mapping[str, bytes]] = None,
+) -> pl.Path:
+    """Path of the cache entry for the capture of a session.
+
+    The file_contents (by normalized path) are used instead of
+    the files on disk, for files that have not been written yet.
+    """
+    assert opts.command
+    id_sum = litprog.index.new_digest()
+    id_sum.update(f"{CAPTURE_CACHE_VERSION}\0{opts.command}\0{opts.timeout}\0".encode("utf-8"))
+    if opts.is_stdin_writable:
+        id_sum.update(block.inner_content.encode("utf-8"))
+
+    for env_var in CAPTURE_CACHE_ENV_VARS:
+        env_val = os.environ.get(env_var, "")
+        id_sum.update(f"\0{env_var}={env_val}".encode("utf-8"))
+
+    for dep_path in sorted(set(_iter_capture_dep_paths(md_file, block, opts))):
+        if file_contents and dep_path in file_contents:
+            digest = _content_digest(file_contents[dep_path])
+        else:
+            try:
+                digest = litprog.index.file_digest(pl.Path(dep_path))
+            except IOError:
+                digest = "<missing>"
+        id_sum.update(f"\0{dep_path}:{digest}".encode("utf-8"))
+
+    return cache_dir / "captures" / (id_sum.hexdigest() + ".json")
+
+
+def _read_capture_cache(cache_path: pl.Path) -> typ.Optional[Capture]:
+    if not cache_path.exists():
+        return None
+
+    try:
+        with cache_path.open(mode="r", encoding="utf-8") as fh:
+            data = json.load(fh)
+        lines = [CapturedLine(*cl) for cl in data['lines']]
+        return Capture(data['command'], data['exit_status'], data['runtime'], lines)
+    except Exception:
+        log.warning(f"Ignoring invalid/corrupted cache file '{cache_path}'", exc_info=True)
+        return None
+
+
+def _write_capture_cache(cache_path: pl.Path, capture: Capture) -> None:
+    data = {
+        'command'    : capture.command,
+        'exit_status': capture.exit_status,
+        'runtime'    : capture.runtime,
+        'lines'      : [list(cl) for cl in capture.lines],
+    }
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    # NOTE: Identical sessions in different files have the same
+    #   cache_path and may complete concurrently.
+    tmp_name = f"{cache_path.name}.{os.getpid()}.{threading.get_ident()}.tmp"
+    tmp_path = cache_path.parent / tmp_name
+    with tmp_path.open(mode="w", encoding="utf-8") as fh:
+        json.dump(data, fh)
+    tmp_path.replace(cache_path)
+
+
+def _run_cached_session(
+    md_file     : MarkdownFile,
+    block       : Block,
+    opts        : SessionBlockOptions,
+    cache_dir   : typ.Optional[pl.Path],
+    is_buffered : bool        = False,
+    fork_servers: ForkServers = None,
+    reused      : typ.Optional[typ.List[Block]] = None,
+) -> Capture:
+    slog = SessionLog(is_buffered)
+    try:
+        return _run_cached_session_logged(
+            md_file, block, opts, cache_dir, slog, fork_servers, reused
+        )
+    finally:
+        slog.flush()
+
+
+def _run_cached_session_logged(
+    md_file     : MarkdownFile,
+    block       : Block,
+    opts        : SessionBlockOptions,
+    cache_dir   : typ.Optional[pl.Path],
+    slog        : SessionLog,
+    fork_servers: ForkServers,
+    reused      : typ.Optional[typ.List[Block]],
+) -> Capture:
+    first_line = md_file.elements[block.elem_index].first_line
+    span_args  = {'path': md_file.md_path, 'line': first_line, 'command': opts.command}
+    if cache_dir is None or not _is_cacheable_session(block):
+        with litprog.tracing.span("session", cat="session", **span_args):
+            return _run_session(block, opts, slog, fork_servers)
+
+    # NOTE: The cache key is only calculated when the session
+    #   is ready to run, since the files it depends on may be
+    #   generated by other sessions.
+    cache_path = _capture_cache_path(md_file, block, opts, cache_dir)
+    capture    = _read_capture_cache(cache_path)
+    if capture is None:
+        with litprog.tracing.span("session", cat="session", **span_args):
+            capture = _run_session(block, opts, slog, fork_servers)
+        _write_capture_cache(cache_path, capture)
+    else:
+        slog.info(f"  lp_run {opts.command} (cached, {md_file.md_path}:{first_line})")
+        if reused is not None:
+            reused.append(block)
+    return capture
+
+
+# (file_idx, elem_index) of a block
+SessionKey = typ.Tuple[int, int]
+
+# (file_idx, name) of an lp_session
+PersistentSessionKey = typ.Tuple[int, str]
+
+
+class PersistentSessions:
+    """Processes of lp_session directives, kept alive between blocks.
+
+    The process of a session is closed after its last block
+    has run (see add_block).
+    """
+
+    _lock    : threading.Lock
+    _sessions: typ.Dict[PersistentSessionKey, litprog.session.PersistentSession]
+    _n_blocks: typ.Dict[PersistentSessionKey, int]
+
+    def __init__(self) -> None:
+        self._lock     = threading.Lock()
+        self._sessions = {}
+        self._n_blocks = collections.Counter()
+
+    def add_block(self, key: PersistentSessionKey) -> None:
+        self._n_blocks[key] += 1
+
+    def _get(
+        self, key: PersistentSessionKey, opts: SessionBlockOptions
+    ) -> litprog.session.PersistentSession:
+        assert opts.command
+        with self._lock:
+            psession = self._sessions.get(key)
+            if psession is None:
+                psession = litprog.session.PersistentSession(
+                    opts.command, max_lines=CAPTURE_MAX_LINES, max_bytes=CAPTURE_MAX_BYTES
+                )
+                self._sessions[key] = psession
+            elif psession.command != opts.command:
+                err_msg = (
+                    f"Invalid command for lp_session: {opts.session}. "
+                    f"The session was started with '{psession.command}', not '{opts.command}'."
+                )
+                raise Exception(err_msg)
+            return psession
+
+    def _block_done(self, key: PersistentSessionKey) -> None:
+        with self._lock:
+            self._n_blocks[key] -= 1
+            if self._n_blocks[key] > 0:
+                return
+            psession = self._sessions.pop(key, None)
+
+        if psession:
+            psession.close()
+
+    def run(
+        self, file_idx: int, block: Block, opts: SessionBlockOptions, slog: SessionLog
+    ) -> Capture:
+        assert opts.command and opts.session
+        key = (file_idx, opts.session)
+        slog.info(f"  lp_run {opts.command} (lp_session: {opts.session})")
+
+        if opts.is_stdin_writable:
+            stdin_lines = block.inner_content.splitlines(opts.keepends)
+        else:
+            stdin_lines = []
+
+        if opts.is_debug:
+            for line in stdin_lines:
+                slog.write_stderr(opts.debug_prefix + line.rstrip() + "\n")
+
+        try:
+            psession = self._get(key, opts)
+            output   = psession.run(stdin_lines, timeout=opts.timeout, delay=opts.input_delay)
+        except Exception:
+            slog.error(f"Error processing '{opts.command}'")
+            raise
+        finally:
+            self._block_done(key)
+
+        runtime_ms = output.runtime * 1000
+        slog.info(f"  lp_run  exit: {output.exit_status}  time: {runtime_ms:9.3f}ms")
+        if output.is_truncated:
+            limits = f"max lines: {CAPTURE_MAX_LINES}, max bytes: {CAPTURE_MAX_BYTES}"
+            slog.info(f"  lp_run  output truncated ({limits})")
+
+        return Capture(opts.command, output.exit_status, output.runtime, output.lines)
+
+    def close(self) -> None:
+        with self._lock:
+            psessions = list(self._sessions.values())
+            self._sessions.clear()
+
+        for psession in psessions:
+            psession.close()
+
+
+def _run_persistent_session(
+    persistent_sessions: PersistentSessions,
+    file_idx           : int,
+    md_file            : MarkdownFile,
+    block              : Block,
+    opts               : SessionBlockOptions,
+    is_buffered        : bool = False,
+) -> Capture:
+    first_line = md_file.elements[block.elem_index].first_line
+    span_args  = {'path': md_file.md_path, 'line': first_line, 'command': opts.command}
+    slog       = SessionLog(is_buffered)
+    try:
+        with litprog.tracing.span("session", cat="session", session=opts.session, **span_args):
+            return persistent_sessions.run(file_idx, block, opts, slog)
+    finally:
+        slog.flush()
+
+
+def _iter_directive_paths(block: Block, name: str) -> typ.Iterable[str]:
+    for directive in iter_directives(block, name):
+        for path_str in directive.value.replace(",", " ").split():
+            yield os.path.normpath(path_str)
+
+
+_Session = typ.Tuple[SessionKey, Block, SessionBlockOptions]
+
+
+def _iter_sessions(build_ctx: Context) -> typ.Iterable[_Session]:
+    for file_idx, md_file in enumerate(build_ctx.files):
+        for block in _iter_session_blocks(md_file):
+            opts = _parse_session_block_options(block)
+            if opts and opts.command:
+                yield ((file_idx, block.elem_index), block, opts)
+
+
+def _lp_make_deps(sessions: typ.List[_Session]) -> typ.Dict[SessionKey, typ.Set[SessionKey]]:
+    """Dependencies of sessions due to lp_make directives.
+
+    A session with an lp_make directive runs after all previous
+    sessions of the same file, and all following sessions of the
+    file run after it.
+    """
+    deps: typ.Dict[SessionKey, typ.Set[SessionKey]] = {}
+
+    prev_keys : typ.List[SessionKey]     = []
+    prev_maker: typ.Optional[SessionKey] = None
+    prev_file : int                      = -1
+    for key, block, _ in sessions:
+        file_idx, _ = key
+        if file_idx != prev_file:
+            prev_keys  = []
+            prev_maker = None
+            prev_file  = file_idx
+
+        if has_directive(block, 'lp_make'):
+            deps[key]  = set(prev_keys)
+            prev_maker = key
+        elif prev_maker:
+            deps[key] = {prev_maker}
+        prev_keys.append(key)
+    return deps
+
+
+def _lp_session_deps(sessions: typ.List[_Session]) -> typ.Dict[SessionKey, typ.Set[SessionKey]]:
+    """Dependencies of each session on the previous session of its lp_session."""
+    deps: typ.Dict[SessionKey, typ.Set[SessionKey]] = {}
+
+    prev_by_name: typ.Dict[typ.Tuple[int, str], SessionKey] = {}
+    for key, _, opts in sessions:
+        if not opts.session:
+            continue
+
+        file_idx, _ = key
+        name_key    = (file_idx, opts.session)
+        if name_key in prev_by_name:
+            deps[key] = {prev_by_name[name_key]}
+        prev_by_name[name_key] = key
+    return deps
+
+
+def _init_session_graph(
+    build_ctx          : Context,
+    cache_dir          : typ.Optional[pl.Path] = None,
+    is_buffered        : bool        = False,
+    fork_servers       : ForkServers = None,
+    persistent_sessions: typ.Optional[PersistentSessions] = None,
+    reused             : typ.Optional[typ.List[Block]] = None,
+) -> litprog.sched.Graph:
+    """Derive the order in which sessions must run.
+
+    Sessions are independent of each other, except for
+      - a session with an 'lp_deps: <path>' directive, which runs
+        after all sessions that declare 'lp_make: <path>'
+      - a session with an 'lp_make' directive, which runs after all
+        previous and before all following sessions of the same file.
+      - a session with an 'lp_session: <name>' directive, which runs
+        after the previous session of the same name and file.
+
+    Files from 'lp_file' directives are written before any session
+    is started, so they don't introduce any dependencies.
+
+    If a cache_dir is given, captures are reused from previous
+    builds if the inputs of a session are unchanged. The blocks
+    of reused captures are appended to reused.
+
+    With is_buffered=True, the output of each session is written
+    only once it has completed (for sessions that run concurrently).
+
+    With fork_servers, python sessions are forked from a fork
+    server instead of starting a new interpreter.
+
+    Sessions with an lp_session directive run in the processes of
+    persistent_sessions, which should be closed after the graph
+    has run, in case it was aborted.
+    """
+    sessions = list(_iter_sessions(build_ctx))
+    if persistent_sessions is None:
+        persistent_sessions = PersistentSessions()
+
+    makers_by_path: typ.Dict[str, typ.List[SessionKey]] = collections.defaultdict(list)
+    for key, block, _ in sessions:
+        for path_str in _iter_directive_paths(block, 'lp_make'):
+            makers_by_path[path_str].append(key)
+
+    make_deps    = _lp_make_deps(sessions)
+    session_deps = _lp_session_deps(sessions)
+
+    graph = litprog.sched.Graph()
+    for key, block, opts in sessions:
+        deps: typ.Set[SessionKey] = set()
+        for path_str in _iter_directive_paths(block, 'lp_deps'):
+            deps.update(makers_by_path.get(path_str, []))
+        deps.update(make_deps.get(key, ()))
+        deps.update(session_deps.get(key, ()))
+        deps.discard(key)
+
+        file_idx, _ = key
+        md_file     = build_ctx.files[file_idx]
+        run_fn: typ.Callable[[], Capture]
+        if opts.session:
+            persistent_sessions.add_block((file_idx, opts.session))
+            run_fn = ft.partial(
+                _run_persistent_session,
+                persistent_sessions,
+                file_idx,
+                md_file,
+                block,
+                opts,
+                is_buffered,
+            )
+        else:
+            run_fn = ft.partial(
+                _run_cached_session,
+                md_file,
+                block,
+                opts,
+                cache_dir,
+                is_buffered,
+                fork_servers,
+                reused,
+            )
+        graph.add(key, run_fn, deps)
+
+    return graph
+
+
+def _iter_updated_elements(
+    orig_md_file: MarkdownFile,
+    md_file     : MarkdownFile,
+    file_idx    : int,
+    captures    : typ.Dict[SessionKey, Capture],
+) -> typ.Iterable[MarkdownElement]:
+    # NOTE: An lp_out block without a command uses the
+    #   capture of the closest previous session block, which
+    #   may be the lp_out block itself.
+    #
+    #   Only the output is taken from the build. The header
+    #   is taken from the original element, so that constants
+    #   (see _expand_constants) are written back unexpanded.
+    prev_capture: typ.Optional[Capture] = None
+
+    for block in _iter_session_blocks(md_file):
+        opts = _parse_session_block_options(block)
+        if opts is None:
+            continue
+
+        if opts.command:
+            prev_capture = captures[file_idx, block.elem_index]
+
+        if not opts.out:
+            continue
+
+        if prev_capture is None:
+            output = "<invalid no output captured>\n"
+        else:
+            output       = _parse_capture_output(prev_capture, opts)
+            prev_capture = None
+
+        elem = orig_md_file.elements[block.elem_index]
+        assert elem.md_type == 'block'
+
+        header_lines = [
+            line
+            for line in elem.content.splitlines(opts.keepends)
+            if line.startswith("```") or line.startswith("# lp_")
+        ]
+
+        last_line   = header_lines.pop()
+        new_content = "".join(header_lines) + output + last_line
+
+        if elem.content != new_content:
+            yield MarkdownElement(
+                elem.md_path, elem.elem_index, elem.md_type, new_content, elem.first_line, None
+            )
+
+
+def _write_back_file(
+    session_graph: litprog.sched.Graph,
+    orig_ctx     : Context,
+    build_ctx    : Context,
+    doc_ctx      : Context,
+    file_idx     : int,
+) -> None:
+    orig_md_file = orig_ctx.files[file_idx]
+    md_file      = build_ctx.files[file_idx]
+    captures     = session_graph.results
+
+    updated_elements = list(_iter_updated_elements(orig_md_file, md_file, file_idx, captures))
+    if not any(updated_elements):
+        return
+
+    with _OUTPUT_LOCK, litprog.tracing.span("write_back", path=md_file.md_path):
+        new_elements = list(orig_md_file.elements)
+        for elem in updated_elements:
+            orig_elem = orig_md_file.elements[elem.elem_index]
+            assert "lp_out" in orig_elem.content
+            new_elements[elem.elem_index] = elem
+
+        new_md_file      = MarkdownFile(md_file.md_path, new_elements)
+        new_file_content = str(new_md_file)
+        _replace_file(new_md_file.md_path, new_file_content)
+        log.info(f"Updated {new_md_file.md_path}")
+        doc_ctx.files[file_idx] = new_md_file
+
+
+def _init_build_ctx(orig_ctx: Context) -> Context:
     build_ctx = orig_ctx.copy()
 
-    # TODO: mark build as running
-    build_start = time.time()
     # pass 1: expand constants
-
-    build_ctx      = _expand_constants(build_ctx)
-    expanded_files = list(_iter_expanded_files(build_ctx.files))
-    build_ctx      = Context(expanded_files)
+    with litprog.tracing.span("expand_constants"):
+        build_ctx = _expand_constants(build_ctx)
+    with litprog.tracing.span("expand_add_directives"):
+        expanded_files = list(_iter_expanded_files(build_ctx.files))
+        build_ctx      = Context(expanded_files)
 
     # phase 3. validate blocks
-    error_messages = list(_iter_block_errors(orig_ctx, build_ctx))
+    with litprog.tracing.span("validate"):
+        error_messages = list(_iter_block_errors(orig_ctx, build_ctx))
     for error_msg in error_messages:
         log.error(error_msg)
 
     if error_messages:
         sys.exit(1)
 
+    return build_ctx
+
+
+def build(
+    orig_ctx           : Context,
+    jobs               : int = 1,
+    cache_dir          : typ.Optional[pl.Path] = None,
+    fork_server_preload: typ.Optional[typ.Sequence[str]] = None,
+) -> Context:
+    """Expand, write files, run sessions and update lp_out blocks.
+
+    If fork_server_preload is not None, sessions with a plain
+    python command (e.g. "lp_run: python3") are forked from a
+    server which has imported these modules already (see
+    litprog.forkserver).
+    """
+    # TODO: Immutable datastructures
+    #   Context, MarkdownFile
+
+    # TODO: mark build as running
+    build_start = time.time()
+    build_ctx   = _init_build_ctx(orig_ctx)
+
     # phase 4. write files with expanded blocks
     #   This has to happen before sub-processes, as those
     #   may use the newly created files.
-    _dump_files(build_ctx)
+    with litprog.tracing.span("dump_files"):
+        _dump_files(build_ctx)
 
-    # TODO: Dependency graph of some kind so we can order
-    #   process execution.
     doc_ctx = orig_ctx.copy()
 
     # phase 5. run sub-processes
-    for file_idx, (orig_md_file, md_file) in enumerate(zip(orig_ctx.files, build_ctx.files)):
-        captures_by_elem_index: typ.Dict[int, Capture] = {}
-        updated_elements      : typ.List[MarkdownElement] = []
+    if jobs <= 0:
+        jobs = os.cpu_count() or 1
 
-        prev_capture_index = -1
+    fork_servers: ForkServers = None
+    if fork_server_preload is not None:
+        if litprog.forkserver.IS_FORK_SERVER_AVAILABLE:
+            fork_servers = litprog.forkserver.ForkServerPool(fork_server_preload)
+        else:
+            log.warning("Fork server is not available on this platform.")
+
+    reused: typ.List[Block] = []
+
+    persistent_sessions = PersistentSessions()
+    session_graph       = _init_session_graph(
+        build_ctx,
+        cache_dir,
+        is_buffered=jobs > 1,
+        fork_servers=fork_servers,
+        persistent_sessions=persistent_sessions,
+        reused=reused,
+    )
 
-        for block in md_file.blocks:
-            opts = _parse_session_block_options(block)
-            if opts is None:
+    # phase 6. rewrite output blocks
+    #   Each file is updated as soon as its sessions have
+    #   completed, while sessions of other files still run.
+    #   The write back of a file is added directly after its
+    #   sessions, so that (with jobs=1) it runs before the
+    #   sessions of the next file, just as if files were
+    #   processed one after another.
+    tasks_by_file: typ.Dict[int, typ.List[litprog.sched.Task]] = collections.defaultdict(list)
+    for key, task in session_graph.tasks.items():
+        file_idx, _ = key
+        tasks_by_file[file_idx].append(task)
+
+    build_graph = litprog.sched.Graph()
+    for file_idx, md_file in enumerate(build_ctx.files):
+        file_tasks = tasks_by_file[file_idx]
+        for task in file_tasks:
+            build_graph.add(task.key, task.func, task.deps)
+
+        if any(_iter_session_blocks(md_file)):
+            write_back_fn = ft.partial(
+                _write_back_file, build_graph, orig_ctx, build_ctx, doc_ctx, file_idx
+            )
+            file_keys = [task.key for task in file_tasks]
+            build_graph.add(('write_back', file_idx), write_back_fn, file_keys)
+
+    try:
+        with litprog.tracing.span("sessions", jobs=jobs):
+            build_graph.run(jobs=jobs)
+    finally:
+        persistent_sessions.close()
+        if fork_servers:
+            fork_servers.close()
+
+    if reused:
+        # NOTE: A session may depend on files that it does not
+        #   declare (see _iter_capture_dep_paths), in which case
+        #   its cached output is stale.
+        log.warning(
+            f"Reused the cached output of {len(reused)} sessions from '{cache_dir}'. "
+            "Use --no-cache to run all sessions."
+        )
+
+    if cache_dir:
+        _mark_sessions_done(build_ctx, cache_dir)
+
+    return doc_ctx
+
+
+# NOTE: The index records the dependencies of
+#   each target of a build, so that a plan can report why a
+#   target is stale. Whether a session is stale is decided
+#   by the capture cache, the index only provides the reason.
+
+INDEX_FILENAME = "index.json"
+
+
+def _open_index(cache_dir: pl.Path) -> litprog.index.Index:
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    return litprog.index.Index(cache_dir / INDEX_FILENAME)
+
+
+def _session_target(md_file: MarkdownFile, block: Block) -> litprog.index.Target:
+    return f"session:{md_file.md_path}:{block.elem_index}"
+
+
+def _session_name(md_file: MarkdownFile, elem_index: int) -> str:
+    first_line = md_file.elements[elem_index].first_line
+    return f"{md_file.md_path}:{first_line}"
+
+
+def _session_deps(
+    md_file: MarkdownFile, block: Block, opts: SessionBlockOptions
+) -> typ.Set[pl.Path]:
+    return {pl.Path(path_str) for path_str in _iter_capture_dep_paths(md_file, block, opts)}
+
+
+def _mark_sessions_done(build_ctx: Context, cache_dir: pl.Path) -> None:
+    index = _open_index(cache_dir)
+    for (file_idx, _), block, opts in _iter_sessions(build_ctx):
+        md_file = build_ctx.files[file_idx]
+        if _is_cacheable_session(block):
+            deps = _session_deps(md_file, block, opts)
+            index.mark_target_done(_session_target(md_file, block), deps)
+    index.dump_index()
+
+
+class DocTarget(typ.NamedTuple):
+    kind: str  # 'html' or 'pdf'
+    path: pl.Path
+
+
+def _iter_doc_targets(
+    ctx        : Context,
+    html_dir   : typ.Optional[pl.Path],
+    pdf_dir    : typ.Optional[pl.Path],
+    pdf_formats: typ.Sequence[str],
+) -> typ.Iterable[DocTarget]:
+    if html_dir:
+        for md_file in ctx.files:
+            # NOTE: gen_html doesn't write a page for an empty file
+            if str(md_file).strip():
+                yield DocTarget('html', html_dir / (md_file.md_path.stem + ".html"))
+    if pdf_dir:
+        for fmt in pdf_formats:
+            yield DocTarget('pdf', pdf_dir / (fmt + ".pdf"))
+
+
+def _doc_deps(ctx: Context) -> typ.Set[pl.Path]:
+    # NOTE: Every page has the toc of all files, so every
+    #   output depends on every markdown file.
+    return {md_file.md_path for md_file in ctx.files}
+
+
+def mark_docs_done(
+    doc_ctx    : Context,
+    cache_dir  : pl.Path,
+    html_dir   : typ.Optional[pl.Path] = None,
+    pdf_dir    : typ.Optional[pl.Path] = None,
+    pdf_formats: typ.Sequence[str] = (),
+) -> None:
+    """Record the dependencies of generated html pages and pdfs.
+
+    This should be called after gen_docs.gen_html and
+    gen_docs.gen_pdf, so that a later plan() can tell if
+    they are stale.
+    """
+    index = _open_index(cache_dir)
+    deps  = _doc_deps(doc_ctx)
+    for target in _iter_doc_targets(doc_ctx, html_dir, pdf_dir, pdf_formats):
+        if target.path.exists():
+            index.mark_target_done(f"{target.kind}:{target.path}", deps)
+    index.dump_index()
+
+
+class StaleTarget(typ.NamedTuple):
+    kind  : str  # 'lp_file', 'session', 'html' or 'pdf'
+    target: str
+    reason: str
+    # Sessions with an lp_make or lp_session directive run with
+    # every build. They are listed, but they are not out of date.
+    is_always_run: bool = False
+
+
+def _index_stale_reason(
+    index: typ.Optional[litprog.index.Index], target: litprog.index.Target, deps: typ.Set[pl.Path]
+) -> typ.Optional[str]:
+    if index is None or target not in index.targets:
+        return "new target"
+
+    if index.is_target_done(target, deps):
+        return None
+
+    if {litprog.index.key(dep) for dep in deps} != index.targets[target]:
+        return "dependencies changed"
+
+    for dep in sorted(deps):
+        if not dep.exists():
+            return f"missing dependency {dep}"
+        if not index.check_path(dep).ok:
+            return f"changed dependency {dep}"
+
+    return "dependencies changed"
+
+
+def _iter_stale_sessions(
+    build_ctx    : Context,
+    cache_dir    : typ.Optional[pl.Path],
+    index        : typ.Optional[litprog.index.Index],
+    file_contents: typ.Dict[str, bytes],
+    stale_files  : typ.Set[str],
+) -> typ.Iterable[typ.Tuple[SessionKey, StaleTarget]]:
+    for key, block, opts in _iter_sessions(build_ctx):
+        file_idx, _ = key
+        md_file     = build_ctx.files[file_idx]
+
+        name = _session_name(md_file, block.elem_index)
+
+        reason: typ.Optional[str]
+        if cache_dir is None:
+            reason = "capture cache disabled"
+        elif opts.session:
+            reason = f"lp_session {opts.session} (always runs)"
+            yield key, StaleTarget('session', name, reason, is_always_run=True)
+            continue
+        elif not _is_cacheable_session(block):
+            reason = "lp_make session (always runs)"
+            yield key, StaleTarget('session', name, reason, is_always_run=True)
+            continue
+        else:
+            cache_path = _capture_cache_path(md_file, block, opts, cache_dir, file_contents)
+            if cache_path.exists():
                 continue
 
-            if opts.command:
-                log.info(f"  lp_run {opts.command}")
+            dep_paths     = set(_iter_capture_dep_paths(md_file, block, opts))
+            changed_files = sorted(dep_paths & stale_files)
+            if changed_files:
+                reason = f"depends on lp_file {changed_files[0]}"
+            else:
+                deps   = _session_deps(md_file, block, opts)
+                target = _session_target(md_file, block)
+                reason = _index_stale_reason(index, target, deps) or "block changed"
+
+        yield key, StaleTarget('session', name, reason)
+
+
+def _iter_stale_files(
+    build_ctx: Context, file_contents: typ.Dict[str, bytes]
+) -> typ.Iterable[StaleTarget]:
+    """Stale lp_file targets, file_contents is filled by normalized path."""
+    for path, content in _lp_file_contents(build_ctx).items():
+        path_str = os.path.normpath(str(path))
+        data     = content.encode("utf-8")
+        file_contents[path_str] = data
+        if not path.exists():
+            yield StaleTarget('lp_file', str(path), "missing output")
+        elif not _is_file_unchanged(path, data):
+            yield StaleTarget('lp_file', str(path), "content changed")
+
+
+def _stale_dep_session(
+    task: litprog.sched.Task, stale_sessions: typ.Dict[SessionKey, StaleTarget]
+) -> typ.Optional[StaleTarget]:
+    for dep in sorted(task.deps):
+        stale = stale_sessions.get(dep)
+        if stale and not stale.is_always_run:
+            return stale
+    return None
 
-                isession = litprog.session.InteractiveSession(opts.command)
 
-                if opts.is_stdin_writable:
-                    stdin_lines = block.inner_content.splitlines(opts.keepends)
-                else:
-                    stdin_lines = []
-
-                try:
-                    for line in stdin_lines:
-                        if opts.is_debug:
-                            sys.stderr.write(opts.debug_prefix + line.rstrip() + "\n")
-                        isession.send(line, delay=opts.input_delay)
-                    exit_status = isession.wait(timeout=opts.timeout)
-                except Exception:
-                    log.error(f"Error processing '{opts.command}'")
-                    sys.stdout.write("".join(isession.iter_stdout()))
-                    sys.stderr.write("".join(isession.iter_stderr()))
-                    raise
-
-                runtime_ms = isession.runtime * 1000
-                log.info(f"  lp_run  exit: {exit_status}  time: {runtime_ms:9.3f}ms")
-
-                lines = list(isession.iter_lines())
-
-                # TODO: limit output using lp_max_bytes and lp_max_lines
-                # TODO: output escaping/fence style change and errors
-
-                prev_capture_index = block.elem_index
-                captures_by_elem_index[prev_capture_index] = Capture(
-                    opts.command, exit_status, isession.runtime, lines
+def _add_stale_dep_sessions(
+    build_ctx     : Context,
+    session_graph : litprog.sched.Graph,
+    stale_sessions: typ.Dict[SessionKey, StaleTarget],
+) -> None:
+    # NOTE: A session that depends on a stale session is stale,
+    #   even if its capture is cached, since its inputs will
+    #   change once the other session has run. A session that
+    #   always runs is expected to produce the same inputs.
+    is_changed = True
+    while is_changed:
+        is_changed = False
+        for key, task in session_graph.tasks.items():
+            if key in stale_sessions:
+                continue
+            stale_dep = _stale_dep_session(task, stale_sessions)
+            if stale_dep:
+                file_idx, elem_index = key
+                name = _session_name(build_ctx.files[file_idx], elem_index)
+                stale_sessions[key] = StaleTarget(
+                    'session', name, f"depends on {stale_dep.target}"
                 )
+                is_changed = True
+
+
+def _iter_stale_docs(
+    orig_ctx         : Context,
+    index            : typ.Optional[litprog.index.Index],
+    has_stale_session: bool,
+    html_dir         : typ.Optional[pl.Path],
+    pdf_dir          : typ.Optional[pl.Path],
+    pdf_formats      : typ.Sequence[str],
+) -> typ.Iterable[StaleTarget]:
+    doc_deps = _doc_deps(orig_ctx)
+    for doc_target in _iter_doc_targets(orig_ctx, html_dir, pdf_dir, pdf_formats):
+        target = f"{doc_target.kind}:{doc_target.path}"
+        reason: typ.Optional[str]
+        if not doc_target.path.exists():
+            reason = "missing output"
+        elif has_stale_session:
+            reason = "sessions may update markdown files"
+        else:
+            reason = _index_stale_reason(index, target, doc_deps)
 
-            if opts.out:
-                if prev_capture_index < 0:
-                    output = "<invalid no output captured>\n"
-                else:
-                    # NOTE: The capture may be the same as the elem_index
-                    #   of the current block.
-                    capture            = captures_by_elem_index[prev_capture_index]
-                    prev_capture_index = -1
-                    output             = _parse_capture_output(capture, opts)
-
-                elem = md_file.elements[block.elem_index]
-                assert elem.md_type == 'block'
-
-                header_lines = [
-                    line
-                    for line in elem.content.splitlines(opts.keepends)
-                    if line.startswith("```") or line.startswith("# lp_")
-                ]
-
-                last_line   = header_lines.pop()
-                new_content = "".join(header_lines) + output + last_line
-
-                if elem.content != new_content:
-                    updated_elem = MarkdownElement(
-                        elem.md_path,
-                        elem.elem_index,
-                        elem.md_type,
-                        new_content,
-                        elem.first_line,
-                        None,
-                    )
-                    updated_elements.append(updated_elem)
-
-        # phase 6. rewrite output blocks
-        if not any(updated_elements):
-            continue
+        if reason:
+            yield StaleTarget(doc_target.kind, str(doc_target.path), reason)
 
-        new_elements = list(orig_md_file.elements)
-        for elem in updated_elements:
-            orig_elem = orig_md_file.elements[elem.elem_index]
-            assert "lp_out" in orig_elem.content
-            new_elements[elem.elem_index] = elem
 
-        new_md_file      = MarkdownFile(md_file.md_path, new_elements)
-        new_file_content = str(new_md_file)
-        with new_md_file.md_path.open(mode="w", encoding="utf-8") as fh:
-            fh.write(new_file_content)
-        log.info(f"Updated {new_md_file.md_path}")
-        doc_ctx.files[file_idx] = new_md_file
+def plan(
+    orig_ctx   : Context,
+    cache_dir  : typ.Optional[pl.Path] = None,
+    html_dir   : typ.Optional[pl.Path] = None,
+    pdf_dir    : typ.Optional[pl.Path] = None,
+    pdf_formats: typ.Sequence[str] = (),
+) -> typ.List[StaleTarget]:
+    """Determine what a build would do, without doing it.
 
-    return doc_ctx
+    No files are written and no sessions are run. The stale
+    targets are returned in the order they would be built.
+    Sessions that run with every build are included with
+    is_always_run=True.
+    """
+    build_ctx = _init_build_ctx(orig_ctx)
+
+    # NOTE: The index is opened read-only, so that a plan
+    #   doesn't change the timestamp of the index file.
+    index: typ.Optional[litprog.index.Index] = None
+    if cache_dir and (cache_dir / INDEX_FILENAME).exists():
+        index = litprog.index.Index(cache_dir / INDEX_FILENAME, is_readonly=True)
+
+    file_contents: typ.Dict[str, bytes] = {}
+
+    stale       = list(_iter_stale_files(build_ctx, file_contents))
+    stale_files = {os.path.normpath(stale_file.target) for stale_file in stale}
+
+    stale_sessions = dict(
+        _iter_stale_sessions(build_ctx, cache_dir, index, file_contents, stale_files)
+    )
+    session_graph = _init_session_graph(build_ctx, cache_dir)
+    _add_stale_dep_sessions(build_ctx, session_graph, stale_sessions)
+    stale.extend(stale_sessions[key] for key in session_graph.tasks if key in stale_sessions)
+
+    has_stale_session = bool(stale_sessions)
+    stale.extend(
+        _iter_stale_docs(orig_ctx, index, has_stale_session, html_dir, pdf_dir, pdf_formats)
+    )
+    return stale
@@ -16,6 +16,7 @@ import logging
 import os.path
 import datetime as dt
 import operator as op
+import fnmatch
 import tempfile
 import functools as ft
 import itertools as it
@@ -26,6 +27,7 @@ import pathlib2 as pl
 
 import litprog.build
 import litprog.parse
+import litprog.tracing
 
 log = logging.getLogger(__name__)
 
@@ -92,25 +94,208 @@ def cli(verbose: int = 0) -> None:
 _in_path_arg = click.Path(readable=True)
 _out_dir_arg = click.Path(file_okay=False, writable=True)
 
+jobs_option = click.option(
+    '-j',
+    '--jobs',
+    default=1,
+    type=int,
+    show_default=True,
+    help="Number of parallel jobs. 0 to use one job per cpu.",
+)
+
+DEFAULT_CACHE_DIR = ".litprog.cache"
+
+no_cache_option = click.option(
+    '--no-cache', is_flag=True, default=False, help=f"Don't use or update '{DEFAULT_CACHE_DIR}'."
+)
+
+ignore_option = click.option(
+    '--ignore',
+    'ignore_patterns',
+    multiple=True,
+    metavar="<pattern>",
+    help="Skip directories with a matching name when scanning for markdown files.",
+)
+
 
 @cli.command()
 @click.argument('input_paths', nargs=-1, type=_in_path_arg)
 @click.option('--html', nargs=1, type=_out_dir_arg)
 @click.option('--pdf' , nargs=1, type=_out_dir_arg)
+@jobs_option
+@no_cache_option
+@ignore_option
+@click.option(
+    '--mmap',
+    'use_mmap',
+    is_flag=True,
+    default=False,
+    help="Memory map input files and only decode content as needed.",
+)
+@click.option(
+    '--fork-server',
+    is_flag=True,
+    default=False,
+    help=(
+        "Fork sessions of python (e.g. 'lp_run: python3') from a server process,"
+        " instead of starting a new interpreter for each block."
+    ),
+)
+@click.option(
+    '--preload',
+    'preload_modules',
+    multiple=True,
+    metavar="<module>",
+    help="Module to import in the fork server before sessions are forked (implies --fork-server).",
+)
+@click.option(
+    '--plan',
+    'is_plan',
+    is_flag=True,
+    default=False,
+    help=(
+        "Only list the outputs that are out of date and why, without building them. "
+        "Exits with status 1 if anything is out of date. Sessions which run with "
+        "every build (lp_make, lp_session) are listed, but don't count as out of date."
+    ),
+)
+@click.option(
+    '--profile-trace',
+    'profile_trace',
+    type=click.Path(dir_okay=False, writable=True),
+    metavar="<path>",
+    help="Write timings of the build phases to a Chrome trace file (see chrome://tracing).",
+)
 @verbosity_option
 def build(
-    input_paths: InputPaths, html: typ.Optional[str], pdf: typ.Optional[str], verbose: int = 0
+    input_paths    : InputPaths,
+    html           : typ.Optional[str],
+    pdf            : typ.Optional[str],
+    jobs           : int               = 1,
+    no_cache       : bool              = False,
+    ignore_patterns: typ.Sequence[str] = (),
+    use_mmap       : bool              = False,
+    fork_server    : bool              = False,
+    preload_modules: typ.Sequence[str] = (),
+    is_plan        : bool              = False,
+    profile_trace  : typ.Optional[str] = None,
+    verbose        : int               = 0,
 ) -> None:
     _configure_logging(verbose)
+
+    fork_server_preload: typ.Optional[typ.List[str]]
+    if fork_server or preload_modules:
+        fork_server_preload = list(preload_modules)
+    else:
+        fork_server_preload = None
+
+    build_args = (
+        input_paths,
+        html,
+        pdf,
+        jobs,
+        no_cache,
+        ignore_patterns,
+        use_mmap,
+        fork_server_preload,
+        is_plan,
+    )
+    if profile_trace is None:
+        _build(*build_args)
+        return
+
+    litprog.tracing.start()
+    try:
+        with litprog.tracing.span("litprog build"):
+            _build(*build_args)
+    finally:
+        litprog.tracing.stop(pl.Path(profile_trace))
+
+
+PDF_FORMATS = [
+    'print_letter',
+    'print_halfletter',
+    'print_booklet_letter',
+    'print_twocol_letter',
+    'print_a4',
+    'print_a5',
+    'print_booklet_a4',
+    'print_twocol_a4',
+    'print_ereader',
+]
+
+
+def _plan(
+    ctx      : litprog.parse.Context,
+    html     : typ.Optional[str],
+    pdf      : typ.Optional[str],
+    cache_dir: typ.Optional[pl.Path],
+) -> None:
+    stale_targets = litprog.build.plan(
+        ctx,
+        cache_dir=cache_dir,
+        html_dir=pl.Path(html) if html else None,
+        pdf_dir=pl.Path(pdf) if pdf else None,
+        pdf_formats=PDF_FORMATS,
+    )
+    if not stale_targets:
+        click.echo("Everything is up to date.")
+        return
+
+    for stale in stale_targets:
+        click.echo(f"{stale.kind:<8} {stale.target}  ({stale.reason})")
+
+    if all(stale.is_always_run for stale in stale_targets):
+        click.echo("Everything else is up to date.")
+    else:
+        sys.exit(1)
+
+
+def _build(
+    input_paths        : InputPaths,
+    html               : typ.Optional[str],
+    pdf                : typ.Optional[str],
+    jobs               : int,
+    no_cache           : bool,
+    ignore_patterns    : typ.Sequence[str],
+    use_mmap           : bool,
+    fork_server_preload: typ.Optional[typ.List[str]],
+    is_plan            : bool,
+) -> None:
     # TODO: figure out how to share this code between sub-commands
-    md_paths = sorted(_iter_markdown_filepaths(input_paths))
+    out_dirs = [out_dir for out_dir in (html, pdf) if out_dir]
+    md_paths = sorted(
+        _iter_markdown_filepaths(
+            input_paths, ignore_patterns=ignore_patterns, exclude_dirs=out_dirs
+        )
+    )
     if len(md_paths) == 0:
         log.error("No markdown files found for {input_paths}.")
         click.secho("No markdown files found", fg='red')
         sys.exit(1)
 
-    ctx       = litprog.parse.parse_context(md_paths)
-    built_ctx = litprog.build.build(ctx)
+    cache_dir: typ.Optional[pl.Path]
+    if no_cache:
+        cache_dir = None
+    else:
+        cache_dir = pl.Path(DEFAULT_CACHE_DIR)
+
+    with litprog.tracing.span("parse", files=len(md_paths)):
+        ctx = litprog.parse.parse_context(
+            md_paths,
+            jobs=jobs,
+            cache_dir=cache_dir,
+            use_mmap=use_mmap,
+            is_cache_readonly=is_plan,
+        )
+    if is_plan:
+        _plan(ctx, html, pdf, cache_dir)
+        return
+
+    with litprog.tracing.span("build"):
+        built_ctx = litprog.build.build(
+            ctx, jobs=jobs, cache_dir=cache_dir, fork_server_preload=fork_server_preload
+        )
 
     if pdf is None and html is None:
         return
@@ -128,24 +313,25 @@ def build(
     html_dir = pl.Path(html)
 
     # lazy import since we don't always need it
-    import litprog.gen_docs
+    # NOTE: "import litprog.gen_docs" would bind "litprog" as
+    #   a local name for the whole function.
+    import litprog.gen_docs as gen_docs
 
-    litprog.gen_docs.gen_html(built_ctx, html_dir)
+    gen_docs.gen_html(built_ctx, html_dir)
 
+    pdf_dir: typ.Optional[pl.Path] = None
     if pdf:
-        pdf_dir          = pl.Path(pdf)
-        selected_formats = [
-            'print_letter',
-            'print_halfletter',
-            'print_booklet_letter',
-            'print_twocol_letter',
-            'print_a4',
-            'print_a5',
-            'print_booklet_a4',
-            'print_twocol_a4',
-            'print_ereader',
-        ]
-        litprog.gen_docs.gen_pdf(built_ctx, html_dir, pdf_dir, formats=selected_formats)
+        pdf_dir = pl.Path(pdf)
+        gen_docs.gen_pdf(built_ctx, html_dir, pdf_dir, formats=PDF_FORMATS)
+
+    if cache_dir:
+        litprog.build.mark_docs_done(
+            built_ctx,
+            cache_dir,
+            html_dir=None if is_html_tmp_dir else html_dir,
+            pdf_dir=pdf_dir,
+            pdf_formats=PDF_FORMATS,
+        )
 
     if is_html_tmp_dir:
         shutil.rmtree(html_dir)
@@ -165,15 +351,68 @@ MARKDOWN_FILE_EXTENSIONS = {
 }
 
 
-def _iter_markdown_filepaths(input_paths: InputPaths) -> FilePaths:
+DEFAULT_IGNORE_PATTERNS = [".git", ".hg", ".svn", DEFAULT_CACHE_DIR]
+
+
+def _is_markdown_filename(name: str) -> bool:
+    _, dot, ext = name.rpartition(".")
+    return bool(dot) and ext in MARKDOWN_FILE_EXTENSIONS
+
+
+def _is_ignored_dir(
+    entry: os.DirEntry, ignore_patterns: typ.Sequence[str], exclude_real: typ.Set[str]
+) -> bool:
+    if any(fnmatch.fnmatch(entry.name, pattern) for pattern in ignore_patterns):
+        return True
+    return bool(exclude_real) and os.path.realpath(entry.path) in exclude_real
+
+
+def _iter_dir_markdown_filepaths(
+    dirpath: str, ignore_patterns: typ.Sequence[str], exclude_real: typ.Set[str]
+) -> typ.Iterable[str]:
+    stack = [dirpath]
+    while stack:
+        dirpath = stack.pop()
+        try:
+            entries = list(os.scandir(dirpath))
+        except OSError as ex:
+            log.warning(f"Could not scan directory {dirpath}: {ex}")
+            continue
+
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if not _is_ignored_dir(entry, ignore_patterns, exclude_real):
+                    stack.append(entry.path)
+            elif _is_markdown_filename(entry.name) and entry.is_file():
+                yield entry.path
+
+
+def _iter_markdown_filepaths(
+    input_paths    : InputPaths,
+    ignore_patterns: typ.Sequence[str] = (),
+    exclude_dirs   : typ.Sequence[str] = (),
+) -> FilePaths:
+    # NOTE: A single walk over each input directory,
+    #   rather than one glob per extension. Directories are pruned by
+    #   name (fnmatch patterns) or by their resolved path (for output
+    #   directories which may be inside of an input directory).
+    #   Symlinked directories are not followed, to avoid cycles.
+    patterns     = list(DEFAULT_IGNORE_PATTERNS) + list(ignore_patterns)
+    exclude_real = {os.path.realpath(dirpath) for dirpath in exclude_dirs}
+
+    seen: typ.Set[str] = set()
     for path_str in input_paths:
-        path = pl.Path(path_str)
-        if path.is_file():
-            yield path
+        fpaths: typ.Iterable[str]
+        if os.path.isfile(path_str):
+            fpaths = [path_str]
         else:
-            for ext in MARKDOWN_FILE_EXTENSIONS:
-                for fpath in path.glob(f"**/*.{ext}"):
-                    yield fpath
+            fpaths = _iter_dir_markdown_filepaths(path_str, patterns, exclude_real)
+
+        for fpath in fpaths:
+            real_fpath = os.path.realpath(fpath)
+            if real_fpath not in seen:
+                seen.add(real_fpath)
+                yield pl.Path(fpath)
 
 
 if __name__ == '__main__':
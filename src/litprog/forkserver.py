@@ -0,0 +1,382 @@
+# This file is part of the litprog project
+# https://gitlab.com/mbarkhau/litprog
+#
+# Copyright (c) 2020 Manuel Barkhau (mbarkhau@gmail.com) - MIT License
+# SPDX-License-Identifier: MIT
+"""Run python sessions as forks of a long lived process.
+
+A session with the command "python3" pays for the startup of the
+interpreter and for the imports of the script. A fork server is
+started once (per interpreter), imports a list of modules and
+then forks a worker for each session. The worker reads the
+script from its stdin and executes it, just as "python3" would.
+
+    server            the long lived process, which accepts
+                      connections on a unix socket
+    monitor           forked by the server for each connection,
+                      reports the pid and exit status of the worker
+    worker            forked by the monitor, executes the script
+
+The pipes for stdin, stdout and stderr of the worker are created
+by the client and sent to the server with the connection, so
+the output of a worker is captured just like that of any other
+process (see litprog.session.InteractiveSession).
+"""
+import os
+import re
+import array
+import shlex
+import shutil
+import signal
+import socket
+import typing as typ
+import logging
+import tempfile
+import threading
+import subprocess as sp
+
+import pathlib2 as pl
+
+log = logging.getLogger(__name__)
+
+
+IS_FORK_SERVER_AVAILABLE = hasattr(os, 'fork') and hasattr(socket, 'AF_UNIX')
+
+
+# NOTE: The server runs with the interpreter of
+#   the session (which may not have litprog installed), so its
+#   code is passed as a string with "python -c".
+
+SERVER_SRC = r'''
+import os
+import sys
+import array
+import types
+import atexit
+import signal
+import socket
+import builtins
+import importlib
+import traceback
+
+
+def _recv_fds(conn):
+    fds = array.array("i")
+    msg, ancdata, _, _ = conn.recvmsg(64, socket.CMSG_SPACE(3 * fds.itemsize))
+    for level, type_, data in ancdata:
+        if level == socket.SOL_SOCKET and type_ == socket.SCM_RIGHTS:
+            fds.frombytes(data[: len(data) - (len(data) % fds.itemsize)])
+    return msg, list(fds)
+
+
+def _run_worker(fds):
+    for target_fd, fd in zip((0, 1, 2), fds):
+        os.dup2(fd, target_fd)
+        os.close(fd)
+
+    sys.argv = [""]
+    main_module = types.ModuleType("__main__")
+    main_module.__dict__["__builtins__"] = builtins
+    sys.modules["__main__"] = main_module
+
+    exit_code = 0
+    try:
+        source = sys.stdin.read()
+        exec(compile(source, "<stdin>", "exec"), main_module.__dict__)
+    except SystemExit as ex:
+        if ex.code is None:
+            exit_code = 0
+        elif isinstance(ex.code, int):
+            exit_code = ex.code
+        else:
+            sys.stderr.write(str(ex.code) + "\n")
+            exit_code = 1
+    except BaseException as ex:
+        # skip the frame of _run_worker
+        traceback.print_exception(type(ex), ex, ex.__traceback__.tb_next)
+        exit_code = 1
+
+    try:
+        atexit._run_exitfuncs()
+    except BaseException:
+        pass
+
+    for stream in (sys.stdout, sys.stderr):
+        try:
+            stream.flush()
+        except BaseException:
+            pass
+    os._exit(exit_code)
+
+
+def _run_monitor(conn, fds):
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    pid = os.fork()
+    if pid == 0:
+        conn.close()
+        _run_worker(fds)
+
+    for fd in fds:
+        os.close(fd)
+    conn.sendall(("%d\n" % pid).encode("ascii"))
+    _, status = os.waitpid(pid, 0)
+    conn.sendall(("%d\n" % status).encode("ascii"))
+    os._exit(0)
+
+
+def main(sock_path, modules):
+    for module_name in modules:
+        importlib.import_module(module_name)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(sock_path)
+    server.listen(64)
+
+    # monitors are reaped automatically
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+
+    sys.stdout.write("ready\n")
+    sys.stdout.flush()
+    devnull = os.open(os.devnull, os.O_RDWR)
+    os.dup2(devnull, 1)
+    os.dup2(devnull, 2)
+
+    while True:
+        conn, _ = server.accept()
+        msg, fds = _recv_fds(conn)
+        if msg != b"run" or len(fds) != 3:
+            conn.close()
+            for fd in fds:
+                os.close(fd)
+            continue
+
+        if os.fork() == 0:
+            server.close()
+            _run_monitor(conn, fds)
+
+        for fd in fds:
+            os.close(fd)
+        conn.close()
+
+
+main(sys.argv[1], sys.argv[2:])
+'''
+
+
+class ForkServerError(Exception):
+    pass
+
+
+def _send_fds(conn: socket.socket, msg: bytes, fds: typ.List[int]) -> None:
+    fd_data = array.array("i", fds).tobytes()
+    conn.sendmsg([msg], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fd_data)])
+
+
+def _exit_code(status: int) -> int:
+    # same as the returncode of a subprocess.Popen
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    else:
+        return os.WEXITSTATUS(status)
+
+
+class ForkedProcess:
+    """A worker of a ForkServer.
+
+    Implements the parts of the subprocess.Popen interface
+    that are used by InteractiveSession.
+    """
+
+    pid       : int
+    stdin     : typ.IO[bytes]
+    stdout    : typ.IO[bytes]
+    stderr    : typ.IO[bytes]
+    returncode: typ.Optional[int]
+
+    _conn: socket.socket
+    _buf : bytes
+
+    def __init__(
+        self,
+        conn  : socket.socket,
+        stdin : typ.IO[bytes],
+        stdout: typ.IO[bytes],
+        stderr: typ.IO[bytes],
+    ) -> None:
+        self._conn      = conn
+        self._buf       = b""
+        self.stdin      = stdin
+        self.stdout     = stdout
+        self.stderr     = stderr
+        self.returncode = None
+
+        pid_line = self._recv_line(timeout=None)
+        if pid_line is None:
+            raise ForkServerError("Fork server did not start worker")
+        self.pid = int(pid_line)
+
+    def _recv_line(self, timeout: typ.Optional[float]) -> typ.Optional[bytes]:
+        while b"\n" not in self._buf:
+            self._conn.settimeout(timeout)
+            try:
+                data = self._conn.recv(64)
+            except socket.timeout:
+                return None
+
+            if not data:
+                raise ForkServerError("Connection to fork server closed")
+            self._buf += data
+
+        line, _, self._buf = self._buf.partition(b"\n")
+        return line
+
+    def wait(self, timeout: typ.Optional[float] = None) -> int:
+        if self.returncode is not None:
+            return self.returncode
+
+        # NOTE: The monitor writes the status as soon as the
+        #   worker exits, so this blocks on the socket rather
+        #   than polling.
+        status_line = self._recv_line(timeout)
+        if status_line is None:
+            raise sp.TimeoutExpired(["<fork server worker>"], timeout or 0)
+
+        self.returncode = _exit_code(int(status_line))
+        self._conn.close()
+        return self.returncode
+
+    def poll(self) -> typ.Optional[int]:
+        try:
+            return self.wait(timeout=0)
+        except sp.TimeoutExpired:
+            return None
+
+    def terminate(self) -> None:
+        if self.returncode is None:
+            try:
+                os.kill(self.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+
+class ForkServer:
+
+    python_exe: str
+    preload   : typ.List[str]
+    sock_path : str
+
+    _tmp_dir: str
+    _proc   : sp.Popen
+
+    def __init__(self, python_exe: str, preload: typ.Sequence[str] = ()) -> None:
+        self.python_exe = python_exe
+        self.preload    = list(preload)
+        self._tmp_dir   = tempfile.mkdtemp(prefix="litprog_fork_")
+        self.sock_path  = os.path.join(self._tmp_dir, "server.sock")
+
+        log.debug(f"starting fork server for {python_exe} preloading {self.preload}")
+        self._proc = sp.Popen(
+            [python_exe, "-c", SERVER_SRC, self.sock_path] + self.preload,
+            stdin=sp.DEVNULL,
+            stdout=sp.PIPE,
+            stderr=sp.PIPE,
+        )
+        ready_line = self._proc.stdout.readline()
+        if ready_line != b"ready\n":
+            error_output = self._proc.stderr.read().decode("utf-8", errors="replace")
+            self._proc.wait()
+            shutil.rmtree(self._tmp_dir, ignore_errors=True)
+            raise ForkServerError(f"Could not start fork server for {python_exe}: {error_output}")
+
+        self._proc.stdout.close()
+        self._proc.stderr.close()
+
+    def spawn(self) -> ForkedProcess:
+        """Fork a worker, which reads its script from stdin."""
+        stdin_r , stdin_w  = os.pipe()
+        stdout_r, stdout_w = os.pipe()
+        stderr_r, stderr_w = os.pipe()
+
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            conn.connect(self.sock_path)
+            _send_fds(conn, b"run", [stdin_r, stdout_w, stderr_w])
+        except OSError:
+            conn.close()
+            for fd in (stdin_w, stdout_r, stderr_r):
+                os.close(fd)
+            raise
+        finally:
+            # NOTE: These were sent to the worker. If they were
+            #   kept open here, stdout and stderr would never
+            #   reach EOF.
+            for fd in (stdin_r, stdout_w, stderr_w):
+                os.close(fd)
+
+        return ForkedProcess(
+            conn,
+            stdin=os.fdopen(stdin_w, mode="wb"),
+            stdout=os.fdopen(stdout_r, mode="rb"),
+            stderr=os.fdopen(stderr_r, mode="rb"),
+        )
+
+    def close(self) -> None:
+        self._proc.terminate()
+        self._proc.wait()
+        shutil.rmtree(self._tmp_dir, ignore_errors=True)
+
+
+PYTHON_EXE_RE = re.compile(r"^python(\d+(\.\d+)?)?$")
+
+
+def python_exe(command: str) -> typ.Optional[str]:
+    """The interpreter of a command, if it can use a fork server.
+
+    This is the case if the command is only the name of (or path
+    to) a python interpreter, which reads its script from stdin.
+    """
+    try:
+        args = shlex.split(command)
+    except ValueError:
+        return None
+
+    if len(args) != 1 or not PYTHON_EXE_RE.match(pl.Path(args[0]).name):
+        return None
+
+    return shutil.which(args[0])
+
+
+class ForkServerPool:
+    """Fork servers by interpreter, started as they are needed."""
+
+    preload: typ.List[str]
+
+    _lock   : threading.Lock
+    _servers: typ.Dict[str, typ.Optional[ForkServer]]
+
+    def __init__(self, preload: typ.Sequence[str] = ()) -> None:
+        self.preload  = list(preload)
+        self._lock    = threading.Lock()
+        self._servers = {}
+
+    def get(self, command: str) -> typ.Optional[ForkServer]:
+        """The fork server for command, or None if it has none."""
+        exe = python_exe(command)
+        if exe is None:
+            return None
+
+        with self._lock:
+            if exe not in self._servers:
+                try:
+                    self._servers[exe] = ForkServer(exe, self.preload)
+                except ForkServerError as ex:
+                    log.warning(str(ex))
+                    self._servers[exe] = None
+            return self._servers[exe]
+
+    def close(self) -> None:
+        with self._lock:
+            for server in self._servers.values():
+                if server:
+                    server.close()
+            self._servers.clear()
@@ -13,6 +13,7 @@ import jinja2
 import pathlib2 as pl
 
 from . import parse
+from . import tracing
 from . import md2html
 from . import html2pdf
 from . import pdf_booklet
@@ -278,7 +279,8 @@ def gen_html(ctx: parse.Context, html_dir: pl.Path) -> None:
         cur_meta = cur_meta.copy()
         cur_meta.update(new_meta)
 
-        html_res: md2html.HTMLResult = md2html.md2html(md_text)
+        with tracing.span("md2html", path=md_file.md_path):
+            html_res: md2html.HTMLResult = md2html.md2html(md_text)
 
         if html_res.raw_html:
             metas.append(cur_meta)
@@ -290,10 +292,11 @@ def gen_html(ctx: parse.Context, html_dir: pl.Path) -> None:
         html_fname = md_path.stem + ".html"
         html_fpath = html_dir / html_fname
         log.info(f"writing '{md_path}' -> '{html_fpath}'")
-        content_html = html_postproc.postproc4screen(html_res)
-        wrapped_html = wrap_content_html(content_html, 'screen', meta, toc)
-        with html_fpath.open(mode="w") as fobj:
-            fobj.write(wrapped_html)
+        with tracing.span("gen_html", path=md_path):
+            content_html = html_postproc.postproc4screen(html_res)
+            wrapped_html = wrap_content_html(content_html, 'screen', meta, toc)
+            with html_fpath.open(mode="w") as fobj:
+                fobj.write(wrapped_html)
 
     # copy/update static dependencies
     # TODO: copy only ttf for print target
@@ -331,7 +334,9 @@ def gen_pdf(
 
     full_md_text = "\n\n".join(all_md_texts)
 
-    html_res: md2html.HTMLResult = md2html.md2html(full_md_text)
+    with tracing.span("md2html", path="<all>"):
+        html_res: md2html.HTMLResult = md2html.md2html(full_md_text)
+
     multipage_formats = {fmt for fmt in formats if fmt in MULTIPAGE_FORMATS}
     onepage_formats   = set(formats) - set(multipage_formats)
     for fmt in multipage_formats:
@@ -339,19 +344,21 @@ def gen_pdf(
         onepage_formats.add(part_page_fmt)
 
     for fmt in onepage_formats:
-        print_html   = html_postproc.postproc4print(html_res, fmt)
-        wrapped_html = wrap_content_html(print_html, fmt, meta)
-        html_fpath   = pdf_dir / (fmt + ".html")
-        pdf_fpath    = pdf_dir / (fmt + ".pdf")
-        with html_fpath.open(mode="w") as fobj:
-            fobj.write(wrapped_html)
+        with tracing.span("gen_pdf", format=fmt):
+            print_html   = html_postproc.postproc4print(html_res, fmt)
+            wrapped_html = wrap_content_html(print_html, fmt, meta)
+            html_fpath   = pdf_dir / (fmt + ".html")
+            pdf_fpath    = pdf_dir / (fmt + ".pdf")
+            with html_fpath.open(mode="w") as fobj:
+                fobj.write(wrapped_html)
 
-        log.info(f"converting '{html_fpath}' -> '{pdf_fpath}'")
-        html2pdf.html2pdf(wrapped_html, pdf_fpath, html_dir)
+            log.info(f"converting '{html_fpath}' -> '{pdf_fpath}'")
+            html2pdf.html2pdf(wrapped_html, pdf_fpath, html_dir)
 
     for fmt in multipage_formats:
         part_page_fmt       = MULTIPAGE_FORMATS[fmt]
         part_page_pdf_fpath = pdf_dir / (part_page_fmt + ".pdf")
         booklet_pdf_fpath   = pdf_dir / (fmt           + ".pdf")
         log.info(f"creating booklet '{part_page_pdf_fpath}' -> '{booklet_pdf_fpath}'")
-        pdf_booklet.create(in_path=part_page_pdf_fpath, out_path=booklet_pdf_fpath)
+        with tracing.span("gen_pdf", format=fmt):
+            pdf_booklet.create(in_path=part_page_pdf_fpath, out_path=booklet_pdf_fpath)
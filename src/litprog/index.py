@@ -71,7 +71,7 @@ except ValueError as ex:
     IS_BLAKE2_AVAILABLE = False
 
 
-def new_digest() -> hashlib._Hash:
+def new_digest() -> "hashlib._Hash":
     # https://blake2.net/
     if IS_BLAKE2_AVAILABLE:
         return hashlib.new('blake2b')
@@ -193,7 +193,12 @@ class Index:
     entries: EntryByKey
     targets: EntryKeysByTarget
 
-    def __init__(self, index_file: pl.Path) -> None:
+    def __init__(self, index_file: pl.Path, is_readonly: bool = False) -> None:
+        """Load the index_file, if it exists.
+
+        With is_readonly=True, the index_file is not touched (it
+        must exist) and dump_index must not be called.
+        """
         self.index_file = index_file
         self.machine_id = machine_id()
         self.entries    = {}
@@ -206,7 +211,8 @@ class Index:
             warn_msg = f"Ignoring invalid/corrupted index file " f"'{self.index_file}'"
             log.warning(warn_msg, exc_info=True)
 
-        self.index_file.touch()
+        if not is_readonly:
+            self.index_file.touch()
         self.index_stat = mk_stat(self.index_file)
 
     def load_index(self) -> None:
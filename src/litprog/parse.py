@@ -9,8 +9,12 @@ import re
 import sys
 import enum
 import math
+import mmap
+import array
+import bisect
 import time
 import typing as typ
+import pickle
 import logging
 import os.path
 import datetime as dt
@@ -18,9 +22,12 @@ import operator as op
 import functools as ft
 import itertools as it
 import collections
+import concurrent.futures as cf
 
 import pathlib2 as pl
 
+import litprog.index
+
 log = logging.getLogger(__name__)
 
 
@@ -168,7 +175,7 @@ LANGUAGE_COMMENT_TEMPLATES = {
 }
 
 
-def _re(pattern: str) -> typ.Pattern:
+def _re(pattern: typ.AnyStr) -> typ.Pattern:
     return re.compile(pattern, flags=re.VERBOSE | re.MULTILINE)
 
 
@@ -178,6 +185,43 @@ LANGUAGE_COMMENT_REGEXES = {
 }
 
 
+class CommentScanner(typ.NamedTuple):
+
+    anchored_re: typ.Pattern
+    search_re  : typ.Pattern
+
+
+def _comment_scanner_pattern(start_pattern: str, end_pattern: str) -> str:
+    return rf"""
+    (?P<comment_start>{start_pattern})
+    (?P<comment_text>.*?)
+    (?:{end_pattern}|\Z)
+    """
+
+
+def _comment_scanner(start_pattern: str, end_pattern: str) -> CommentScanner:
+    assert start_pattern.startswith("^")
+    flags   = re.VERBOSE | re.MULTILINE | re.DOTALL
+    pattern = _comment_scanner_pattern(start_pattern, end_pattern)
+    # NOTE: The anchored variant is used to match
+    #   directly at the position where the previous comment ended,
+    #   which may be in the middle of a line (where "^" would not
+    #   match).
+    anchored_pattern = _comment_scanner_pattern(start_pattern[1:], end_pattern)
+    return CommentScanner(re.compile(anchored_pattern, flags), re.compile(pattern, flags))
+
+
+# Each comment (including its start and end) is matched
+# by a single regular expression.
+LANGUAGE_COMMENT_SCANNERS = {
+    lang: _comment_scanner(start_pattern, end_pattern)
+    for lang, (start_pattern, end_pattern) in LANGUAGE_COMMENT_PATTERNS.items()
+}
+
+# Enables additional (slow) consistency checks during parsing.
+VERIFY_PARSE = os.environ.get('LITPROG_VERIFY_PARSE') == '1'
+
+
 ELEMENT_RE = _re(ELEMENT_PATTERN)
 
 HEADLINE_RE_A = _re(HEADLINE_PATTERN_A)
@@ -187,11 +231,27 @@ BLOCK_START_RE = _re(BLOCK_START_PATTERN)
 
 BLOCK_END_RE = {"```": _re(r"^```"), "~~~": _re(r"^~~~")}
 
+# Used to scan memory mapped files without decoding them.
+ELEMENT_RE_BYTES   = _re(ELEMENT_PATTERN.encode("ascii"))
+BLOCK_END_RE_BYTES = {b"```": _re(rb"^```"), b"~~~": _re(rb"^~~~")}
+
+NEWLINE_RE       = re.compile("\n")
+NEWLINE_RE_BYTES = re.compile(b"\n")
+
+# A buffer that elements can reference instead of having
+# their own copy of the content (see parse_context(use_mmap=True)).
+ContentBuffer = typ.Union[bytes, mmap.mmap]
+
+# Offsets at which each line starts. The line number (1 based)
+# for an offset is bisect.bisect_right(line_starts, offset).
+LineStarts = array.array
+
 
 class _RawMarkdownElement(typ.NamedTuple):
 
     md_type   : MarkdownElementType
-    content   : str
+    start     : int
+    end       : int
     first_line: int
 
 
@@ -204,12 +264,36 @@ Successor = typ.Optional['MarkdownElement']
 
 class MarkdownElement:
 
+    # NOTE: There are many instances of this
+    #   class (one for each paragraph, headline, block etc.),
+    #   so they are kept compact by not having a __dict__.
+    __slots__ = [
+        'md_path',
+        'elem_index',
+        'md_type',
+        'first_line',
+        '_successor',
+        '_block',
+        '_content',
+        '_buf',
+        '_start',
+        '_end',
+    ]
+
     md_path   : pl.Path
     elem_index: int
     md_type   : MarkdownElementType
-    content   : str
     first_line: int
     _successor: typ.Optional[typ.Any]
+    # memoized result of _parse_block for elements of type 'block'
+    _block: typ.Optional[typ.Any]
+
+    # Either _content is set, or the content is decoded
+    # on demand from _buf[_start:_end].
+    _content: typ.Optional[str]
+    _buf    : typ.Optional[ContentBuffer]
+    _start  : int
+    _end    : int
 
     # Recursive types not fully supported yet;
     # this class can be changed to a NamedTuple once they are.
@@ -231,9 +315,43 @@ class MarkdownElement:
         self.md_path    = md_path
         self.elem_index = elem_index
         self.md_type    = md_type
-        self.content    = content
         self.first_line = first_line
         self._successor = successor
+        self._block     = None
+        self._content   = content
+        self._buf       = None
+        self._start     = 0
+        self._end       = 0
+
+    @staticmethod
+    def from_buffer(
+        md_path   : pl.Path,
+        elem_index: int,
+        md_type   : MarkdownElementType,
+        buf       : ContentBuffer,
+        start     : int,
+        end       : int,
+        first_line: int,
+    ) -> 'MarkdownElement':
+        """Create an element that references its content in buf.
+
+        The content is decoded whenever it is accessed and is
+        not retained by the element.
+        """
+        elem = MarkdownElement(md_path, elem_index, md_type, "", first_line, None)
+        elem._content = None
+        elem._buf     = buf
+        elem._start   = start
+        elem._end     = end
+        return elem
+
+    @property
+    def content(self) -> str:
+        if self._content is None:
+            assert self._buf is not None
+            return self._buf[self._start : self._end].decode("utf-8")
+        else:
+            return self._content
 
     def clone(self) -> 'MarkdownElement':
         return MarkdownElement(
@@ -265,6 +383,9 @@ class Directive(typ.NamedTuple):
     raw_text: str
 
 
+DirectiveIndex = typ.Dict[str, typ.List[Directive]]
+
+
 class Block(typ.NamedTuple):
 
     md_path      : pl.Path
@@ -273,6 +394,18 @@ class Block(typ.NamedTuple):
     directives   : typ.List[Directive]
     content      : str
     inner_content: str
+    # directives by name, in the same order as in directives
+    directive_index: DirectiveIndex
+
+
+def _index_directives(directives: typ.List[Directive]) -> DirectiveIndex:
+    directive_index: DirectiveIndex = {}
+    for directive in directives:
+        if directive.name in directive_index:
+            directive_index[directive.name].append(directive)
+        else:
+            directive_index[directive.name] = [directive]
+    return directive_index
 
 
 VALID_DIRECTIVE_NAMES = {
@@ -294,6 +427,9 @@ VALID_DIRECTIVE_NAMES = {
     'lp_err_prefix',
     'lp_out_color',
     'lp_err_color',
+    'lp_max_lines',
+    'lp_max_bytes',
+    'lp_session',
     # file generation
     'lp_file',
     'lp_deps',
@@ -318,13 +454,152 @@ def _parse_directive(directive_text: str, raw_text: str) -> Directive:
     return Directive(name, value, raw_text)
 
 
+def _parse_headline(md_path: pl.Path, elem_index: int, elem: MarkdownElement) -> Headline:
+    a_match = HEADLINE_RE_A.match(elem.content)
+    b_match = HEADLINE_RE_B.match(elem.content)
+    if a_match:
+        text   = a_match.group('headline_text_a')
+        marker = a_match.group('headline_marker_a')
+        level  = marker.count("#")
+    elif b_match:
+        text   = b_match.group('headline_text_b')
+        marker = b_match.group('headline_marker_b')
+        level  = 1 if "-" in marker else 2
+    else:
+        err_msg = "Invalid headline: {elem.content}"
+        assert False, err_msg
+
+    return Headline(md_path, elem_index, text.strip(), level)
+
+
+def _iter_comments(
+    content: str, pos: int, scanner: CommentScanner
+) -> typ.Iterable[typ.Tuple[str, typ.Optional[typ.Match]]]:
+    """Yield (chunk, comment_match) pairs for content[pos:].
+
+    The chunk is the content between comments and comment_match is
+    None for the final chunk after the last comment.
+    """
+    end_pos = len(content)
+    while pos < end_pos:
+        match = scanner.anchored_re.match(content, pos)
+        if match is None:
+            match = scanner.search_re.search(content, pos)
+        if match is None:
+            yield content[pos:], None
+            break
+
+        yield content[pos : match.start()], match
+        pos = match.end()
+
+
+def _parse_block(md_path: pl.Path, elem_index: int, elem: MarkdownElement) -> Block:
+    content     = elem.content
+    start_match = BLOCK_START_RE.match(content)
+    assert start_match is not None
+    info_string = start_match.group('info_string') or ""
+
+    info_string = info_string.strip()
+
+    is_valid_language = info_string in LANGUAGE_COMMENT_SCANNERS
+    if not is_valid_language:
+        inner_content = content
+        inner_content = inner_content.split("\n", 1)[-1]
+        # trim off final fence
+        inner_content = inner_content.rsplit("\n", 1)[0]
+
+        return Block(md_path, elem_index, info_string, [], content, inner_content, {})
+
+    language = info_string
+    scanner  = LANGUAGE_COMMENT_SCANNERS[language]
+
+    directives = [Directive('lp_language', language, info_string)]
+
+    inner_content_chunks = []
+    for chunk, comment_match in _iter_comments(content, start_match.end(), scanner):
+        if chunk:
+            inner_content_chunks.append(chunk)
+        if comment_match is None:
+            break
+
+        comment_text = comment_match.group('comment_text')
+        raw_text     = content[comment_match.start() : comment_match.end('comment_text')]
+        raw_text     = raw_text.lstrip("\n")
+        if VERIFY_PARSE:
+            assert raw_text in content
+
+        comment_text = comment_text.strip()
+        if comment_text.startswith("lp_"):
+            directive = _parse_directive(comment_text, raw_text)
+            directives.append(directive)
+        else:
+            inner_content_chunks.append(raw_text)
+
+    inner_content = "".join(inner_content_chunks)
+    # trim off final fence
+    inner_content = inner_content.rsplit("\n", 1)[0]
+
+    return Block(
+        md_path,
+        elem_index,
+        info_string,
+        directives,
+        content,
+        inner_content,
+        _index_directives(directives),
+    )
+
+
+def _memo_block(md_path: pl.Path, elem_index: int, elem: MarkdownElement) -> Block:
+    # NOTE: Elements are shared between the
+    #   MarkdownFile instances that are created during a build
+    #   (copies and expanded files), so memoizing on the element
+    #   means that each block is only parsed once per build.
+    block = typ.cast(typ.Optional[Block], elem._block)
+    if block is None or block.elem_index != elem_index or block.md_path != md_path:
+        block       = _parse_block(md_path, elem_index, elem)
+        elem._block = block
+    return block
+
+
+def parse_block(elem: MarkdownElement) -> Block:
+    """Parse the Block of an element (memoized on the element)."""
+    assert elem.md_type == MD_BLOCK
+    return _memo_block(elem.md_path, elem.elem_index, elem)
+
+
+Elements = typ.Tuple[MarkdownElement, ...]
+
+
 class MarkdownFile:
 
-    md_path : pl.Path
-    elements: typ.List[MarkdownElement]
+    __slots__ = [
+        'md_path',
+        '_elements',
+        '_headlines',
+        '_blocks',
+        '_blocks_by_directive',
+        '_line_starts',
+        '_elem_offsets',
+    ]
+
+    md_path: pl.Path
+
+    # NOTE: The elements are immutable so that
+    #   copies of a MarkdownFile (and of a Context) can share
+    #   them. A modified file is created by replacing elements.
+    _elements : Elements
+    _headlines: typ.Optional[typ.List[Headline]]
+    _blocks   : typ.Optional[typ.List[Block]]
+
+    _blocks_by_directive: typ.Optional[typ.Dict[str, typ.List[Block]]]
+
+    # offsets into str(self)
+    _line_starts : typ.Optional[LineStarts]
+    _elem_offsets: typ.Optional[array.array]
 
     def __init__(
-        self, md_path: pl.Path, elements: typ.Optional[typ.List[MarkdownElement]] = None
+        self, md_path: pl.Path, elements: typ.Optional[typ.Sequence[MarkdownElement]] = None
     ) -> None:
         self.md_path = md_path
         if elements is None:
@@ -332,97 +607,99 @@ class MarkdownFile:
         else:
             self.elements = elements
 
+    @property
+    def elements(self) -> Elements:
+        return self._elements
+
+    @elements.setter
+    def elements(self, elements: typ.Sequence[MarkdownElement]) -> None:
+        # NOTE: The headline and block tables are derived from the
+        #   elements and are invalidated when the elements are
+        #   replaced.
+        self._elements  = tuple(elements)
+        self._headlines = None
+        self._blocks    = None
+
+        self._blocks_by_directive = None
+
+        self._line_starts  = None
+        self._elem_offsets = None
+
     def copy(self) -> 'MarkdownFile':
-        return MarkdownFile(self.md_path, list(self.elements))
+        # The copy shares the (immutable) elements and tables.
+        md_file = MarkdownFile(self.md_path, self._elements)
+        md_file._headlines = self._headlines
+        md_file._blocks    = self._blocks
+
+        md_file._blocks_by_directive = self._blocks_by_directive
+
+        md_file._line_starts  = self._line_starts
+        md_file._elem_offsets = self._elem_offsets
+        return md_file
 
     @property
-    def headlines(self) -> typ.Iterable[Headline]:
-        for elem_index, elem in enumerate(self.elements):
-            if elem.md_type != 'headline':
-                continue
-
-            a_match = HEADLINE_RE_A.match(elem.content)
-            b_match = HEADLINE_RE_B.match(elem.content)
-            if a_match:
-                text   = a_match.group('headline_text_a')
-                marker = a_match.group('headline_marker_a')
-                level  = marker.count("#")
-            elif b_match:
-                text   = b_match.group('headline_text_b')
-                marker = b_match.group('headline_marker_b')
-                level  = 1 if "-" in marker else 2
-            else:
-                err_msg = "Invalid headline: {elem.content}"
-                assert False, err_msg
+    def headlines(self) -> typ.List[Headline]:
+        if self._headlines is None:
+            self._headlines = [
+                _parse_headline(self.md_path, elem_index, elem)
+                for elem_index, elem in enumerate(self.elements)
+                if elem.md_type == MD_HEADLINE
+            ]
+        return self._headlines
 
-            yield Headline(self.md_path, elem_index, text.strip(), level)
+    @property
+    def blocks(self) -> typ.List[Block]:
+        if self._blocks is None:
+            self._blocks = [
+                _memo_block(self.md_path, elem_index, elem)
+                for elem_index, elem in enumerate(self.elements)
+                if elem.md_type == MD_BLOCK
+            ]
+        return self._blocks
+
+    def blocks_with_directive(self, name: str) -> typ.List[Block]:
+        """Blocks (in document order) which have a directive with name."""
+        if self._blocks_by_directive is None:
+            blocks_by_directive: typ.Dict[str, typ.List[Block]] = collections.defaultdict(list)
+            for block in self.blocks:
+                for directive_name in block.directive_index:
+                    blocks_by_directive[directive_name].append(block)
+            self._blocks_by_directive = dict(blocks_by_directive)
+
+        return self._blocks_by_directive.get(name, [])
+
+    def _init_line_index(self) -> None:
+        line_starts  = array.array('I', [0])
+        elem_offsets = array.array('I')
+
+        offset = 0
+        for elem in self.elements:
+            content = elem.content
+            elem_offsets.append(offset)
+            line_starts.extend(offset + match.end() for match in NEWLINE_RE.finditer(content))
+            offset += len(content)
+
+        self._line_starts  = line_starts
+        self._elem_offsets = elem_offsets
 
     @property
-    def blocks(self) -> typ.Iterable[Block]:
-        for elem_index, elem in enumerate(self.elements):
-            if elem.md_type != 'block':
-                continue
-
-            start_match = BLOCK_START_RE.match(elem.content)
-            assert start_match is not None
-            info_string = start_match.group('info_string') or ""
-
-            info_string = info_string.strip()
-
-            is_valid_language = info_string in LANGUAGE_COMMENT_REGEXES
-            if not is_valid_language:
-                inner_content = elem.content
-                inner_content = inner_content.split("\n", 1)[-1]
-                # trim off final fence
-                inner_content = inner_content.rsplit("\n", 1)[0]
-
-                yield Block(self.md_path, elem_index, info_string, [], elem.content, inner_content)
-                continue
-
-            language = info_string
-            comment_start_re, comment_end_re = LANGUAGE_COMMENT_REGEXES[language]
-
-            directives = [Directive('lp_language', language, info_string)]
-
-            inner_content_chunks = []
-            rest                 = elem.content[start_match.end() :]
-            while rest:
-                start_match = comment_start_re.search(rest)
-                if start_match is None:
-                    inner_content_chunks.append(rest)
-                    break
-
-                chunk = rest[: start_match.start()]
-                if chunk:
-                    inner_content_chunks.append(chunk)
-
-                rest      = rest[start_match.end() :]
-                end_match = comment_end_re.search(rest)
-                if end_match is None:
-                    comment_text = rest
-                    rest         = ""
-                else:
-                    comment_text = rest[: end_match.start()]
-                    rest         = rest[end_match.end() :]
-
-                raw_text = start_match.group(0) + comment_text
-                raw_text = raw_text.lstrip("\n")
-                assert raw_text in elem.content
-
-                comment_text = comment_text.strip()
-                if comment_text.startswith("lp_"):
-                    directive = _parse_directive(comment_text, raw_text)
-                    directives.append(directive)
-                else:
-                    inner_content_chunks.append(raw_text)
-
-            inner_content = "".join(inner_content_chunks)
-            # trim off final fence
-            inner_content = inner_content.rsplit("\n", 1)[0]
-
-            yield Block(
-                self.md_path, elem_index, info_string, directives, elem.content, inner_content
-            )
+    def line_starts(self) -> LineStarts:
+        """Offsets (into str(self)) at which each line starts."""
+        if self._line_starts is None:
+            self._init_line_index()
+        assert self._line_starts is not None
+        return self._line_starts
+
+    def elem_offset(self, elem_index: int) -> int:
+        """Offset (into str(self)) at which an element starts."""
+        if self._elem_offsets is None:
+            self._init_line_index()
+        assert self._elem_offsets is not None
+        return self._elem_offsets[elem_index]
+
+    def line_no(self, offset: int) -> int:
+        """Line number (1 based) for an offset into str(self)."""
+        return bisect.bisect_right(self.line_starts, offset)
 
     def __lt__(self, other: 'MarkdownFile') -> bool:
         return self.md_path < other.md_path
@@ -443,60 +720,114 @@ class MarkdownFile:
         return f"litprog.parse.MarkdownFile(\"{self.md_path}\")"
 
 
-def _iter_raw_md_elements(content: str) -> typ.Iterable[_RawMarkdownElement]:
-    line_no = 1
-    while content:
-        match = ELEMENT_RE.search(content)
+AnyContent = typ.Union[str, ContentBuffer]
+
+
+def _init_line_starts(content: AnyContent) -> LineStarts:
+    newline_re  = NEWLINE_RE if isinstance(content, str) else NEWLINE_RE_BYTES
+    line_starts = array.array('I', [0])
+    line_starts.extend(match.end() for match in newline_re.finditer(content))
+    return line_starts
+
+
+def _search_element(
+    content: AnyContent, pos: int, element_re: typ.Pattern, nl: typ.AnyStr
+) -> typ.Tuple[int, typ.Optional[typ.Match]]:
+    # NOTE: When pos is not at the start of a line,
+    #   "^" would not match at pos for a search with an offset. An
+    #   element may however start directly after the previous one
+    #   ended (for example the rest of a line after a headline such
+    #   as "# foo # bar"). To preserve the semantics of matching
+    #   against the remaining content, we first try to match at pos
+    #   using only the (at most two) lines the pattern can span.
+    #   The offset that is returned with the match is the position
+    #   that the match positions are relative to.
+    if pos > 0 and content[pos - 1 : pos] != nl:
+        line_end = content.find(nl, pos)
+        if line_end >= 0:
+            line_end = content.find(nl, line_end + 1)
+        if line_end < 0:
+            line_end = len(content)
+
+        match = element_re.match(content[pos:line_end])
+        if match:
+            return pos, match
+
+    return 0, element_re.search(content, pos)
+
+
+def _iter_raw_md_elements(content: AnyContent) -> typ.Iterable[_RawMarkdownElement]:
+    """Tokenize content into elements.
+
+    The content may either be a str or the undecoded bytes of a
+    file (including a memory mapped file), the returned offsets
+    are relative to the content that is passed.
+    """
+    if isinstance(content, str):
+        nl            = "\n"
+        element_re    = ELEMENT_RE
+        block_end_res = BLOCK_END_RE
+    else:
+        nl            = b"\n"
+        element_re    = ELEMENT_RE_BYTES
+        block_end_res = BLOCK_END_RE_BYTES
+
+    line_starts = _init_line_starts(content)
+
+    end_pos = len(content)
+    pos     = 0
+    while pos < end_pos:
+        offset, match = _search_element(content, pos, element_re, nl)
         if match is None:
             break
 
         # yield preceding paragraph
-        para_content = content[: match.start()]
-        if para_content:
-            yield _RawMarkdownElement(MD_PARAGRAPH, para_content, line_no)
-
-        line_no += para_content.count("\n")
+        elem_start = offset + match.start()
+        if elem_start > pos:
+            line_no = bisect.bisect_right(line_starts, pos)
+            yield _RawMarkdownElement(MD_PARAGRAPH, pos, elem_start, line_no)
 
         # parse match as special element
         groups         = match.groupdict()
         is_headline    = bool(groups['headline_marker_a'] or groups['headline_marker_b'])
         is_block_fence = groups['block_fence']
-        match_content  = content[match.start() : match.end()]
-        rest_content   = content[match.end() :]
+        elem_end       = offset + match.end()
 
         if is_headline:
             md_type = MD_HEADLINE
         elif is_block_fence:
             md_type      = MD_BLOCK
             block_fence  = groups['block_fence']
-            block_end_re = BLOCK_END_RE[block_fence]
-            end_match    = block_end_re.search(rest_content)
+            block_end_re = block_end_res[block_fence]
+            end_match    = block_end_re.search(content, elem_end)
             if end_match is None:
-                match_content += rest_content
-                rest_content = ""
+                elem_end = end_pos
             else:
-                end_pos = end_match.end()
-                match_content += rest_content[:end_pos]
-                rest_content = rest_content[end_pos:]
-
-        yield _RawMarkdownElement(md_type, match_content, line_no)
+                elem_end = end_match.end()
 
-        line_no += match_content.count("\n")
-        content = rest_content
+        line_no = bisect.bisect_right(line_starts, elem_start)
+        yield _RawMarkdownElement(md_type, elem_start, elem_end, line_no)
+        pos = elem_end
 
-    if content:
-        yield _RawMarkdownElement(MD_PARAGRAPH, content, line_no)
+    if pos < end_pos:
+        line_no = bisect.bisect_right(line_starts, pos)
+        yield _RawMarkdownElement(MD_PARAGRAPH, pos, end_pos, line_no)
 
 
-def _parse_md_elements(md_path: pl.Path) -> typ.List[MarkdownElement]:
+def _read_md_content(md_path: pl.Path) -> str:
     # TODO: encoding from config
     with md_path.open(mode='r', encoding="utf-8") as fh:
-        content = fh.read()
+        return fh.read()
 
+
+def _init_md_elements(
+    md_path: pl.Path, content: str, raw_elems: typ.Iterable[_RawMarkdownElement]
+) -> typ.List[MarkdownElement]:
     elements = []
-    for elem_index, raw_elem in enumerate(_iter_raw_md_elements(content)):
-        elem = MarkdownElement(
-            md_path, elem_index, raw_elem.md_type, raw_elem.content, raw_elem.first_line, None
+    for elem_index, raw_elem in enumerate(raw_elems):
+        elem_content = content[raw_elem.start : raw_elem.end]
+        elem         = MarkdownElement(
+            md_path, elem_index, raw_elem.md_type, elem_content, raw_elem.first_line, None
         )
         elements.append(elem)
 
@@ -510,6 +841,49 @@ def _parse_md_elements(md_path: pl.Path) -> typ.List[MarkdownElement]:
     return elements
 
 
+def _init_lazy_md_elements(
+    md_path: pl.Path, buf: ContentBuffer, raw_elems: typ.Iterable[_RawMarkdownElement]
+) -> typ.List[MarkdownElement]:
+    elements = []
+    end_pos  = 0
+    for elem_index, raw_elem in enumerate(raw_elems):
+        # Equivalent to the byte for byte assertion of
+        # _init_md_elements, without decoding the content.
+        assert raw_elem.start == end_pos
+        end_pos = raw_elem.end
+
+        elem = MarkdownElement.from_buffer(
+            md_path,
+            elem_index,
+            raw_elem.md_type,
+            buf,
+            raw_elem.start,
+            raw_elem.end,
+            raw_elem.first_line,
+        )
+        elements.append(elem)
+
+    assert end_pos == len(buf)
+    return elements
+
+
+def _map_md_file(md_path: pl.Path) -> ContentBuffer:
+    with md_path.open(mode="rb") as fh:
+        if os.fstat(fh.fileno()).st_size == 0:
+            # empty files cannot be mapped
+            return b""
+        return mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _parse_md_elements(md_path: pl.Path, use_mmap: bool = False) -> typ.List[MarkdownElement]:
+    if use_mmap:
+        buf = _map_md_file(md_path)
+        return _init_lazy_md_elements(md_path, buf, _iter_raw_md_elements(buf))
+    else:
+        content = _read_md_content(md_path)
+        return _init_md_elements(md_path, content, _iter_raw_md_elements(content))
+
+
 class Context:
 
     files: typ.List[MarkdownFile]
@@ -535,6 +909,11 @@ class Context:
             for block in md_file.blocks:
                 yield block
 
+    def blocks_with_directive(self, name: str) -> typ.Iterable[Block]:
+        for md_file in self.files:
+            for block in md_file.blocks_with_directive(name):
+                yield block
+
     def copy(self) -> 'Context':
         return Context([f.copy() for f in self.files])
 
@@ -545,8 +924,228 @@ class Context:
             return False
 
 
-def parse_context(md_paths: FilePaths) -> Context:
-    ctx = Context(md_paths)
+def _parse_md_file(
+    md_path          : pl.Path,
+    cache_dir        : typ.Optional[pl.Path] = None,
+    use_mmap         : bool = False,
+    is_cache_readonly: bool = False,
+) -> MarkdownFile:
+    if cache_dir is None:
+        md_file = MarkdownFile(md_path, _parse_md_elements(md_path, use_mmap))
+    else:
+        md_file = _load_md_file(md_path, cache_dir, use_mmap, is_cache_readonly)
+
+    # populate the tables in the worker, so they are
+    # part of the result that is sent back.
+    md_file.headlines
+    md_file.blocks
+    return md_file
+
+
+# Increment this whenever the parsing logic or any of the cached
+# types change, so that previously cached results are ignored.
+PARSE_CACHE_VERSION = 3
+
+
+class _ParseCacheEntry(typ.NamedTuple):
+
+    raw_elems: typ.List[_RawMarkdownElement]
+    headlines: typ.List[Headline]
+    # NOTE: The content of each block is omitted, as it is
+    #   identical to the content of its element.
+    blocks: typ.List[Block]
+
+
+def _parse_cache_prefix(md_path: pl.Path, use_mmap: bool) -> str:
+    # NOTE: The offsets of elements are either byte offsets (for
+    #   mmap) or offsets into the decoded content, so the mode is
+    #   part of the key.
+    path_sum = litprog.index.new_digest()
+    path_sum.update(f"{PARSE_CACHE_VERSION}_{use_mmap}_{md_path}".encode("utf-8"))
+    return path_sum.hexdigest()[:16]
+
+
+def _parse_cache_path(
+    md_path: pl.Path, data: ContentBuffer, use_mmap: bool, cache_dir: pl.Path
+) -> pl.Path:
+    # NOTE: The name starts with a prefix for the path of the file,
+    #   so that the entries for previous versions of the file can
+    #   be removed (see _prune_parse_cache).
+    prefix = _parse_cache_prefix(md_path, use_mmap)
+    id_sum = litprog.index.new_digest()
+    id_sum.update(data)
+    return cache_dir / "parse" / f"{prefix}_{id_sum.hexdigest()}.pickle"
+
+
+def _read_parse_cache(cache_path: pl.Path) -> typ.Optional[_ParseCacheEntry]:
+    if not cache_path.exists():
+        return None
+
+    try:
+        with cache_path.open(mode="rb") as fh:
+            entry = pickle.load(fh)
+        assert isinstance(entry, _ParseCacheEntry)
+        return entry
+    except Exception:
+        log.warning(f"Ignoring invalid/corrupted cache file '{cache_path}'", exc_info=True)
+        return None
+
+
+def _write_parse_cache(cache_path: pl.Path, entry: _ParseCacheEntry) -> None:
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = cache_path.parent / f"{cache_path.name}.{os.getpid()}.tmp"
+    with tmp_path.open(mode="wb") as fh:
+        pickle.dump(entry, fh, protocol=pickle.HIGHEST_PROTOCOL)
+    tmp_path.replace(cache_path)
+
+
+def _prune_parse_cache(cache_path: pl.Path) -> None:
+    """Remove entries for other versions of the file of cache_path."""
+    prefix = cache_path.name.split("_", 1)[0]
+    for stale_path in cache_path.parent.glob(f"{prefix}_*.pickle"):
+        if stale_path != cache_path:
+            try:
+                stale_path.unlink()
+            except IOError:
+                # already removed by a concurrent build
+                pass
+
+
+def _load_md_file(
+    md_path          : pl.Path,
+    cache_dir        : pl.Path,
+    use_mmap         : bool = False,
+    is_cache_readonly: bool = False,
+) -> MarkdownFile:
+    """Load a MarkdownFile, reusing cached parse results if possible.
+
+    The cache is keyed by a digest of the path and content of the
+    file, so a cached entry is only used if the file is unchanged.
+    With is_cache_readonly=True, no cache entries are written.
+    """
+    data: ContentBuffer
+    if use_mmap:
+        data = _map_md_file(md_path)
+    else:
+        with md_path.open(mode="rb") as fh:
+            data = fh.read()
+
+    # NOTE: Elements are always initialized from data, which is
+    #   also what the cache entry is keyed on. Reading the file
+    #   again could give a different content, if it was changed.
+    content: AnyContent
+    if use_mmap:
+        content = data
+    else:
+        # decode the same way as _read_md_content does (universal newlines)
+        content = io.TextIOWrapper(io.BytesIO(data), encoding="utf-8").read()
+
+    def _init_elements(raw_elems: typ.List[_RawMarkdownElement]) -> typ.List[MarkdownElement]:
+        if isinstance(content, str):
+            return _init_md_elements(md_path, content, raw_elems)
+        else:
+            return _init_lazy_md_elements(md_path, content, raw_elems)
+
+    cache_path = _parse_cache_path(md_path, data, use_mmap, cache_dir)
+    entry      = _read_parse_cache(cache_path)
+
+    if entry is None:
+        raw_elems = list(_iter_raw_md_elements(content))
+        elements  = _init_elements(raw_elems)
+        md_file   = MarkdownFile(md_path, elements)
+        blocks    = [block._replace(content="") for block in md_file.blocks]
+        entry     = _ParseCacheEntry(raw_elems, md_file.headlines, blocks)
+        if is_cache_readonly:
+            return md_file
+
+        try:
+            _write_parse_cache(cache_path, entry)
+            _prune_parse_cache(cache_path)
+        except IOError:
+            log.warning(f"Could not write cache file '{cache_path}'", exc_info=True)
+        return md_file
+
+    log.debug(f"using cached parse result for '{md_path}'")
+    elements = _init_elements(entry.raw_elems)
+    md_file  = MarkdownFile(md_path, elements)
+
+    blocks = []
+    for block in entry.blocks:
+        elem  = elements[block.elem_index]
+        block = block._replace(content=elem.content)
+        blocks.append(block)
+        elem._block = block
+
+    md_file._headlines = entry.headlines
+    md_file._blocks    = blocks
+    return md_file
+
+
+# Below this total size of input files, the overhead of
+# starting worker processes and transferring the parsed
+# elements back is larger than the time to parse, so
+# threads are used instead.
+MIN_PROCESS_POOL_INPUT_SIZE = 4 * 1024 * 1024
+
+
+def _parse_md_files(
+    md_paths         : typ.List[pl.Path],
+    jobs             : int,
+    cache_dir        : typ.Optional[pl.Path] = None,
+    use_mmap         : bool = False,
+    is_cache_readonly: bool = False,
+) -> typ.List[MarkdownFile]:
+    parse_fn = ft.partial(
+        _parse_md_file, cache_dir=cache_dir, use_mmap=use_mmap, is_cache_readonly=is_cache_readonly
+    )
+
+    if jobs <= 0:
+        jobs = os.cpu_count() or 1
+
+    jobs = min(jobs, len(md_paths))
+    if jobs <= 1:
+        return [parse_fn(md_path) for md_path in md_paths]
+
+    input_size = sum(md_path.stat().st_size for md_path in md_paths)
+
+    executor: cf.Executor
+    # NOTE: mapped files can't be sent between processes.
+    if use_mmap or input_size < MIN_PROCESS_POOL_INPUT_SIZE:
+        executor = cf.ThreadPoolExecutor(max_workers=jobs)
+    else:
+        executor = cf.ProcessPoolExecutor(max_workers=jobs)
+
+    log.debug(f"parsing {len(md_paths)} files using {type(executor).__name__}(jobs={jobs})")
+    with executor:
+        return list(executor.map(parse_fn, md_paths))
+
+
+def parse_context(
+    md_paths         : FilePaths,
+    jobs             : int = 1,
+    cache_dir        : typ.Optional[pl.Path] = None,
+    use_mmap         : bool = False,
+    is_cache_readonly: bool = False,
+) -> Context:
+    """Parse markdown files into a Context.
+
+    With jobs > 1, files are parsed concurrently (jobs=0 uses
+    one worker per cpu). The resulting Context is the same,
+    regardless of the number of jobs.
+
+    If a cache_dir is given, parse results are persisted there and
+    reused for files that have not changed since a previous parse.
+    With is_cache_readonly=True, they are only reused.
+
+    With use_mmap=True, files are memory mapped and elements are
+    scanned without decoding the file. The content of an element
+    is only decoded when it is accessed. In this mode, newlines
+    are not translated and files must not be truncated or
+    modified in place while the Context is in use (build replaces
+    files instead).
+    """
+    md_files = _parse_md_files(list(md_paths), jobs, cache_dir, use_mmap, is_cache_readonly)
+    ctx      = Context(md_files)
 
     assert ctx.copy() == ctx
     list(ctx.headlines)
@@ -0,0 +1,141 @@
+# This file is part of the litprog project
+# https://gitlab.com/mbarkhau/litprog
+#
+# Copyright (c) 2020 Manuel Barkhau (mbarkhau@gmail.com) - MIT License
+# SPDX-License-Identifier: MIT
+"""Execute tasks of a dependency graph on a pool of worker threads.
+
+A task is started as soon as all of its dependencies have
+completed. Of the tasks that are ready to run, the one that was
+added first is started first, so with jobs=1 tasks run in the
+order they were added (as far as dependencies allow).
+"""
+import heapq
+import typing as typ
+import logging
+import concurrent.futures as cf
+
+log = logging.getLogger(__name__)
+
+
+TaskKey = typ.Hashable
+Result  = typ.Any
+
+
+class CycleError(Exception):
+    pass
+
+
+class Task(typ.NamedTuple):
+    key : TaskKey
+    func: typ.Callable[[], Result]
+    deps: typ.FrozenSet[TaskKey]
+
+
+class Graph:
+
+    tasks  : typ.Dict[TaskKey, Task]
+    results: typ.Dict[TaskKey, Result]
+
+    def __init__(self) -> None:
+        self.tasks   = {}
+        self.results = {}
+
+    def add(
+        self,
+        key : TaskKey,
+        func: typ.Callable[[], Result],
+        deps: typ.Iterable[TaskKey] = (),
+    ) -> None:
+        assert key not in self.tasks, key
+        self.tasks[key] = Task(key, func, frozenset(deps))
+
+    def _init_dependents(self) -> typ.Dict[TaskKey, typ.List[TaskKey]]:
+        dependents: typ.Dict[TaskKey, typ.List[TaskKey]] = {key: [] for key in self.tasks}
+        for task in self.tasks.values():
+            for dep in task.deps:
+                if dep not in self.tasks:
+                    raise KeyError(f"Task {task.key} depends on unknown task {dep}")
+                dependents[dep].append(task.key)
+        return dependents
+
+    @staticmethod
+    def _iter_unblocked(
+        key       : TaskKey,
+        dependents: typ.Dict[TaskKey, typ.List[TaskKey]],
+        n_pending : typ.Dict[TaskKey, int],
+    ) -> typ.Iterable[TaskKey]:
+        """Dependents of a completed task, which have no more pending deps."""
+        for dependent in dependents[key]:
+            n_pending[dependent] -= 1
+            if n_pending[dependent] == 0:
+                yield dependent
+
+    def _check_cycles(self, dependents: typ.Dict[TaskKey, typ.List[TaskKey]]) -> None:
+        n_pending = {key: len(task.deps) for key, task in self.tasks.items()}
+        stack     = [key for key, num_deps in n_pending.items() if num_deps == 0]
+        n_visited = 0
+        while stack:
+            key = stack.pop()
+            n_visited += 1
+            stack.extend(self._iter_unblocked(key, dependents, n_pending))
+
+        if n_visited < len(self.tasks):
+            cyclic_keys = [key for key, num_deps in n_pending.items() if num_deps > 0]
+            raise CycleError(f"Dependency cycle between tasks: {cyclic_keys}")
+
+    def run(self, jobs: int = 1) -> typ.Dict[TaskKey, Result]:
+        """Run all tasks and return their results by key.
+
+        While the graph runs, the results of completed tasks are
+        available in self.results, so a task may use the results
+        of the tasks it depends on.
+
+        If a task raises an exception, no further tasks are
+        started and the exception is reraised once the tasks that
+        are already running have completed.
+        """
+        dependents = self._init_dependents()
+        self._check_cycles(dependents)
+
+        order     = {key: idx for idx, key in enumerate(self.tasks)}
+        n_pending = {key: len(task.deps) for key, task in self.tasks.items()}
+
+        ready: typ.List[typ.Tuple[int, TaskKey]] = [
+            (order[key], key) for key, num_deps in n_pending.items() if num_deps == 0
+        ]
+        heapq.heapify(ready)
+
+        results = self.results
+        results.clear()
+        error: typ.Optional[BaseException] = None
+
+        with cf.ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            running: typ.Dict[cf.Future, TaskKey] = {}
+            while True:
+                while ready and error is None and len(running) < max(1, jobs):
+                    _, key = heapq.heappop(ready)
+                    future = executor.submit(self.tasks[key].func)
+                    running[future] = key
+
+                if not running:
+                    break
+
+                done, _ = cf.wait(running, return_when=cf.FIRST_COMPLETED)
+                for future in sorted(done, key=lambda fut: order[running[fut]]):
+                    key = running.pop(future)
+                    try:
+                        results[key] = future.result()
+                    except Exception as ex:
+                        if error is None:
+                            error = ex
+                        continue
+
+                    for dependent in self._iter_unblocked(key, dependents, n_pending):
+                        heapq.heappush(ready, (order[dependent], dependent))
+
+        if error is not None:
+            raise error
+
+        assert len(results) == len(self.tasks)
+        return results
@@ -8,10 +8,13 @@ import io
 import os
 import re
 import sys
+import copy
 import enum
 import math
 import time
 import shlex
+import codecs
+import asyncio
 import typing as typ
 
 ###################################
@@ -25,12 +28,15 @@ import datetime as dt
 import operator as op
 import functools as ft
 import itertools as it
+import selectors
 import threading
 import subprocess as sp
 import collections
 
 import pathlib2 as pl
 
+import litprog.forkserver
+
 log = logging.getLogger(__name__)
 
 InputPaths = typ.Sequence[str]
@@ -48,6 +54,9 @@ class CapturedLine(typ.NamedTuple):
     ts    : float
     line  : str
     is_err: bool
+    # If > 0, this is a marker for lines that were omitted
+    # from the capture at this point (line is empty).
+    n_omitted: int = 0
 
 
 class SessionException(Exception):
@@ -62,34 +71,202 @@ _: Environ = os.environ
 def _gen_captured_lines(
     raw_lines: typ.Iterable[bytes], encoding: str = "utf-8"
 ) -> typ.Iterable[RawCapturedLine]:
+    # NOTE: Overlong lines are read in parts (see _read_loop),
+    #   which may split a multibyte character.
+    decoder = codecs.getincrementaldecoder(encoding)()
     for raw_line in raw_lines:
         # get timestamp as fast as possible after
         #   output was read
         ts = time.time()
 
-        line_value = raw_line.decode(encoding)
+        line_value = decoder.decode(raw_line)
         log.debug(f"read {len(raw_line)} bytes")
         yield RawCapturedLine(ts, line_value)
 
 
+class BoundedLines:
+    """Captured lines of an output stream, with limited memory use.
+
+    If the output exceeds max_lines or max_bytes, only the lines
+    at the head and at the tail (up to half of each limit) are
+    kept in memory. The lines in between are dropped and only
+    counted (n_omitted_lines, n_omitted_bytes).
+
+    A reader thread notifies cond for every appended line and
+    when it reaches the end of the stream (see close()).
+    """
+
+    max_lines: typ.Optional[int]
+    max_bytes: typ.Optional[int]
+    cond     : threading.Condition
+    is_closed: bool
+
+    n_omitted_lines: int
+    n_omitted_bytes: int
+    # timestamp of the first omitted line
+    omitted_ts: float
+
+    _head      : typ.List[RawCapturedLine]
+    _tail      : typ.Deque[RawCapturedLine]
+    _head_bytes: int
+    _tail_bytes: int
+    _is_head   : bool
+
+    def __init__(
+        self, max_lines: typ.Optional[int] = None, max_bytes: typ.Optional[int] = None
+    ) -> None:
+        self.max_lines = max_lines
+        self.max_bytes = max_bytes
+        self.cond      = threading.Condition()
+        self.is_closed = False
+        self._reset()
+
+    def _reset(self) -> None:
+        self.n_omitted_lines = 0
+        self.n_omitted_bytes = 0
+        self.omitted_ts      = -1.0
+
+        self._head       = []
+        self._tail       = collections.deque()
+        self._head_bytes = 0
+        self._tail_bytes = 0
+        self._is_head    = True
+
+    @staticmethod
+    def _size(cl: RawCapturedLine) -> int:
+        return len(cl.line.encode("utf-8"))
+
+    def _fits(self, n_lines: int, n_bytes: int, is_head: bool) -> bool:
+        if self.max_lines is not None:
+            head_max_lines = self.max_lines // 2
+            max_lines      = head_max_lines if is_head else self.max_lines - head_max_lines
+            if n_lines > max_lines:
+                return False
+        if self.max_bytes is not None:
+            head_max_bytes = self.max_bytes // 2
+            max_bytes      = head_max_bytes if is_head else self.max_bytes - head_max_bytes
+            if n_bytes > max_bytes:
+                return False
+        return True
+
+    def append(self, cl: RawCapturedLine) -> None:
+        with self.cond:
+            self._append(cl)
+            self.cond.notify_all()
+
+    def close(self) -> None:
+        """Mark the end of the stream."""
+        with self.cond:
+            self.is_closed = True
+            self.cond.notify_all()
+
+    def _append(self, cl: RawCapturedLine) -> None:
+        size = self._size(cl)
+        if self._is_head:
+            if self._fits(len(self._head) + 1, self._head_bytes + size, is_head=True):
+                self._head.append(cl)
+                self._head_bytes += size
+                return
+            else:
+                self._is_head = False
+
+        self._tail.append(cl)
+        self._tail_bytes += size
+        while self._tail and not self._fits(len(self._tail), self._tail_bytes, is_head=False):
+            omitted_cl = self._tail.popleft()
+            self._tail_bytes -= self._size(omitted_cl)
+            self._omit(omitted_cl)
+
+    def _omit(self, cl: RawCapturedLine) -> None:
+        if self.n_omitted_lines == 0:
+            self.omitted_ts = cl.ts
+        self.n_omitted_lines += 1
+        self.n_omitted_bytes += self._size(cl)
+
+    @property
+    def is_truncated(self) -> bool:
+        return self.n_omitted_lines > 0
+
+    @property
+    def last(self) -> typ.Optional[RawCapturedLine]:
+        with self.cond:
+            if self._tail:
+                return self._tail[-1]
+            elif self._head:
+                return self._head[-1]
+            else:
+                return None
+
+    def pop_last(self) -> typ.Optional[RawCapturedLine]:
+        with self.cond:
+            if self._tail:
+                cl = self._tail.pop()
+                self._tail_bytes -= self._size(cl)
+            elif self._head:
+                cl = self._head.pop()
+                self._head_bytes -= self._size(cl)
+            else:
+                return None
+        return cl
+
+    def take(self) -> 'BoundedLines':
+        """Move the lines captured so far to a new BoundedLines.
+
+        The limits apply anew to lines that are appended after
+        this (see PersistentSession).
+        """
+        with self.cond:
+            taken = copy.copy(self)
+            self._reset()
+        return taken
+
+    @property
+    def head(self) -> typ.List[RawCapturedLine]:
+        return self._head
+
+    @property
+    def tail(self) -> typ.List[RawCapturedLine]:
+        return list(self._tail)
+
+    def __len__(self) -> int:
+        return len(self._head) + len(self._tail)
+
+    def __iter__(self) -> typ.Iterator[RawCapturedLine]:
+        return it.chain(self._head, self._tail)
+
+
 def _read_loop(
     sp_output_pipe: typ.IO[bytes],
-    captured_lines: typ.List[RawCapturedLine],
+    captured_lines: BoundedLines,
     encoding      : str = "utf-8",
 ) -> None:
-    raw_lines = iter(sp_output_pipe.readline, b'')
+    # NOTE: Without a limit on the length of a
+    #   line, a process that writes without newlines could still
+    #   exhaust memory. Overlong lines are split instead.
+    if captured_lines.max_bytes is None:
+        readline = sp_output_pipe.readline
+    else:
+        readline = ft.partial(sp_output_pipe.readline, max(1, captured_lines.max_bytes))
+
+    raw_lines = iter(readline, b'')
     cl_gen    = _gen_captured_lines(raw_lines, encoding=encoding)
     for cl in cl_gen:
         captured_lines.append(cl)
+    captured_lines.close()
 
 
 class CapturingThread(typ.NamedTuple):
     thread: threading.Thread
-    lines : typ.List[RawCapturedLine]
+    lines : BoundedLines
 
 
-def _start_reader(sp_output_pipe: typ.IO[bytes], encoding: str = "utf-8") -> CapturingThread:
-    captured_lines: typ.List[RawCapturedLine] = []
+def _start_reader(
+    sp_output_pipe: typ.IO[bytes],
+    encoding      : str = "utf-8",
+    max_lines     : typ.Optional[int] = None,
+    max_bytes     : typ.Optional[int] = None,
+) -> CapturingThread:
+    captured_lines   = BoundedLines(max_lines=max_lines, max_bytes=max_bytes)
     read_loop_thread = threading.Thread(
         target=_read_loop, args=(sp_output_pipe, captured_lines, encoding)
     )
@@ -97,6 +274,133 @@ def _start_reader(sp_output_pipe: typ.IO[bytes], encoding: str = "utf-8") -> Cap
     return CapturingThread(read_loop_thread, captured_lines)
 
 
+try:
+    _monotonic_ns = time.monotonic_ns
+except AttributeError:
+    # python < 3.7
+    def _monotonic_ns() -> int:
+        return int(time.monotonic() * 1_000_000_000)
+
+
+# NOTE: On windows, selectors only work with
+#   sockets, so the output of a process is read with one thread
+#   per pipe instead.
+IS_SELECT_READER_AVAILABLE = os.name == 'posix'
+
+READ_CHUNK_SIZE = 64 * 1024
+
+
+class _ReaderStream:
+    """State of an output pipe that is read by _select_loop."""
+
+    lines  : BoundedLines
+    decoder: codecs.IncrementalDecoder
+    buf    : bytearray
+
+    def __init__(self, lines: BoundedLines, encoding: str) -> None:
+        self.lines   = lines
+        self.decoder = codecs.getincrementaldecoder(encoding)()
+        self.buf     = bytearray()
+
+
+class _Clock:
+    """Timestamps for captured lines, strictly increasing in read order.
+
+    The timestamps are based on a monotonic clock (relative to the
+    start time of the session), so that the order of lines from
+    different pipes is the order in which they were read.
+    """
+
+    def __init__(self, start: float, start_ns: int) -> None:
+        self.start    = start
+        self.start_ns = start_ns
+        self.last_ts  = start
+
+    def now(self) -> float:
+        ts = self.start + (_monotonic_ns() - self.start_ns) / 1_000_000_000
+        # NOTE: Lines from the same read, or reads within the
+        #   precision of a float, would otherwise have the same
+        #   timestamp.
+        if ts <= self.last_ts:
+            ts = self.last_ts + 1e-6
+        self.last_ts = ts
+        return ts
+
+
+def _split_lines(
+    stream: _ReaderStream, clock: _Clock, max_line_bytes: typ.Optional[int], is_eof: bool
+) -> None:
+    buf = stream.buf
+    pos = 0
+    while True:
+        end = buf.find(b"\n", pos) + 1
+        if end == 0 or (max_line_bytes and end - pos > max_line_bytes):
+            if max_line_bytes and len(buf) - pos >= max_line_bytes:
+                # overlong line, split like readline(limit) does
+                end = pos + max_line_bytes
+            elif is_eof and pos < len(buf):
+                end = len(buf)
+            else:
+                break
+
+        line_value = stream.decoder.decode(bytes(buf[pos:end]))
+        stream.lines.append(RawCapturedLine(clock.now(), line_value))
+        pos = end
+
+    del buf[:pos]
+
+
+def _select_loop(
+    pipes         : typ.List[typ.IO[bytes]],
+    streams       : typ.List[_ReaderStream],
+    clock         : _Clock,
+    max_line_bytes: typ.Optional[int],
+) -> None:
+    with selectors.DefaultSelector() as selector:
+        for pipe, stream in zip(pipes, streams):
+            selector.register(pipe.fileno(), selectors.EVENT_READ, stream)
+
+        while selector.get_map():
+            for key, _ in selector.select():
+                stream = key.data
+                data   = os.read(key.fd, READ_CHUNK_SIZE)
+                log.debug(f"read {len(data)} bytes")
+                if data:
+                    stream.buf += data
+                    _split_lines(stream, clock, max_line_bytes, is_eof=False)
+                else:
+                    _split_lines(stream, clock, max_line_bytes, is_eof=True)
+                    stream.lines.close()
+                    selector.unregister(key.fd)
+
+    for pipe in pipes:
+        pipe.close()
+
+
+def _start_select_reader(
+    out_pipe : typ.IO[bytes],
+    err_pipe : typ.IO[bytes],
+    clock    : _Clock,
+    encoding : str = "utf-8",
+    max_lines: typ.Optional[int] = None,
+    max_bytes: typ.Optional[int] = None,
+) -> typ.Tuple[threading.Thread, BoundedLines, BoundedLines]:
+    """Read stdout and stderr of a process on a single thread.
+
+    Lines are timestamped when they are read, so the order of
+    the lines of both pipes (see InteractiveSession.iter_lines)
+    is the order in which they were read.
+    """
+    out_lines = BoundedLines(max_lines=max_lines, max_bytes=max_bytes)
+    err_lines = BoundedLines(max_lines=max_lines, max_bytes=max_bytes)
+    streams   = [_ReaderStream(out_lines, encoding), _ReaderStream(err_lines, encoding)]
+    thread    = threading.Thread(
+        target=_select_loop, args=([out_pipe, err_pipe], streams, clock, max_bytes)
+    )
+    thread.start()
+    return thread, out_lines, err_lines
+
+
 AnyCommand = typ.Union[str, typ.List[str]]
 
 
@@ -110,22 +414,169 @@ def _normalize_command(command: AnyCommand) -> typ.List[str]:
         raise Exception(err_msg)
 
 
-class InteractiveSession:
+def _iter_stream_lines(lines: BoundedLines, is_err: bool) -> typ.Iterable[CapturedLine]:
+    for ts, line in lines.head:
+        yield CapturedLine(ts, line, is_err)
+
+    if lines.is_truncated:
+        yield CapturedLine(lines.omitted_ts, "", is_err, lines.n_omitted_lines)
+
+    for ts, line in lines.tail:
+        yield CapturedLine(ts, line, is_err)
+
+
+def _iter_merged_lines(
+    out_stream: BoundedLines, err_stream: BoundedLines
+) -> typ.Iterable[CapturedLine]:
+    out_lines = iter(_iter_stream_lines(out_stream, is_err=False))
+    err_lines = iter(_iter_stream_lines(err_stream, is_err=True))
+    ol        = next(out_lines, None)
+    el        = next(err_lines, None)
+
+    while True:
+        if ol and el:
+            if ol.ts <= el.ts:
+                yield ol
+                ol = next(out_lines, None)
+            else:
+                yield el
+                el = next(err_lines, None)
+        elif el:
+            yield el
+            el = next(err_lines, None)
+        elif ol:
+            yield ol
+            ol = next(out_lines, None)
+        else:
+            break
+
+
+def _wait_for_pidfd(proc: sp.Popen, timeout: float) -> typ.Optional[int]:
+    pidfd = os.pidfd_open(proc.pid)  # type: ignore
+    try:
+        with selectors.DefaultSelector() as selector:
+            # the pidfd becomes readable when the process exits
+            selector.register(pidfd, selectors.EVENT_READ)
+            selector.select(timeout)
+    finally:
+        os.close(pidfd)
+    return proc.poll()
+
+
+def _wait_for_exit(proc: typ.Any, timeout: float) -> typ.Optional[int]:
+    """Wait until proc exits or the timeout expires.
+
+    Returns the exit status, or None if proc is still running.
+    """
+    # NOTE: Popen.wait(timeout) polls with a
+    #   sleep between checks, so it can return up to 50ms after
+    #   the process exited. A pidfd (linux >= 5.3) wakes up as
+    #   soon as the process exits.
+    if hasattr(os, 'pidfd_open') and isinstance(proc, sp.Popen):
+        try:
+            return _wait_for_pidfd(proc, timeout)
+        except OSError as ex:
+            # ENOSYS on older kernels, ESRCH if the process was
+            # already reaped.
+            log.debug(f"pidfd_open failed: {ex}")
+
+    try:
+        return proc.wait(timeout=timeout)
+    except sp.TimeoutExpired:
+        return None
+
+
+class _SessionBase:
+    """Captured output of a session (common to sync and async sessions)."""
 
     encoding: str
     start   : float
     end     : float
 
-    _retcode: typ.Optional[int]
-    _proc   : sp.Popen
+    _retcode  : typ.Optional[int]
+    _in_cl    : typ.List[RawCapturedLine]
+    _out_lines: BoundedLines
+    _err_lines: BoundedLines
+
+    def _assert_retcode(self) -> None:
+        if self._retcode is None:
+            cls_name = type(self).__name__
+            raise AssertionError(
+                f"'{cls_name}.wait()' must be called " + " before accessing captured output."
+            )
+
+    @property
+    def out_lines(self) -> typ.List[RawCapturedLine]:
+        return list(self._out_lines)
+
+    @property
+    def err_lines(self) -> typ.List[RawCapturedLine]:
+        return list(self._err_lines)
+
+    @property
+    def is_truncated(self) -> bool:
+        return self._out_lines.is_truncated or self._err_lines.is_truncated
+
+    def iter_lines(self) -> typ.Iterable[CapturedLine]:
+        """Lines of stdout and stderr, in the order they were read.
+
+        If output was omitted, a CapturedLine with n_omitted > 0
+        marks the position of the omitted lines.
+        """
+        return _iter_merged_lines(self._out_lines, self._err_lines)
+
+    def iter_stdout(self) -> typ.Iterable[str]:
+        for ts, line in self._out_lines:
+            yield line
+
+    def iter_stderr(self) -> typ.Iterable[str]:
+        for ts, line in self._err_lines:
+            yield line
+
+    def __iter__(self) -> typ.Iterable[str]:
+        all_lines = self._in_cl + self.out_lines + self.err_lines
+        for captured_line in sorted(all_lines):
+            yield captured_line.line
+
+    @property
+    def runtime(self) -> float:
+        self._assert_retcode()
+        return self.end - self.start
+
+    @property
+    def stdout(self) -> str:
+        return "".join(self.iter_stdout())
+
+    @property
+    def stderr(self) -> str:
+        return "".join(self.iter_stderr())
+
 
-    _in_cl : typ.List[RawCapturedLine]
-    _out_ct: CapturingThread
-    _err_ct: CapturingThread
+class InteractiveSession(_SessionBase):
+
+    _proc   : typ.Any  # sp.Popen or litprog.forkserver.ForkedProcess
+    _readers: typ.List[threading.Thread]
 
     def __init__(
-        self, cmd: AnyCommand, *, env: typ.Optional[Environ] = None, encoding: str = "utf-8"
+        self,
+        cmd        : AnyCommand,
+        *,
+        env        : typ.Optional[Environ] = None,
+        encoding   : str = "utf-8",
+        max_lines  : typ.Optional[int] = None,
+        max_bytes  : typ.Optional[int] = None,
+        fork_server: typ.Any = None,
     ) -> None:
+        """Start a process for cmd.
+
+        The output of each of stdout and stderr is captured up to
+        max_lines and max_bytes (see BoundedLines).
+
+        If a fork_server (litprog.forkserver.ForkServer) is given,
+        the process is forked from it instead, in which case cmd
+        must be the interpreter of the fork server and the
+        environment is that of the fork server.
+        """
         _env: Environ
         if env is None:
             _env = os.environ.copy()
@@ -136,16 +587,33 @@ class InteractiveSession:
         self.start    = time.time()
         self.end      = -1.0
         self._retcode = None
+        start_ns      = _monotonic_ns()
 
         cmd_parts = _normalize_command(cmd)
-        log.debug(f"popen {cmd_parts}")
-        self._proc = sp.Popen(cmd_parts, stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.PIPE, env=_env)
+        if fork_server is None:
+            log.debug(f"popen {cmd_parts}")
+            self._proc = sp.Popen(
+                cmd_parts, stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.PIPE, env=_env
+            )
+        else:
+            log.debug(f"fork {cmd_parts} from {fork_server.python_exe}")
+            self._proc = fork_server.spawn()
 
         _enc = encoding
 
-        self._in_cl  = []
-        self._out_ct = _start_reader(self._proc.stdout, _enc)
-        self._err_ct = _start_reader(self._proc.stderr, _enc)
+        self._in_cl = []
+        if IS_SELECT_READER_AVAILABLE:
+            clock = _Clock(self.start, start_ns)
+            reader, self._out_lines, self._err_lines = _start_select_reader(
+                self._proc.stdout, self._proc.stderr, clock, _enc, max_lines, max_bytes
+            )
+            self._readers = [reader]
+        else:
+            out_ct          = _start_reader(self._proc.stdout, _enc, max_lines, max_bytes)
+            err_ct          = _start_reader(self._proc.stderr, _enc, max_lines, max_bytes)
+            self._out_lines = out_ct.lines
+            self._err_lines = err_ct.lines
+            self._readers   = [out_ct.thread, err_ct.thread]
 
     def send(self, input_str: str, delay: float = 0) -> None:
         self._in_cl.append(RawCapturedLine(time.time(), input_str))
@@ -156,17 +624,14 @@ class InteractiveSession:
             self._proc.stdin.flush()
             time.sleep(delay)
 
+    def flush(self) -> None:
+        self._proc.stdin.flush()
+
     @property
     def retcode(self) -> int:
-        self._proc.stdin.flush()
+        self.flush()
         return self.wait()
 
-    def _assert_retcode(self) -> None:
-        if self._retcode is None:
-            raise AssertionError(
-                "'InteractiveSession.wait()' must be called " + " before accessing captured output."
-            )
-
     def wait(self, timeout=1) -> int:
         if self._retcode is not None:
             return self._retcode
@@ -175,79 +640,366 @@ class InteractiveSession:
         returncode: typ.Optional[int] = None
         try:
             self._proc.stdin.close()
-            max_time = self.start + timeout
-            while returncode is None and max_time > time.time():
-                time_left = max_time - time.time()
-                # print("poll", max_time - time.time())
-                log.debug(f"poll {time_left}")
-                time.sleep(min(0.01, max(0, time_left)))
-                returncode = self._proc.poll()
+            time_left  = self.start + timeout - time.time()
+            returncode = _wait_for_exit(self._proc, max(0, time_left))
         finally:
             if self._proc.returncode is None:
                 log.debug("sending SIGTERM")
                 self._proc.terminate()
                 returncode = self._proc.wait()
 
-        self._out_ct.thread.join()
-        self._err_ct.thread.join()
+        for reader in self._readers:
+            reader.join()
         assert returncode is not None
         self._retcode = returncode
         self.end      = time.time()
         return returncode
 
-    @property
-    def out_lines(self) -> typ.List[RawCapturedLine]:
-        return self._out_ct.lines
 
-    @property
-    def err_lines(self) -> typ.List[RawCapturedLine]:
-        return self._err_ct.lines
+# NOTE: A persistent session runs the code of
+#   multiple blocks in one process. After the code of a block,
+#   a command is sent that writes a marker line with the exit
+#   status of the block to both stdout and stderr. The lines up
+#   to the markers are the output of the block.
+#
+#   A plain "python3" only executes its script after stdin is
+#   closed, so python runs a driver which executes the code of
+#   each block as soon as its marker line is received.
+
+PYTHON_DRIVER_SRC = r'''
+import sys
+import traceback
+
+marker_prefix = sys.argv[1]
+namespace     = {"__name__": "__main__", "__builtins__": __builtins__}
+source_lines  = []
+
+for line in iter(sys.stdin.readline, ""):
+    if not line.startswith(marker_prefix):
+        source_lines.append(line)
+        continue
+
+    status = 0
+    try:
+        exec(compile("".join(source_lines), "<stdin>", "exec"), namespace)
+    except SystemExit:
+        raise
+    except BaseException as ex:
+        # skip the frame of the driver
+        traceback.print_exception(type(ex), ex, ex.__traceback__.tb_next)
+        status = 1
+
+    source_lines = []
+    marker       = "%s %d\n" % (line.strip(), status)
+    for stream in (sys.stdout, sys.stderr):
+        stream.write(marker)
+        stream.flush()
+'''
+
+SHELL_NAMES = {'sh', 'bash', 'dash', 'zsh', 'ksh'}
+
+
+class _Language(typ.NamedTuple):
+    cmd_parts : typ.List[str]
+    end_marker: typ.Callable[[str], str]
+
+
+def _shell_end_marker(marker: str) -> str:
+    return (
+        "__lp_status=$?\n"
+        f'echo "{marker} $__lp_status"\n'
+        f'echo "{marker} $__lp_status" >&2\n'
+    )
+
+
+def _python_end_marker(marker: str) -> str:
+    return marker + "\n"
 
-    def iter_lines(self) -> typ.Iterable[CapturedLine]:
-        out_lines = iter(self.out_lines)
-        err_lines = iter(self.err_lines)
-        ol        = next(out_lines, None)
-        el        = next(err_lines, None)
 
+def _persistent_language(cmd_parts: typ.List[str], marker_prefix: str) -> _Language:
+    exe_name = os.path.basename(cmd_parts[0]) if cmd_parts else ""
+    if exe_name in SHELL_NAMES:
+        return _Language(cmd_parts, _shell_end_marker)
+    elif litprog.forkserver.PYTHON_EXE_RE.match(exe_name) and len(cmd_parts) == 1:
+        driver_parts = cmd_parts + ["-u", "-c", PYTHON_DRIVER_SRC, marker_prefix]
+        return _Language(driver_parts, _python_end_marker)
+    else:
+        cmd_str = " ".join(cmd_parts)
+        err_msg = (
+            f"Invalid command for a persistent session: '{cmd_str}'. "
+            f"Must be a python interpreter or one of {', '.join(sorted(SHELL_NAMES))}."
+        )
+        raise SessionException(err_msg)
+
+
+class BlockOutput(typ.NamedTuple):
+    exit_status : int
+    runtime     : float
+    lines       : typ.List[CapturedLine]
+    is_truncated: bool
+
+
+def _marker_status(lines: BoundedLines, marker: str) -> typ.Optional[int]:
+    last_cl = lines.last
+    if last_cl is None:
+        return None
+
+    idx = last_cl.line.find(marker + " ")
+    if idx < 0:
+        return None
+
+    try:
+        return int(last_cl.line[idx + len(marker) :].strip())
+    except ValueError:
+        return None
+
+
+def _wait_for_marker(lines: BoundedLines, marker: str, deadline: float) -> typ.Optional[int]:
+    with lines.cond:
         while True:
-            if ol and el:
-                if ol.ts <= el.ts:
-                    yield CapturedLine(ol.ts, ol.line, False)
-                    ol = next(out_lines, None)
-                else:
-                    yield CapturedLine(el.ts, el.line, True)
-                    el = next(err_lines, None)
-            elif el:
-                yield CapturedLine(el.ts, el.line, True)
-                el = next(err_lines, None)
-            elif ol:
-                yield CapturedLine(ol.ts, ol.line, False)
-                ol = next(out_lines, None)
-            else:
-                break
+            status = _marker_status(lines, marker)
+            if status is not None or lines.is_closed:
+                return status
 
-    def iter_stdout(self) -> typ.Iterable[str]:
-        for ts, line in self._out_ct.lines:
-            yield line
+            time_left = deadline - time.time()
+            if time_left <= 0:
+                return None
+            lines.cond.wait(time_left)
 
-    def iter_stderr(self) -> typ.Iterable[str]:
-        for ts, line in self._err_ct.lines:
-            yield line
 
-    def __iter__(self) -> typ.Iterable[str]:
-        all_lines = self._in_cl + self._out_ct.lines + self._err_ct.lines
-        for captured_line in sorted(all_lines):
-            yield captured_line.line
+def _take_block_lines(lines: BoundedLines, marker: str, has_marker: bool) -> BoundedLines:
+    taken = lines.take()
+    if has_marker:
+        marker_cl = taken.pop_last()
+        assert marker_cl is not None
+        # output of the block without a trailing newline
+        prefix = marker_cl.line[: marker_cl.line.find(marker)]
+        if prefix:
+            taken.append(RawCapturedLine(marker_cl.ts, prefix))
+    return taken
 
-    @property
-    def runtime(self) -> float:
-        self._assert_retcode()
-        return self.end - self.start
 
-    @property
-    def stdout(self) -> str:
-        return "".join(self.iter_stdout())
+class PersistentSession:
+    """A process which runs the code of multiple blocks in sequence.
 
-    @property
-    def stderr(self) -> str:
-        return "".join(self.iter_stderr())
+    State (variables, the working directory, etc.) is kept
+    from one block to the next. The output of each block is
+    captured separately, up to max_lines and max_bytes.
+
+    If the process exits or a block times out, the process is
+    restarted (with fresh state) for the next block.
+    """
+
+    command  : AnyCommand
+    encoding : str
+    max_lines: typ.Optional[int]
+    max_bytes: typ.Optional[int]
+
+    _language     : _Language
+    _marker_prefix: str
+    _n_blocks     : int
+    _isession     : typ.Optional[InteractiveSession]
+
+    def __init__(
+        self,
+        cmd      : AnyCommand,
+        *,
+        encoding : str = "utf-8",
+        max_lines: typ.Optional[int] = None,
+        max_bytes: typ.Optional[int] = None,
+    ) -> None:
+        self.command   = cmd
+        self.encoding  = encoding
+        self.max_lines = max_lines
+        self.max_bytes = max_bytes
+
+        self._marker_prefix = f"__litprog_session_{os.getpid()}_{id(self)}_"
+        self._language      = _persistent_language(_normalize_command(cmd), self._marker_prefix)
+        self._n_blocks      = 0
+        self._isession      = None
+
+    def _session(self) -> InteractiveSession:
+        if self._isession is None:
+            # NOTE: The marker line is captured too, but it is
+            #   removed from the output of a block.
+            max_lines      = None if self.max_lines is None else self.max_lines + 1
+            self._isession = InteractiveSession(
+                self._language.cmd_parts,
+                encoding=self.encoding,
+                max_lines=max_lines,
+                max_bytes=self.max_bytes,
+            )
+        return self._isession
+
+    def run(
+        self, input_lines: typ.Sequence[str], timeout: float = 1, delay: float = 0
+    ) -> BlockOutput:
+        """Send the code of a block and wait for its output."""
+        self._n_blocks += 1
+        marker   = f"{self._marker_prefix}{self._n_blocks}"
+        isession = self._session()
+        start    = time.time()
+
+        try:
+            for line in input_lines:
+                isession.send(line, delay=delay)
+            # NOTE: The newline terminates the last line of the
+            #   block, in case it has none.
+            isession.send("\n" + self._language.end_marker(marker))
+            isession.flush()
+        except BrokenPipeError:
+            log.debug("process exited before the block was sent")
+
+        deadline   = start + timeout
+        out_status = _wait_for_marker(isession._out_lines, marker, deadline)
+        err_status = _wait_for_marker(isession._err_lines, marker, deadline)
+
+        exit_status: int
+        if out_status is None or err_status is None:
+            # the process exited or timed out
+            exit_status    = isession.wait(timeout=0)
+            self._isession = None
+        else:
+            exit_status = out_status
+
+        out_lines = _take_block_lines(isession._out_lines, marker, out_status is not None)
+        err_lines = _take_block_lines(isession._err_lines, marker, err_status is not None)
+        return BlockOutput(
+            exit_status=exit_status,
+            runtime=time.time() - start,
+            lines=list(_iter_merged_lines(out_lines, err_lines)),
+            is_truncated=out_lines.is_truncated or err_lines.is_truncated,
+        )
+
+    def close(self, timeout: float = 1) -> typ.Optional[int]:
+        """Close stdin and wait for the process to exit."""
+        isession = self._isession
+        if isession is None:
+            return None
+
+        self._isession = None
+        # NOTE: InteractiveSession.wait measures the timeout from
+        #   the start of the process.
+        return isession.wait(timeout=time.time() - isession.start + timeout)
+
+
+# NOTE: An asyncio.StreamReader has a limit on
+#   the length of a line (64KiB by default). Longer lines are
+#   read in parts of this size.
+ASYNC_STREAM_LIMIT = 64 * 1024
+
+
+async def _async_read_loop(
+    stream        : asyncio.StreamReader,
+    captured_lines: BoundedLines,
+    encoding      : str = "utf-8",
+) -> None:
+    decoder = codecs.getincrementaldecoder(encoding)()
+    while True:
+        try:
+            raw_line = await stream.readuntil(b"\n")
+        except asyncio.IncompleteReadError as ex:
+            raw_line = ex.partial
+        except asyncio.LimitOverrunError as ex:
+            raw_line = await stream.read(ex.consumed)
+
+        if not raw_line:
+            break
+
+        ts         = time.time()
+        line_value = decoder.decode(raw_line)
+        log.debug(f"read {len(raw_line)} bytes")
+        captured_lines.append(RawCapturedLine(ts, line_value))
+    captured_lines.close()
+
+
+class AsyncInteractiveSession(_SessionBase):
+    """Like InteractiveSession, but driven by an asyncio event loop.
+
+    No threads are started, so many sessions can run concurrently
+    on a single event loop.
+
+    Usage:
+        session = await AsyncInteractiveSession.create(["python"])
+        await session.send("print('hello')\n")
+        retcode = await session.wait(timeout=1)
+        print(session.stdout)
+    """
+
+    _proc     : asyncio.subprocess.Process
+    _read_task: typ.Awaitable[typ.Any]
+
+    @classmethod
+    async def create(
+        cls,
+        cmd      : AnyCommand,
+        *,
+        env      : typ.Optional[Environ] = None,
+        encoding : str = "utf-8",
+        max_lines: typ.Optional[int] = None,
+        max_bytes: typ.Optional[int] = None,
+    ) -> 'AsyncInteractiveSession':
+        _env: Environ
+        if env is None:
+            _env = os.environ.copy()
+        else:
+            _env = env
+
+        self = cls()
+        self.encoding = encoding
+        self.start    = time.time()
+        self.end      = -1.0
+        self._retcode = None
+
+        cmd_parts = _normalize_command(cmd)
+        log.debug(f"create_subprocess_exec {cmd_parts}")
+        self._proc = await asyncio.create_subprocess_exec(
+            *cmd_parts,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            env=_env,
+            limit=ASYNC_STREAM_LIMIT,
+        )
+
+        self._in_cl     = []
+        self._out_lines = BoundedLines(max_lines=max_lines, max_bytes=max_bytes)
+        self._err_lines = BoundedLines(max_lines=max_lines, max_bytes=max_bytes)
+        self._read_task = asyncio.gather(
+            _async_read_loop(self._proc.stdout, self._out_lines, encoding),
+            _async_read_loop(self._proc.stderr, self._err_lines, encoding),
+        )
+        return self
+
+    async def send(self, input_str: str, delay: float = 0) -> None:
+        self._in_cl.append(RawCapturedLine(time.time(), input_str))
+        input_data = input_str.encode(self.encoding)
+        log.debug(f"sending {len(input_data)} bytes")
+        self._proc.stdin.write(input_data)
+        await self._proc.stdin.drain()
+        if delay:
+            await asyncio.sleep(delay)
+
+    async def wait(self, timeout: float = 1) -> int:
+        if self._retcode is not None:
+            return self._retcode
+
+        log.debug(f"wait with timeout={timeout}")
+        try:
+            self._proc.stdin.close()
+            time_left = self.start + timeout - time.time()
+            await asyncio.wait_for(self._proc.wait(), max(0, time_left))
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            if self._proc.returncode is None:
+                log.debug("sending SIGTERM")
+                self._proc.terminate()
+                await self._proc.wait()
+
+        await self._read_task
+        returncode = self._proc.returncode
+        assert returncode is not None
+        self._retcode = returncode
+        self.end      = time.time()
+        return returncode
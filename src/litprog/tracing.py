@@ -0,0 +1,153 @@
+# This file is part of the litprog project
+# https://gitlab.com/mbarkhau/litprog
+#
+# Copyright (c) 2020 Manuel Barkhau (mbarkhau@gmail.com) - MIT License
+# SPDX-License-Identifier: MIT
+"""Record how long the phases of a build take.
+
+Spans are written in the Chrome trace event format, which can be
+viewed with chrome://tracing or https://ui.perfetto.dev
+
+https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU
+
+Recording is disabled by default, in which case span() only
+returns a shared no-op context manager.
+"""
+import os
+import json
+import time
+import typing as typ
+import logging
+import threading
+import contextlib
+
+import pathlib2 as pl
+
+log = logging.getLogger(__name__)
+
+
+TraceEvent = typ.Dict[str, typ.Any]
+
+
+class Recorder:
+
+    events: typ.List[TraceEvent]
+
+    _lock : threading.Lock
+    _start: float
+    _tids : typ.Dict[int, int]
+
+    def __init__(self) -> None:
+        self.events = []
+        self._lock  = threading.Lock()
+        self._start = time.perf_counter()
+        self._tids  = {}
+
+    def _tid(self) -> int:
+        # NOTE: Thread idents are large and reused,
+        #   small sequential ids are easier to read in the viewer.
+        thread = threading.current_thread()
+        ident  = threading.get_ident()
+        with self._lock:
+            tid = self._tids.get(ident)
+            if tid is None:
+                tid = len(self._tids)
+                self._tids[ident] = tid
+                self.events.append(
+                    {
+                        'name': "thread_name",
+                        'ph'  : "M",
+                        'pid' : os.getpid(),
+                        'tid' : tid,
+                        'args': {'name': thread.name},
+                    }
+                )
+        return tid
+
+    def add_span(
+        self, name: str, cat: str, start: float, end: float, args: typ.Dict[str, typ.Any]
+    ) -> None:
+        # NOTE: timestamps and durations are in microseconds
+        event = {
+            'name': name,
+            'cat' : cat,
+            'ph'  : "X",
+            'ts'  : round((start - self._start) * 1_000_000, 3),
+            'dur' : round((end   - start      ) * 1_000_000, 3),
+            'pid' : os.getpid(),
+            'tid' : self._tid(),
+        }
+        if args:
+            event['args'] = {key: str(val) for key, val in args.items()}
+
+        with self._lock:
+            self.events.append(event)
+
+    def dump(self, path: pl.Path) -> None:
+        with self._lock:
+            events = sorted(self.events, key=lambda event: event.get('ts', -1))
+
+        trace = {'traceEvents': events, 'displayTimeUnit': "ms"}
+        with path.open(mode="w", encoding="utf-8") as fobj:
+            json.dump(trace, fobj, indent=None, separators=(",", ":"))
+
+
+_recorder: typ.Optional[Recorder] = None
+
+
+def start() -> Recorder:
+    """Start recording spans (discarding any previous recording)."""
+    global _recorder
+    _recorder = Recorder()
+    return _recorder
+
+
+def stop(path: typ.Optional[pl.Path] = None) -> typ.Optional[Recorder]:
+    """Stop recording and write the trace to path (if given)."""
+    global _recorder
+    recorder  = _recorder
+    _recorder = None
+    if recorder and path:
+        recorder.dump(path)
+        log.info(f"Wrote trace with {len(recorder.events)} events to '{path}'")
+    return recorder
+
+
+def is_enabled() -> bool:
+    return _recorder is not None
+
+
+class _NoopSpan:
+    def __enter__(self) -> None:
+        return None
+
+    def __exit__(self, *exc_info: typ.Any) -> None:
+        return None
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+@contextlib.contextmanager
+def _span(
+    recorder: Recorder, name: str, cat: str, args: typ.Dict[str, typ.Any]
+) -> typ.Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        recorder.add_span(name, cat, start, time.perf_counter(), args)
+
+
+def span(name: str, cat: str = "build", **args: typ.Any) -> typ.ContextManager[None]:
+    """Record the duration of a with block.
+
+    Usage:
+        with tracing.span("gen_html", path=md_file.md_path):
+            ...
+    """
+    recorder = _recorder
+    if recorder is None:
+        return _NOOP_SPAN
+    else:
+        return _span(recorder, name, cat, args)
@@ -0,0 +1,28 @@
+# This file is part of the litprog project
+# https://gitlab.com/mbarkhau/litprog
+#
+# Copyright (c) 2020 Manuel Barkhau (mbarkhau@gmail.com) - MIT License
+# SPDX-License-Identifier: MIT
+import random
+
+import litprog.aho_corasick as sut
+
+
+def test_iter_matches():
+    automaton = sut.Automaton(["he", "she", "his", "hers", ""])
+    matches   = sorted(automaton.iter_matches("ushers"))
+    assert matches == [(4, 0), (4, 1), (6, 3)]
+    assert automaton.find_present("ushers") == {0, 1, 3, 4}
+
+
+def test_find_present_fuzz():
+    rnd = random.Random(0)
+    for _ in range(1000):
+        patterns = [
+            "".join(rnd.choice("abc") for _ in range(rnd.randint(0, 4)))
+            for _ in range(rnd.randint(1, 6))
+        ]
+        text      = "".join(rnd.choice("abcd") for _ in range(rnd.randint(0, 30)))
+        automaton = sut.Automaton(patterns)
+        expected  = {idx for idx, pattern in enumerate(patterns) if pattern in text}
+        assert automaton.find_present(text) == expected
@@ -0,0 +1,473 @@
+# This file is part of the litprog project
+# https://gitlab.com/mbarkhau/litprog
+#
+# Copyright (c) 2020 Manuel Barkhau (mbarkhau@gmail.com) - MIT License
+# SPDX-License-Identifier: MIT
+import os
+
+import pytest
+import pathlib2 as pl
+
+import litprog.parse
+import litprog.build as sut
+
+SESSIONS_A = """
+```bash
+# lp_run: echo one
+```
+
+```bash
+# lp_make: out/gen.txt
+# lp_run: bash
+echo gen > out/gen.txt
+```
+
+```bash
+# lp_run: cat out/gen.txt
+```
+"""
+
+SESSIONS_B = """
+```bash
+# lp_run: echo independent
+```
+
+```bash
+# lp_deps: out/gen.txt
+# lp_run: cat out/gen.txt
+```
+"""
+
+
+def _parse_test_context(tmpdir, **contents):
+    md_paths = []
+    for name, content in sorted(contents.items()):
+        md_path = pl.Path(str(tmpdir)) / f"{name}.md"
+        md_path.write_text(content, encoding="utf-8")
+        md_paths.append(md_path)
+    return litprog.parse.parse_context(md_paths)
+
+
+def test_session_graph(tmpdir):
+    ctx   = _parse_test_context(tmpdir, a=SESSIONS_A, b=SESSIONS_B)
+    graph = sut._init_session_graph(ctx)
+
+    deps = {key: set(task.deps) for key, task in graph.tasks.items()}
+    assert deps == {
+        (0, 1): set(),
+        (0, 3): {(0, 1)},
+        (0, 5): {(0, 3)},
+        (1, 1): set(),
+        (1, 3): {(0, 3)},
+    }
+
+
+CACHED_SESSION = """
+```bash
+# lp_run: bash
+echo run >> runs.log
+echo hello
+```
+
+```
+# lp_out
+```
+"""
+
+
+def test_capture_cache(tmpdir, monkeypatch, caplog):
+    monkeypatch.chdir(str(tmpdir))
+    cache_dir = pl.Path(str(tmpdir)) / "cache"
+
+    ctx = _parse_test_context(tmpdir, a=CACHED_SESSION)
+    out_ctx_1 = sut.build(ctx, cache_dir=cache_dir)
+    assert "Reused the cached output" not in caplog.text
+    out_ctx_2 = sut.build(ctx, cache_dir=cache_dir)
+    assert "Reused the cached output of 1 sessions" in caplog.text
+
+    assert "hello" in str(out_ctx_1.files[0])
+    assert str(out_ctx_1.files[0]) == str(out_ctx_2.files[0])
+    assert pl.Path("runs.log").read_text(encoding="utf-8") == "run\n"
+    assert len(list((cache_dir / "captures").iterdir())) == 1
+
+    sut.build(ctx)
+    assert pl.Path("runs.log").read_text(encoding="utf-8") == "run\nrun\n"
+
+
+def test_build_concurrent_files(tmpdir, monkeypatch):
+    monkeypatch.chdir(str(tmpdir))
+    session  = "\n```bash\n# lp_run: echo {0}\n```\n\n```shell\n# lp_out\n```\n"
+    contents = {f"chapter{i}": session.format(i) for i in range(6)}
+    ctx      = _parse_test_context(tmpdir, **contents)
+
+    out_ctx = sut.build(ctx, jobs=4)
+    for i, md_file in enumerate(out_ctx.files):
+        file_content = md_file.md_path.read_text(encoding="utf-8")
+        assert str(md_file) == file_content
+        assert f"\n{i}\n" in file_content
+
+
+def test_write_back_before_failed_file(tmpdir, monkeypatch):
+    monkeypatch.chdir(str(tmpdir))
+    session = "\n```bash\n# lp_run: echo ok\n```\n\n```shell\n# lp_out\n```\n"
+    failing = "\n```shell\n# lp_out: litprog_missing_command\n```\n"
+    ctx     = _parse_test_context(tmpdir, a=session, b=failing)
+
+    with pytest.raises(FileNotFoundError):
+        sut.build(ctx)
+
+    a_content = ctx.files[0].md_path.read_text(encoding="utf-8")
+    assert "\nok\n" in a_content
+
+
+TRUNCATED_SESSION = """
+```bash
+# lp_run: bash
+seq 1 100
+```
+
+```shell
+# lp_out
+# lp_max_lines: 4
+```
+"""
+
+
+def test_truncated_capture(tmpdir, monkeypatch):
+    monkeypatch.chdir(str(tmpdir))
+    ctx     = _parse_test_context(tmpdir, a=TRUNCATED_SESSION)
+    out_ctx = sut.build(ctx)
+
+    out_block = out_ctx.files[0].blocks[1]
+    assert out_block.inner_content.strip().splitlines() == [
+        "1",
+        "2",
+        "[... 96 lines omitted ...]",
+        "99",
+        "100",
+        "# exit:   0",
+    ]
+
+
+def test_truncate_lines():
+    lines = [sut.CapturedLine(float(i), f"{i}\n", False) for i in range(10)]
+    # marker for lines omitted during the capture
+    lines[5] = sut.CapturedLine(5.0, "", False, 20)
+
+    assert sut._truncate_lines(lines, None, None) == lines
+    assert sut._truncate_lines(lines, 9, None) == lines
+
+    truncated = sut._truncate_lines(lines, 4, None)
+    assert [cl.line for cl in truncated] == ["0\n", "1\n", "", "8\n", "9\n"]
+    assert truncated[2].n_omitted == 25
+    assert truncated[2].ts        == 2.0
+
+    truncated = sut._truncate_lines(lines, None, 8)
+    assert [cl.line for cl in truncated] == ["0\n", "1\n", "", "8\n", "9\n"]
+
+
+PERSISTENT_SESSION = """
+```python
+# lp_run: python3
+# lp_session: tutorial
+x = 41
+```
+
+```python
+# lp_run: python3
+# lp_session: tutorial
+x += 1
+print(x)
+```
+
+```python
+# lp_out
+```
+"""
+
+
+def test_persistent_session(tmpdir, monkeypatch):
+    monkeypatch.chdir(str(tmpdir))
+    cache_dir = pl.Path(str(tmpdir)) / "cache"
+    ctx       = _parse_test_context(tmpdir, a=PERSISTENT_SESSION)
+
+    graph = sut._init_session_graph(ctx)
+    keys  = list(graph.tasks)
+    assert graph.tasks[keys[1]].deps == {keys[0]}
+
+    out_ctx   = sut.build(ctx, jobs=2, cache_dir=cache_dir)
+    out_block = out_ctx.files[0].blocks[2]
+    assert out_block.inner_content.strip().splitlines() == ["42", "# exit:   0"]
+    assert not (cache_dir / "captures").exists()
+
+    # listed by plan, but not out of date
+    stale = sut.plan(ctx, cache_dir=cache_dir)
+    assert len(stale) == 2
+    assert all(s.is_always_run for s in stale)
+
+
+PLANNED_SESSION = """
+```python
+# lp_file: out/a.py
+print("a")
+```
+
+```bash
+# lp_deps: dep.txt
+# lp_run: cat dep.txt
+```
+"""
+
+
+def test_plan(tmpdir, monkeypatch):
+    monkeypatch.chdir(str(tmpdir))
+    cache_dir = pl.Path(str(tmpdir)) / "cache"
+    dep_path  = pl.Path("dep.txt")
+    dep_path.write_text("one\n", encoding="utf-8")
+
+    ctx     = _parse_test_context(tmpdir, a=PLANNED_SESSION)
+    md_path = ctx.files[0].md_path
+    stale   = sut.plan(ctx, cache_dir=cache_dir)
+    assert [(s.kind, s.target, s.reason) for s in stale] == [
+        ('lp_file', "out/a.py"    , "missing output"),
+        ('session', f"{md_path}:7", "depends on lp_file out/a.py"),
+    ]
+    assert not pl.Path("out").exists()
+    assert not cache_dir.exists()
+
+    sut.build(ctx, cache_dir=cache_dir)
+    index_path = cache_dir / sut.INDEX_FILENAME
+    os.utime(str(index_path), (1000, 1000))
+    assert sut.plan(ctx, cache_dir=cache_dir) == []
+    assert index_path.stat().st_mtime == 1000
+
+    dep_path.write_text("two\n", encoding="utf-8")
+    stale = sut.plan(ctx, cache_dir=cache_dir)
+    assert [(s.kind, s.reason) for s in stale] == [('session', "changed dependency dep.txt")]
+
+    stale = sut.plan(ctx, cache_dir=cache_dir, html_dir=pl.Path("html"))
+    assert [(s.kind, s.target) for s in stale][-1] == ('html', "html/a.html")
+
+
+def test_dump_files_unchanged(tmpdir, monkeypatch):
+    monkeypatch.chdir(str(tmpdir))
+    ctx = _parse_test_context(tmpdir, a="```python\n# lp_file: out/a.py\nprint(1)\n```\n")
+
+    inner_content = ctx.files[0].blocks[0].inner_content
+    assert "print(1)" in inner_content
+
+    sut._dump_files(ctx)
+    out_path = pl.Path("out/a.py")
+    assert out_path.read_text(encoding="utf-8") == inner_content
+
+    os.utime(str(out_path), (1000, 1000))
+    sut._dump_files(ctx)
+    assert out_path.stat().st_mtime == 1000
+
+    out_path.write_text("print(2)\n", encoding="utf-8")
+    sut._dump_files(ctx)
+    assert out_path.read_text(encoding="utf-8") == inner_content
+    assert sorted(p.name for p in out_path.parent.iterdir()) == ["a.py"]
+
+
+NESTED_ADDS = """
+```python
+def outer():
+    # lp_add: def inner
+```
+
+```python
+def inner():
+    # lp_add: def leaf
+```
+
+```python
+def leaf():
+    pass
+```
+
+```python
+# lp_add: def outer
+```
+
+```python
+# lp_add: cycle_a
+cycle_b = 1
+```
+
+```python
+# lp_add: cycle_b
+cycle_a = 1
+```
+"""
+
+
+# The same directive is expanded to the same block twice, from two
+# different directives, which is not a recursion.
+REPEATED_ADDS = """
+```python
+# lp_add: delta
+# lp_run: true
+# lp_add: alpha
+x='beta'
+```
+
+```python
+x='delta' # gamma
+# lp_run: true
+# lp_add: delta
+```
+
+```python
+# lp_add: beta
+    # lp_add: gamma
+x='gamma'
+```
+
+```python
+x='gamma'
+x='eps'
+    # lp_add: gamma
+x='alpha' # delta
+```
+
+```
+x='alpha' # beta
+x='eps'
+```
+
+```
+x='delta' # gamma
+# lp_add: eps
+    # lp_add: beta
+```
+"""
+
+
+def test_expand_add_directives(tmpdir, caplog):
+    ctx     = _parse_test_context(tmpdir, a=NESTED_ADDS, b=REPEATED_ADDS)
+    md_file = sut._expand_file_add_directives(ctx.files[0])
+    blocks  = md_file.blocks
+
+    assert blocks[3].inner_content.split() == [
+        "def", "outer():", "def", "inner():", "def", "leaf():", "pass"
+    ]
+    assert "lp_add" not in blocks[0].directive_index
+    assert [d.value for d in blocks[4].directive_index['lp_add']] == ["cycle_a"]
+    assert "Cyclic lp_add directives" in caplog.text
+
+    md_file = sut._expand_file_add_directives(ctx.files[1])
+    blocks  = md_file.blocks
+    assert blocks[2].inner_content.splitlines() == [
+        "",
+        "x='alpha' # beta",
+        "x='eps'",
+        "    x='delta' # gamma",
+        "    x='alpha' # beta",
+        "    x='eps'",
+        "        x='alpha' # beta",
+        "        x='eps'",
+        "x='gamma'",
+    ]
+
+
+# The directive of the block without a language is parsed when it
+# is included, and the same directive is repeated, so that it is
+# replaced with an indented copy of itself.
+SELF_ADDS = """
+```
+    # lp_add: zeta
+```
+
+```python
+# lp_add: zeta
+# lp_add: zeta
+```
+"""
+
+
+def test_expand_self_add_directives(tmpdir, caplog):
+    ctx     = _parse_test_context(tmpdir, a=SELF_ADDS)
+    md_file = sut._expand_file_add_directives(ctx.files[0])
+
+    assert "Recursive lp_add directive" in caplog.text
+    assert "lp_add" in md_file.blocks[1].directive_index
+
+
+def test_expand_add_directives_max_rounds(tmpdir, monkeypatch):
+    monkeypatch.setattr(sut, '_is_recursive', lambda includes, ancestries: False)
+    ctx = _parse_test_context(tmpdir, a=SELF_ADDS)
+
+    with pytest.raises(Exception, match="did not terminate"):
+        sut._expand_file_add_directives(ctx.files[0])
+
+
+def test_addable_index_prefetch(tmpdir, monkeypatch):
+    monkeypatch.setattr(sut, 'MIN_AUTOMATON_QUERIES', 0)
+
+    contents = [f"```python\ndef f{i}():\n    return {i % 7}\n```\n" for i in range(20)]
+    ctx      = _parse_test_context(tmpdir, a="\n".join(contents))
+    blocks   = ctx.files[0].blocks
+    queries  = [f"return {i}" for i in range(8)] + ["def f1", "def f19", "missing", ""]
+
+    index_a = sut._AddableIndex()
+    index_b = sut._AddableIndex()
+    for block in blocks[:10]:
+        index_a.add(block)
+        index_b.add(block)
+
+    for new_blocks in [blocks[15:], blocks[10:15]]:
+        index_a.next_gen()
+        index_b.next_gen()
+        index_b.prefetch(queries)
+        for query in queries:
+            assert index_a.find(query) == index_b.find(query)
+
+        for block in new_blocks:
+            index_a.add(block)
+            index_b.add(block)
+
+
+CONSTANTS_A = """
+Maximum: `lp_const: MAX_FIB = 20` and `lp_const: MAX = 3`
+
+```python
+print(MAX_FIB, MAX, MAXIMUM, GREETING)
+```
+"""
+
+CONSTANTS_B = """
+Shadowed: `lp_const: MAX = 4` and `lp_const: GREETING = hello`
+
+```python
+print(MAX_FIB, MAX, GREETING)
+```
+"""
+
+
+def test_expand_constants(tmpdir):
+    ctx = _parse_test_context(tmpdir, a=CONSTANTS_A, b=CONSTANTS_B)
+    ctx = sut._expand_constants(ctx)
+
+    block_a, = ctx.files[0].blocks
+    block_b, = ctx.files[1].blocks
+    assert block_a.inner_content.strip() == "print(20, 3, MAXIMUM, hello)"
+    assert block_b.inner_content.strip() == "print(20, 4, hello)"
+
+
+CONSTANT_SESSION = """
+Greeting: `lp_const: GREETING = hello`
+
+```shell
+# lp_out: echo GREETING
+```
+"""
+
+
+def test_write_back_constant_header(tmpdir, monkeypatch):
+    monkeypatch.chdir(str(tmpdir))
+    ctx = _parse_test_context(tmpdir, a=CONSTANT_SESSION)
+    sut.build(ctx)
+
+    content = ctx.files[0].md_path.read_text(encoding="utf-8")
+    assert "# lp_out: echo GREETING\nhello\n# exit:   0\n" in content
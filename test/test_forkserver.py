@@ -0,0 +1,58 @@
+# This file is part of the litprog project
+# https://gitlab.com/mbarkhau/litprog
+#
+# Copyright (c) 2020 Manuel Barkhau (mbarkhau@gmail.com) - MIT License
+# SPDX-License-Identifier: MIT
+import sys
+
+import pytest
+
+import litprog.session
+import litprog.forkserver as sut
+
+pytestmark = pytest.mark.skipif(
+    not sut.IS_FORK_SERVER_AVAILABLE, reason="fork server requires fork and unix sockets"
+)
+
+
+def test_python_exe():
+    assert sut.python_exe("python3")
+    assert sut.python_exe("python3 -u"      ) is None
+    assert sut.python_exe("python3 out/a.py") is None
+    assert sut.python_exe("bash"            ) is None
+
+
+SCRIPT = """
+import sys
+import json
+print(__name__, sys.argv, "json" in sys.modules)
+sys.stderr.write("warn\\n")
+raise ValueError("boom")
+"""
+
+
+def test_fork_server():
+    server = sut.ForkServer(sys.executable, preload=["json"])
+    try:
+        session = litprog.session.InteractiveSession(sys.executable, fork_server=server)
+        session.send(SCRIPT)
+        assert session.wait(timeout=5) == 1
+        assert session.stdout == "__main__ [''] True\n"
+        assert session.stderr.startswith("warn\nTraceback (most recent call last):\n")
+        assert session.stderr.endswith("ValueError: boom\n")
+        assert "_run_worker" not in session.stderr
+
+        session = litprog.session.InteractiveSession(sys.executable, fork_server=server)
+        session.send("import sys\nsys.exit(7)\n")
+        assert session.wait(timeout=5) == 7
+
+        session = litprog.session.InteractiveSession(sys.executable, fork_server=server)
+        session.send("import time\ntime.sleep(5)\n")
+        assert session.wait(timeout=0.2) < 0
+    finally:
+        server.close()
+
+
+def test_fork_server_error():
+    with pytest.raises(sut.ForkServerError):
+        sut.ForkServer(sys.executable, preload=["litprog_no_such_module"])
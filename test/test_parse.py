@@ -21,3 +21,239 @@ def test_fs_scanning():
     assert len(lit_paths) > 0
     assert all(isinstance(p, pl.Path) for p in lit_paths)
     assert all(p.suffix == ".md" for p in lit_paths)
+
+
+TOKENIZER_TEXT = """# Headline # with trailing text
+---
+
+Paragraph text.
+
+```python
+# lp_run: python3
+print("hello")
+```
+
+Setext Headline
+===============
+
+~~~
+unclosed tilde block
+"""
+
+
+def test_iter_raw_md_elements():
+    raw_elems = list(sut._iter_raw_md_elements(TOKENIZER_TEXT))
+
+    md_types = [raw_elem.md_type for raw_elem in raw_elems]
+    assert md_types == [
+        'headline',
+        'headline',
+        'paragraph',
+        'block',
+        'paragraph',
+        'headline',
+        'paragraph',
+        'block',
+    ]
+
+    # elements are contiguous and cover the content byte for byte
+    assert raw_elems[0].start == 0
+    assert raw_elems[-1].end  == len(TOKENIZER_TEXT)
+    for prev_elem, elem in zip(raw_elems, raw_elems[1:]):
+        assert prev_elem.end == elem.start
+
+    for raw_elem in raw_elems:
+        elem_content = TOKENIZER_TEXT[raw_elem.start : raw_elem.end]
+        prefix       = TOKENIZER_TEXT[: raw_elem.start]
+        assert raw_elem.first_line == prefix.count("\n") + 1
+        assert elem_content
+
+
+def test_block_tables_are_memoized(tmpdir):
+    md_path = pl.Path(str(tmpdir)) / "test.md"
+    md_path.write_text(TOKENIZER_TEXT, encoding="utf-8")
+
+    md_file = sut.MarkdownFile(md_path)
+    blocks  = md_file.blocks
+    assert md_file.blocks is blocks
+    assert md_file.headlines is md_file.headlines
+    assert [b.info_string for b in blocks] == ["python", ""]
+
+    run_block = blocks[0]
+    assert [d.name for d in run_block.directives] == ['lp_language', 'lp_run']
+
+    # blocks of unchanged elements are shared with copies
+    md_file_copy = md_file.copy()
+    assert md_file_copy.blocks[0] is run_block
+
+    # replacing elements invalidates the tables
+    md_file.elements = md_file.elements[:1]
+    assert md_file.blocks == []
+    assert len(md_file.headlines) == 1
+
+
+def test_parse_context_jobs(tmpdir):
+    md_paths = []
+    for i in range(5):
+        md_path = pl.Path(str(tmpdir)) / f"chapter_{4 - i}.md"
+        md_path.write_text(TOKENIZER_TEXT * (i + 1), encoding="utf-8")
+        md_paths.append(md_path)
+
+    serial_ctx   = sut.parse_context(md_paths)
+    parallel_ctx = sut.parse_context(md_paths, jobs=3)
+
+    assert [f.md_path for f in serial_ctx.files] == sorted(md_paths)
+    assert [f.md_path for f in parallel_ctx.files] == sorted(md_paths)
+    for serial_file, parallel_file in zip(serial_ctx.files, parallel_ctx.files):
+        assert str(serial_file) == str(parallel_file)
+        assert serial_file.blocks == parallel_file.blocks
+
+
+def test_parse_cache(tmpdir, monkeypatch):
+    md_path   = pl.Path(str(tmpdir)) / "test.md"
+    cache_dir = pl.Path(str(tmpdir)) / ".litprog.cache"
+    md_path.write_text(TOKENIZER_TEXT, encoding="utf-8")
+
+    uncached_ctx = sut.parse_context([md_path])
+    cold_ctx     = sut.parse_context([md_path], cache_dir=cache_dir)
+    assert len(list((cache_dir / "parse").glob("*.pickle"))) == 1
+
+    warm_ctx = sut.parse_context([md_path], cache_dir=cache_dir)
+    for ctx in [cold_ctx, warm_ctx]:
+        md_file = ctx.files[0]
+        assert str(md_file) == TOKENIZER_TEXT
+        assert md_file.blocks    == uncached_ctx.files[0].blocks
+        assert md_file.headlines == uncached_ctx.files[0].headlines
+
+    # with is_cache_readonly, a changed file is parsed, but not cached
+    md_path.write_text(TOKENIZER_TEXT + "\nmore text\n", encoding="utf-8")
+    cached_paths = sorted((cache_dir / "parse").iterdir())
+    readonly_ctx = sut.parse_context([md_path], cache_dir=cache_dir, is_cache_readonly=True)
+    assert str(readonly_ctx.files[0]).endswith("more text\n")
+    assert sorted((cache_dir / "parse").iterdir()) == cached_paths
+
+    # a changed file is parsed again, the previous entry is removed
+    changed_ctx = sut.parse_context([md_path], cache_dir=cache_dir)
+    assert str(changed_ctx.files[0]).endswith("more text\n")
+    assert len(list((cache_dir / "parse").glob("*.pickle"))) == 1
+
+    # the file is only read once, even if it changes while it is parsed
+    monkeypatch.setattr(sut, '_read_md_content', lambda md_path: "changed\n")
+    md_path.write_text(TOKENIZER_TEXT, encoding="utf-8")
+    reparsed_ctx = sut.parse_context([md_path], cache_dir=cache_dir)
+    assert str(reparsed_ctx.files[0]) == TOKENIZER_TEXT
+
+
+def test_context_copy_shares_elements(tmpdir):
+    md_path = pl.Path(str(tmpdir)) / "test.md"
+    md_path.write_text(TOKENIZER_TEXT, encoding="utf-8")
+
+    ctx      = sut.parse_context([md_path])
+    ctx_copy = ctx.copy()
+    assert ctx_copy == ctx
+    assert ctx_copy.files[0] is not ctx.files[0]
+    assert ctx_copy.files[0].elements is ctx.files[0].elements
+    assert not hasattr(ctx.files[0].elements[0], '__dict__')
+
+    # replacing the elements of a copy doesn't affect the original
+    ctx_copy.files[0].elements = list(ctx.files[0].elements[:-1])
+    assert ctx_copy != ctx
+    assert str(ctx.files[0]) == TOKENIZER_TEXT
+
+
+def test_parse_context_mmap(tmpdir):
+    md_path = pl.Path(str(tmpdir)) / "test.md"
+    md_path.write_text("Ünïcödé\n\n" + TOKENIZER_TEXT, encoding="utf-8")
+
+    ctx      = sut.parse_context([md_path])
+    mmap_ctx = sut.parse_context([md_path], use_mmap=True)
+
+    md_file      = ctx.files[0]
+    mmap_md_file = mmap_ctx.files[0]
+    assert str(mmap_md_file) == str(md_file)
+    assert mmap_md_file.blocks    == md_file.blocks
+    assert mmap_md_file.headlines == md_file.headlines
+
+    # content is decoded on demand and not retained
+    elem = mmap_md_file.elements[0]
+    assert elem._content is None
+    assert elem.content == md_file.elements[0].content
+    assert [e.first_line for e in mmap_md_file.elements] == [
+        e.first_line for e in md_file.elements
+    ]
+
+
+def test_directive_index(tmpdir):
+    md_path = pl.Path(str(tmpdir)) / "test.md"
+    md_path.write_text(TOKENIZER_TEXT, encoding="utf-8")
+
+    ctx     = sut.parse_context([md_path])
+    md_file = ctx.files[0]
+
+    run_block = md_file.blocks[0]
+    assert list(run_block.directive_index) == ['lp_language', 'lp_run']
+    assert run_block.directive_index['lp_run'][0].value == "python3"
+
+    assert md_file.blocks_with_directive('lp_run') == [run_block]
+    assert md_file.blocks_with_directive('lp_file') == []
+    assert list(ctx.blocks_with_directive('lp_run')) == [run_block]
+
+
+def test_line_index(tmpdir):
+    md_path = pl.Path(str(tmpdir)) / "test.md"
+    md_path.write_text(TOKENIZER_TEXT, encoding="utf-8")
+
+    ctx     = sut.parse_context([md_path])
+    md_file = ctx.files[0]
+    text    = str(md_file)
+
+    assert md_file.line_starts[0] == 0
+    assert len(md_file.line_starts) == text.count("\n") + 1
+    for elem in md_file.elements:
+        offset = md_file.elem_offset(elem.elem_index)
+        assert text[offset:].startswith(elem.content)
+        assert md_file.line_no(offset) == elem.first_line
+
+    assert md_file.copy()._line_starts is md_file._line_starts
+
+
+def _parse_test_block(content):
+    elem = sut.MarkdownElement(pl.Path("test.md"), 0, 'block', content, 1, None)
+    return sut._parse_block(pl.Path("test.md"), 0, elem)
+
+
+def test_parse_block_directives():
+    block = _parse_test_block(
+        "```python\n# lp_run: python3\n# lp_hide\n# a comment\nprint(1)\n    # lp_add: foo\n```"
+    )
+    assert [d.name for d in block.directives] == ['lp_language', 'lp_run', 'lp_hide', 'lp_add']
+    assert block.directives[3].raw_text == "    # lp_add: foo"
+    assert block.inner_content == "# a comment\nprint(1)\n"
+
+    block = _parse_test_block("```html\n<!-- lp_out --> <!-- lp_hide -->\n<p>\n```")
+    assert [d.name for d in block.directives] == ['lp_language', 'lp_out', 'lp_hide']
+    assert block.directives[2].raw_text == " <!-- lp_hide "
+    assert block.inner_content == "\n<p>"
+
+
+def test_fs_scanning_prune(tmpdir):
+    root = pl.Path(str(tmpdir))
+    for rel_path in [
+        "a.md",
+        "sub/b.markdown",
+        "sub/c.txt",
+        "sub/.git/d.md",
+        "html/e.md",
+        "node_modules/f.md",
+    ]:
+        fpath = root / rel_path
+        fpath.parent.mkdir(parents=True, exist_ok=True)
+        fpath.write_text("# Title\n", encoding="utf-8")
+
+    md_paths = litprog.cli._iter_markdown_filepaths(
+        [str(root), str(root / "a.md")],
+        ignore_patterns=["node_*"],
+        exclude_dirs=[str(root / "html")],
+    )
+    rel_paths = sorted(str(p.relative_to(root)) for p in md_paths)
+    assert rel_paths == ["a.md", "sub/b.markdown"]
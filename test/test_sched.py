@@ -0,0 +1,67 @@
+# This file is part of the litprog project
+# https://gitlab.com/mbarkhau/litprog
+#
+# Copyright (c) 2020 Manuel Barkhau (mbarkhau@gmail.com) - MIT License
+# SPDX-License-Identifier: MIT
+import time
+import threading
+
+import pytest
+
+import litprog.sched as sut
+
+
+def test_graph_order():
+    calls = []
+
+    graph = sut.Graph()
+    graph.add('c', lambda: calls.append('c') or 3, deps=['b'])
+    graph.add('a', lambda: calls.append('a') or 1)
+    graph.add('b', lambda: calls.append('b') or 2, deps=['a'])
+    graph.add('d', lambda: calls.append('d') or 4)
+
+    results = graph.run(jobs=1)
+    assert results == {'a': 1, 'b': 2, 'c': 3, 'd': 4}
+    assert calls == ['a', 'b', 'c', 'd']
+
+
+def test_graph_parallel():
+    barrier = threading.Barrier(3, timeout=5)
+
+    graph = sut.Graph()
+    for key in range(3):
+        graph.add(key, barrier.wait)
+    graph.add('last', time.time, deps=range(3))
+
+    results = graph.run(jobs=3)
+    assert sorted(results[key] for key in range(3)) == [0, 1, 2]
+
+
+def test_graph_errors():
+    graph = sut.Graph()
+    graph.add('a', lambda: 1, deps=['b'])
+    graph.add('b', lambda: 2, deps=['a'])
+    with pytest.raises(sut.CycleError):
+        graph.run()
+
+    calls = []
+
+    def _fail():
+        raise ValueError("fail")
+
+    graph = sut.Graph()
+    graph.add('a', _fail)
+    graph.add('b', lambda: calls.append('b'), deps=['a'])
+    with pytest.raises(ValueError):
+        graph.run()
+    assert calls == []
+
+
+def test_graph_dep_results():
+    graph = sut.Graph()
+    graph.add('a', lambda: 1)
+    graph.add('b', lambda: 2)
+    graph.add('sum', lambda: graph.results['a'] + graph.results['b'], deps=['a', 'b'])
+
+    results = graph.run(jobs=2)
+    assert results['sum'] == 3
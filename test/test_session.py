@@ -10,6 +10,7 @@
 #  Changes will be overwritten!   #
 ###################################
 import io
+import asyncio
 
 import litprog.session as sut
 
@@ -75,3 +76,164 @@ def test_integration():
     assert session.stderr == "moep\n"
     assert retcode        == 0
     assert session.runtime < 0.2
+
+
+def test_bounded_lines():
+    lines = sut.BoundedLines(max_lines=4)
+    for i in range(10):
+        lines.append(sut.RawCapturedLine(float(i), f"{i}\n"))
+
+    assert [cl.line for cl in lines] == ["0\n", "1\n", "8\n", "9\n"]
+    assert lines.is_truncated
+    assert lines.n_omitted_lines == 6
+    assert lines.omitted_ts      == 2.0
+
+    lines = sut.BoundedLines(max_bytes=8)
+    for i in range(3):
+        lines.append(sut.RawCapturedLine(float(i), "abc\n"))
+    assert len(lines) == 2
+    assert lines.n_omitted_bytes == 4
+
+
+def test_truncated_session():
+    session = sut.InteractiveSession(cmd=['python'], max_lines=4)
+    session.send("for i in range(1000): print(i)\n")
+    assert session.wait() == 0
+    assert session.is_truncated
+
+    lines = list(session.iter_lines())
+    assert [cl.line for cl in lines] == ["0\n", "1\n", "", "998\n", "999\n"]
+    assert [cl.n_omitted for cl in lines] == [0, 0, 996, 0, 0]
+
+
+def test_persistent_session():
+    session = sut.PersistentSession("python3")
+
+    output = session.run(["x = 41\n", "print('a', end='')\n"])
+    assert output.exit_status == 0
+    assert [cl.line for cl in output.lines] == ["a"]
+
+    output = session.run(["x += 1\n", "print(x)\n", "1 / 0\n"])
+    assert output.exit_status == 1
+    assert output.lines[0].line == "42\n"
+    assert output.lines[-1].line == "ZeroDivisionError: division by zero\n"
+    assert output.lines[-1].is_err
+
+    output = session.run(["print(x)\n"])
+    assert [cl.line for cl in output.lines] == ["42\n"]
+    assert session.close() == 0
+
+
+def test_persistent_shell_session():
+    session = sut.PersistentSession("bash", max_lines=4)
+
+    output = session.run(["cd /\n", "A=1\n", "seq 1 100\n", "false\n"])
+    assert output.exit_status == 1
+    assert output.is_truncated
+    assert [cl.line for cl in output.lines] == ["1\n", "2\n", "", "99\n", "100\n"]
+
+    output = session.run(["pwd\n", "echo a=$A\n"])
+    assert output.exit_status == 0
+    assert not output.is_truncated
+    assert [cl.line for cl in output.lines] == ["/\n", "a=1\n"]
+
+    # the process is restarted (with fresh state) after it exits
+    output = session.run(["exit 3\n"])
+    assert output.exit_status == 3
+    output = session.run(["echo a=$A\n"])
+    assert [cl.line for cl in output.lines] == ["a=\n"]
+    assert session.close() == 0
+
+
+def test_wait_timeout():
+    session = sut.InteractiveSession(cmd=['sleep', '5'])
+    retcode = session.wait(timeout=0.2)
+    assert retcode != 0
+    assert session.runtime < 1
+
+
+def test_wait_fallback(monkeypatch):
+    monkeypatch.delattr(sut.os, 'pidfd_open', raising=False)
+
+    session = sut.InteractiveSession(cmd=['python'])
+    session.send("print('ok')\n")
+    assert session.wait() == 0
+    assert session.stdout == "ok\n"
+
+    session = sut.InteractiveSession(cmd=['sleep', '5'])
+    assert session.wait(timeout=0.2) != 0
+
+
+def test_async_sessions():
+    async def _run(i):
+        session = await sut.AsyncInteractiveSession.create(['python'])
+        await session.send(f"import sys\nprint({i})\nsys.stderr.write('err\\n')\n")
+        retcode = await session.wait(timeout=5)
+        return session, retcode
+
+    async def _run_all():
+        return await asyncio.gather(*[_run(i) for i in range(20)])
+
+    results = asyncio.run(_run_all())
+    for i, (session, retcode) in enumerate(results):
+        assert retcode        == 0
+        assert session.stdout == f"{i}\n"
+        assert session.stderr == "err\n"
+        assert sorted(cl.is_err for cl in session.iter_lines()) == [False, True]
+        assert session.runtime > 0
+
+
+def test_async_session_timeout():
+    async def _run():
+        session = await sut.AsyncInteractiveSession.create(['sleep', '5'])
+        return await session.wait(timeout=0.2)
+
+    assert asyncio.run(_run()) != 0
+
+
+def test_split_multibyte_line():
+    raw_lines = [b"Hello \xe4\xb8", b"\x96\xe7\x95\x8c!\n"]
+    lines     = [cl.line for cl in sut._gen_captured_lines(raw_lines)]
+    assert "".join(lines) == "Hello 世界!\n"
+
+
+INTERLEAVED_BLOCK = r"""
+import sys, time
+for i in range(5):
+    sys.stdout.write(f"out{i}\n")
+    sys.stdout.flush()
+    time.sleep(0.005)
+    sys.stderr.write(f"err{i}\n")
+    sys.stderr.flush()
+    time.sleep(0.005)
+"""
+
+
+def test_interleaved_lines():
+    session = sut.InteractiveSession(cmd=['python'])
+    session.send(INTERLEAVED_BLOCK)
+    assert session.wait(timeout=5) == 0
+
+    lines = list(session.iter_lines())
+    assert [cl.line for cl in lines] == [
+        f"{name}{i}\n" for i in range(5) for name in ["out", "err"]
+    ]
+    assert [cl.is_err for cl in lines] == [False, True] * 5
+
+    timestamps = [cl.ts for cl in lines]
+    assert timestamps == sorted(set(timestamps))
+
+
+def test_split_lines():
+    lines  = sut.BoundedLines()
+    stream = sut._ReaderStream(lines, "utf-8")
+    clock  = sut._Clock(0.0, sut._monotonic_ns())
+
+    stream.buf += b"abcdefgh\nij"
+    sut._split_lines(stream, clock, max_line_bytes=4, is_eof=False)
+    assert [cl.line for cl in lines] == ["abcd", "efgh", "\n"]
+    assert bytes(stream.buf) == b"ij"
+
+    sut._split_lines(stream, clock, max_line_bytes=4, is_eof=True)
+    assert [cl.line for cl in lines][-1] == "ij"
+    assert bytes(stream.buf) == b""
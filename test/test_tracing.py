@@ -0,0 +1,61 @@
+# This file is part of the litprog project
+# https://gitlab.com/mbarkhau/litprog
+#
+# Copyright (c) 2020 Manuel Barkhau (mbarkhau@gmail.com) - MIT License
+# SPDX-License-Identifier: MIT
+import json
+import threading
+
+import pathlib2 as pl
+
+import litprog.tracing as sut
+
+
+def test_disabled():
+    assert not sut.is_enabled()
+    with sut.span("noop"):
+        pass
+    assert sut.stop() is None
+
+
+def test_trace_events(tmpdir):
+    sut.start()
+    try:
+        with sut.span("outer", path="a.md"):
+            with sut.span("inner"):
+                pass
+
+        with sut.span("threaded"):
+            thread = threading.Thread(target=_worker_span, name="worker-1")
+            thread.start()
+            thread.join()
+    finally:
+        trace_path = pl.Path(str(tmpdir)) / "trace.json"
+        sut.stop(trace_path)
+
+    assert not sut.is_enabled()
+
+    with trace_path.open(mode="r", encoding="utf-8") as fobj:
+        trace = json.load(fobj)
+
+    spans = {event['name']: event for event in trace['traceEvents'] if event['ph'] == "X"}
+    assert set(spans) == {"outer", "inner", "threaded", "worker"}
+    assert spans['outer']['args'] == {'path': "a.md"}
+
+    outer = spans['outer']
+    inner = spans['inner']
+    assert outer['ts'] <= inner['ts']
+    assert inner['ts'] + inner['dur'] <= outer['ts'] + outer['dur']
+
+    assert spans['worker']['tid'] != spans['threaded']['tid']
+    thread_names = {
+        event['tid']: event['args']['name']
+        for event in trace['traceEvents']
+        if event['ph'] == "M"
+    }
+    assert thread_names[spans['worker']['tid']] == "worker-1"
+
+
+def _worker_span():
+    with sut.span("worker"):
+        pass